@@ -0,0 +1,102 @@
+#!/usr/bin/python
+#
+# Compare reading and writing the package profile cache as JSON and in
+# the compact cache format, as ProfileManager does every
+# rhsmcertd-worker run.
+#
+#  usage: scripts/bench_cache_format.py [count ...]
+#
+# Runs from the top of a source checkout, defaults to profiles of 1000,
+# 5000 and 20000 installed packages. Reading includes building the
+# RPMProfile that has_changed compares.
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, 'src')
+
+from rhsm import ourjson as json
+from subscription_manager import cacheformat
+
+REPEAT = 5
+ARCHES = ['x86_64', 'i686', 'noarch']
+VENDORS = ['Red Hat, Inc.', 'Fedora Project', None]
+
+
+def build_profile(count):
+    return [{'name': 'package-%d-%s' % (i, 'devel' if i % 3 else 'libs'),
+             'version': '%d.%d.%d' % (i % 7, i % 13, i % 31),
+             'release': '%d.el7' % (i % 17),
+             'arch': ARCHES[i % len(ARCHES)],
+             'epoch': i % 4,
+             'vendor': VENDORS[i % len(VENDORS)]}
+            for i in range(count)]
+
+
+def profile_from_dicts(pkg_dicts):
+    # As RPMProfile and ProfileManager._load_compact_data do, without
+    # needing rpm to be importable.
+    return [(d['name'], d['version'], d['release'], d['arch'], d['epoch'],
+             d['vendor']) for d in pkg_dicts]
+
+
+def write_json(path, data):
+    f = open(path, 'w')
+    f.write(json.dumps(data, default=json.encode))
+    f.close()
+
+
+def read_json(path):
+    f = open(path)
+    data = json.loads(f.read())
+    f.close()
+    return profile_from_dicts(data)
+
+
+def write_compact(path, data):
+    f = open(path, 'w')
+    f.write(cacheformat.dumps(data))
+    f.close()
+
+
+def read_compact(path):
+    f = open(path)
+    data = cacheformat.load(f)
+    f.close()
+    return profile_from_dicts(data)
+
+
+def best(func, *args):
+    return min(timeit.repeat(lambda: func(*args), repeat=REPEAT, number=1))
+
+
+def main(counts):
+    tmp_dir = tempfile.mkdtemp()
+    json_path = os.path.join(tmp_dir, 'packages.json')
+    compact_path = os.path.join(tmp_dir, 'packages.compact')
+    print "%8s %10s %10s %10s %10s %10s %10s" % (
+        "packages", "json (kB)", "write (s)", "read (s)",
+        "cmpct (kB)", "write (s)", "read (s)")
+    try:
+        for count in counts:
+            data = build_profile(count)
+            write_json(json_path, data)
+            write_compact(compact_path, data)
+            assert read_json(json_path) == read_compact(compact_path)
+            print "%8d %10d %10.4f %10.4f %10d %10.4f %10.4f" % (
+                count,
+                os.path.getsize(json_path) / 1024,
+                best(write_json, json_path, data),
+                best(read_json, json_path),
+                os.path.getsize(compact_path) / 1024,
+                best(write_compact, compact_path, data),
+                best(read_compact, compact_path))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 5000, 20000])
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+#
+# Compare certificate directory lookups done by scanning the listing
+# against the serial/product/stacking id indexes.
+#
+#  usage: scripts/bench_certdir_lookups.py [certs] [products]
+#
+# Runs from the top of a source checkout, defaults to 1000 certs and
+# 500 products.
+
+import random
+import sys
+import timeit
+
+sys.path.insert(0, 'src')
+sys.path.insert(0, 'test')
+
+# the test stubs pull in gui code, which needs the ga module set up
+from subscription_manager import ga_loader
+ga_loader.init_ga()
+
+from stubs import StubEntitlementCertificate, StubEntitlementDirectory
+
+
+def scan_find_by_product(cert_dir, p_hash):
+    for c in cert_dir.list():
+        for p in c.products:
+            if p.id == p_hash:
+                return c
+    return None
+
+
+def scan_list_for_product(cert_dir, product_id):
+    entitlements = []
+    for cert in cert_dir.list():
+        for cert_product in cert.products:
+            if product_id == cert_product.id:
+                entitlements.append(cert)
+    return entitlements
+
+
+def scan_find_all_by_product(cert_dir, p_hash):
+    certs = set()
+    providing_stack_ids = set()
+    stack_id_map = {}
+    for c in cert_dir.list():
+        for p in c.products:
+            if p.id == p_hash:
+                certs.add(c)
+                if (c.order and c.order.stacking_id):
+                    providing_stack_ids.add(c.order.stacking_id)
+        if (c.order and c.order.stacking_id):
+            stack_id_map.setdefault(c.order.stacking_id, set()).add(c)
+    for stack_id in providing_stack_ids:
+        certs |= stack_id_map[stack_id]
+    return list(certs)
+
+
+def scan_find(cert_dir, sn):
+    for c in cert_dir.list():
+        if c.serial == sn:
+            return c
+    return None
+
+
+def build(cert_count, product_count):
+    pids = ["%s" % i for i in range(product_count)]
+    certs = []
+    for i in range(cert_count):
+        provided = random.sample(pids, 5)
+        stacking_id = None
+        if i % 3 == 0:
+            stacking_id = "stack-%s" % (i % 50)
+        certs.append(StubEntitlementCertificate(provided[0],
+                                                provided_products=provided[1:],
+                                                stacking_id=stacking_id))
+    return StubEntitlementDirectory(certs), pids
+
+
+def run(label, scan, indexed):
+    scan_time = min(timeit.repeat(scan, repeat=3, number=1))
+    indexed_time = min(timeit.repeat(indexed, repeat=3, number=1))
+    print "%-22s %12.4f %12.4f %8.1fx" % (label, scan_time, indexed_time,
+                                         scan_time / indexed_time)
+
+
+def main(cert_count, product_count):
+    cert_dir, pids = build(cert_count, product_count)
+    serials = [c.serial for c in cert_dir.list()]
+    print "%d certs, %d products" % (cert_count, product_count)
+    print "%-22s %12s %12s %9s" % ("lookup", "scan (s)", "indexed (s)", "speedup")
+
+    run("find_by_product",
+        lambda: [scan_find_by_product(cert_dir, pid) for pid in pids],
+        lambda: [cert_dir.find_by_product(pid) for pid in pids])
+    run("list_for_product",
+        lambda: [scan_list_for_product(cert_dir, pid) for pid in pids],
+        lambda: [cert_dir.list_for_product(pid) for pid in pids])
+    run("find",
+        lambda: [scan_find(cert_dir, sn) for sn in serials],
+        lambda: [cert_dir.find(sn) for sn in serials])
+    run("find_all_by_product",
+        lambda: [scan_find_all_by_product(cert_dir, pid) for pid in pids],
+        lambda: [cert_dir.find_all_by_product(pid) for pid in pids])
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [1000, 500][len(args):]))
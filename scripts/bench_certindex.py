@@ -0,0 +1,67 @@
+#!/usr/bin/python
+#
+# Compare listing a certificate directory by parsing every PEM file
+# against listing it from the persistent certificate index.
+#
+#  usage: scripts/bench_certindex.py [count ...]
+#
+# Runs from the top of a source checkout, defaults to 10, 100 and 1000 certs.
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, 'src')
+sys.path.insert(0, 'test')
+
+import certdata
+from subscription_manager import certindex
+from subscription_manager.certdirectory import CertificateDirectory
+
+REPEAT = 3
+
+
+def populate(path, count):
+    for i in range(count):
+        f = open(os.path.join(path, '%s.pem' % i), 'w')
+        f.write(certdata.ENTITLEMENT_CERT_V3_0)
+        f.close()
+
+
+def cold_list(path):
+    cert_dir = CertificateDirectory(path)
+    cert_dir._get_index().delete_cache()
+    return cert_dir.list()
+
+
+def indexed_list(path):
+    return CertificateDirectory(path).list()
+
+
+def main(counts):
+    index_dir = tempfile.mkdtemp(prefix='bench-certindex-')
+    certindex.CERT_INDEX_DIR = index_dir
+    print "%8s %12s %12s %8s" % ("certs", "cold (s)", "indexed (s)", "speedup")
+    try:
+        for count in counts:
+            cert_path = tempfile.mkdtemp(prefix='bench-certdir-')
+            try:
+                populate(cert_path, count)
+                cold = min(timeit.repeat(lambda: cold_list(cert_path),
+                                         repeat=REPEAT, number=1))
+                # make sure the index is written before timing it
+                indexed_list(cert_path)
+                indexed = min(timeit.repeat(lambda: indexed_list(cert_path),
+                                            repeat=REPEAT, number=1))
+                print "%8d %12.4f %12.4f %7.1fx" % (count, cold, indexed,
+                                                   cold / indexed)
+            finally:
+                shutil.rmtree(cert_path)
+    finally:
+        shutil.rmtree(index_dir)
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000])
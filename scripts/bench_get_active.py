@@ -0,0 +1,118 @@
+#!/usr/bin/python
+#
+# Compare finding the active repos with a rpmdb search for every
+# available package against the join on the installed package index
+# used by ProductManager.get_active.
+#
+#  usage: scripts/bench_get_active.py [count ...]
+#
+# Runs from the top of a source checkout, defaults to synthetic package
+# sacks of 5000, 50000 and 200000 available packages. The rpmdb is an
+# in memory stand in, so the searchNevra numbers are a lower bound of
+# what searching the real rpmdb costs.
+
+import sys
+import timeit
+
+sys.path.insert(0, 'src')
+
+from subscription_manager import productid
+
+REPEAT = 3
+ARCHES = ['x86_64', 'i686', 'noarch']
+PACKAGES_PER_REPO = 1000
+# one in INSTALLED_RATIO available packages is installed
+INSTALLED_RATIO = 4
+
+
+class FakePackage(object):
+    def __init__(self, name, arch, repoid):
+        self.name = name
+        self.arch = arch
+        self.repoid = repoid
+        self.epoch = '0'
+        self.ver = '1.0'
+        self.rel = '1'
+        self.pkgtup = (name, arch, self.epoch, self.ver, self.rel)
+
+
+class FakeRpmdb(object):
+    """
+    Stand in for a fully loaded yum RPMDBPackageSack, searchNevra follows
+    the in memory path of RPMDBPackageSack._search.
+    """
+    def __init__(self, packages):
+        self._name2pkg = {}
+        self._tup2pkg = {}
+        for p in packages:
+            self._name2pkg.setdefault(p.name, []).append(p)
+            self._tup2pkg[p.pkgtup] = p
+        self._pkgname_fails = set()
+
+    def searchNevra(self, name=None, epoch=None, ver=None, rel=None, arch=None):
+        if name is not None and name in self._pkgname_fails:
+            return []
+        pkgtup = (name, arch, epoch, ver, rel)
+        if pkgtup in self._tup2pkg:
+            return [self._tup2pkg[pkgtup]]
+        loc = locals()
+        ret = []
+        pkgs = self._name2pkg.get(name, [])
+        if not pkgs:
+            self._pkgname_fails.add(name)
+        for po in pkgs:
+            for tag in ('arch', 'rel', 'ver', 'epoch'):
+                if loc[tag] is not None and loc[tag] != getattr(po, tag):
+                    break
+            else:
+                ret.append(po)
+        return ret
+
+    def simplePkgList(self):
+        return self._tup2pkg.keys()
+
+
+def build_sacks(count):
+    available = []
+    installed = []
+    for i in range(count):
+        p = FakePackage('package-%d' % (i / len(ARCHES)),
+                        ARCHES[i % len(ARCHES)],
+                        'repo-%d' % (i / PACKAGES_PER_REPO))
+        available.append(p)
+        if i % INSTALLED_RATIO == 0:
+            installed.append(FakePackage(p.name, p.arch, 'installed'))
+    return available, FakeRpmdb(installed)
+
+
+def searchnevra_active(packages, rpmdb):
+    active = set([])
+    for p in packages:
+        if not rpmdb.searchNevra(name=p.name, arch=p.arch):
+            continue
+        if p.repoid in (None, "installed"):
+            continue
+        active.add(p.repoid)
+    return active
+
+
+def indexed_active(packages, rpmdb):
+    return productid.find_active_repos(packages,
+                                       productid.installed_package_index(rpmdb))
+
+
+def main(counts):
+    print "%8s %14s %12s %8s" % ("packages", "searchNevra (s)", "indexed (s)", "speedup")
+    for count in counts:
+        packages, rpmdb = build_sacks(count)
+        assert searchnevra_active(packages, rpmdb) == indexed_active(packages, rpmdb)
+        search = min(timeit.repeat(lambda: searchnevra_active(packages, rpmdb),
+                                   repeat=REPEAT, number=1))
+        indexed = min(timeit.repeat(lambda: indexed_active(packages, rpmdb),
+                                    repeat=REPEAT, number=1))
+        print "%8d %14.4f %12.4f %7.1fx" % (count, search, indexed,
+                                           search / indexed)
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [5000, 50000, 200000])
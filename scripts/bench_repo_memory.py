@@ -0,0 +1,134 @@
+#!/usr/bin/python
+#
+# Report the peak RSS of building the content and repo models of a
+# full repo update, as the yum plugin does for every transaction.
+#
+#  usage: scripts/bench_repo_memory.py [--baseline] [count ...]
+#
+# Runs from the top of a source checkout, defaults to entitlements
+# providing 1000, 3000 and 10000 content sets. Each count is measured in
+# a fresh process, as peak RSS never goes down.
+#
+# With --baseline, strings are not interned and the content and repo
+# models get a per instance dict, as they had before they were slotted,
+# to compare against the current code from the same checkout.
+
+import resource
+import subprocess
+import sys
+
+sys.path.insert(0, 'src')
+
+CONTENT_PER_CERT = 100
+BASEURL = 'https://cdn.example.com'
+CA_CERT = '/etc/rhsm/ca/redhat-uep.pem'
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class FakeEntCert(object):
+    def __init__(self, serial, content):
+        self.path = '/etc/pki/entitlement/%d.pem' % serial
+        self.content = content
+
+    def key_path(self):
+        # new string every call, like the real EntitlementCertificate
+        return '/etc/pki/entitlement/%d-key.pem' % int(self.path.split('/')[-1][:-4])
+
+
+class FakeReleaseSource(object):
+    marker = '$releasever'
+
+    def get_expansion(self):
+        return '7Server'
+
+
+def build_certs(count):
+    # Every string is built at runtime, as it would be decoding certs.
+    from rhsm.certificate2 import Content
+    certs = []
+    for serial in range(count / CONTENT_PER_CERT):
+        content = []
+        for i in range(CONTENT_PER_CERT):
+            n = serial * CONTENT_PER_CERT + i
+            content.append(Content(
+                content_type='%s' % 'yum',
+                name='Awesome OS %d (RPMs)' % n,
+                label='awesomeos-%d-rpms' % n,
+                vendor='%s' % 'Red Hat',
+                url='/content/dist/awesomeos/$releasever/$basearch/%d/os' % n,
+                gpg='%s' % 'file:///etc/pki/rpm-gpg/RPM-GPG-KEY-awesomeos-release',
+                enabled='%d' % 1,
+                metadata_expire=86400,
+                required_tags=['%s' % 'awesomeos-server', '%s' % 'awesomeos-server-7']))
+        certs.append(FakeEntCert(serial, content))
+    return certs
+
+
+def unslotted(cls, base):
+    # A subclass of a slotted class only allocates its __dict__ when an
+    # attribute outside the slots is set, so rebuild the class instead.
+    slots = getattr(cls, '__slots__', ())
+    namespace = dict((name, value) for (name, value) in cls.__dict__.items()
+                     if name not in slots and
+                     name not in ('__slots__', '__dict__', '__weakref__'))
+    return type(cls.__name__, (base,), namespace)
+
+
+def disable_interning_and_slots():
+    from subscription_manager import model
+    from subscription_manager.model import ent_cert
+    from subscription_manager import repolib
+
+    model.intern_string = lambda value: value
+
+    content = unslotted(model.Content, object)
+    ent_cert.EntitlementCertContent = unslotted(ent_cert.EntitlementCertContent,
+                                                content)
+    repolib.Repo = unslotted(repolib.Repo, dict)
+
+
+def child(count, baseline=False):
+    if baseline:
+        disable_interning_and_slots()
+
+    from subscription_manager import model
+    from subscription_manager.model import ent_cert
+    from subscription_manager.repolib import Repo
+
+    certs = build_certs(count)
+    before = peak_rss_kb()
+
+    ent_source = model.EntitlementSource()
+    ent_source.product_tags = ['awesomeos-server', 'awesomeos-server-7']
+    ent_source._entitlements = [ent_cert.EntitlementCertEntitlement.from_ent_cert(cert)
+                                for cert in certs]
+    release_source = FakeReleaseSource()
+    repos = [Repo.from_ent_cert_content(content, BASEURL, CA_CERT, release_source)
+             for content in model.find_content(ent_source, content_type='yum')]
+    assert len(repos) == count
+
+    after = peak_rss_kb()
+    print "%8d %14d %14d" % (count, after, after - before)
+
+
+def main(counts, baseline=False):
+    print "%8s %14s %14s" % ("content", "peak RSS (kB)", "models (kB)")
+    for count in counts:
+        args = [sys.executable, __file__, '--child', str(count)]
+        if baseline:
+            args.append('--baseline')
+        subprocess.check_call(args)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    baseline = '--baseline' in args
+    if baseline:
+        args.remove('--baseline')
+    if args[:1] == ['--child']:
+        child(int(args[1]), baseline)
+    else:
+        main([int(arg) for arg in args] or [1000, 3000, 10000], baseline)
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+#
+# Compare reconciling local and expected entitlement serials with the
+# old list membership tests against EntCertUpdatePlan.
+#
+#  usage: scripts/bench_serial_reconcile.py [count ...]
+#
+# Runs from the top of a source checkout, defaults to 500, 1000 and 5000
+# serials. A tenth of the local serials are rogue, a tenth of the expected
+# serials are missing.
+
+import sys
+import timeit
+
+sys.path.insert(0, 'src')
+
+from subscription_manager.entcertlib import EntCertUpdatePlan
+
+REPEAT = 3
+FIRST_SERIAL = 1000000000000000000
+
+
+def serials(count):
+    rogue = count / 10
+    local = dict((FIRST_SERIAL + i, object()) for i in range(count))
+    expected = [FIRST_SERIAL + i for i in range(rogue, count + rogue)]
+    return local, expected
+
+
+def list_reconcile(local, expected):
+    missing = [sn for sn in expected if sn not in local]
+    rogue = [local[sn] for sn in local if not sn in expected]
+    return missing, rogue
+
+
+def plan_reconcile(local, expected):
+    plan = EntCertUpdatePlan(local, expected)
+    return plan.missing, plan.rogue
+
+
+def main(counts):
+    print "%8s %12s %12s %8s" % ("serials", "list (s)", "plan (s)", "speedup")
+    for count in counts:
+        local, expected = serials(count)
+        old = min(timeit.repeat(lambda: list_reconcile(local, expected),
+                                repeat=REPEAT, number=1))
+        new = min(timeit.repeat(lambda: plan_reconcile(local, expected),
+                                repeat=REPEAT, number=1))
+        print "%8d %12.4f %12.4f %7.1fx" % (count, old, new, old / new)
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [500, 1000, 5000])
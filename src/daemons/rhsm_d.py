@@ -91,11 +91,7 @@ def debug(msg):
 
 
 def in_warning_period(sorter):
-
-    for entitlement in sorter.valid_entitlement_certs:
-        if entitlement.is_expiring():
-            return True
-    return False
+    return sorter.in_warning_period()
 
 
 def pre_check_status(force_signal):
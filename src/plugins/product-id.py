@@ -22,13 +22,26 @@ sys.path.append('/usr/share/rhsm')
 
 
 from subscription_manager import logutil
-from subscription_manager.productid import ProductManager
+from subscription_manager.productid import ProductManager, rpmdb_signature
 from subscription_manager.utils import chroot
 from subscription_manager.injectioninit import init_dep_injection
 
 requires_api_version = '2.6'
 plugin_type = (TYPE_CORE,)
 
+# rpmdb signature from before the transaction
+rpmdb_before = None
+
+
+def pretrans_hook(conduit):
+    """
+    Remember the rpmdb signature, so the active repos found before the
+    transaction can be updated with just the transaction members.
+    """
+    global rpmdb_before
+    chroot(conduit.getConf().installroot)
+    rpmdb_before = rpmdb_signature()
+
 
 def posttrans_hook(conduit):
     """
@@ -51,7 +64,8 @@ def posttrans_hook(conduit):
     chroot(conduit.getConf().installroot)
     try:
         pm = ProductManager()
-        pm.update(conduit._base)
+        pm.update(conduit._base, ts_info=conduit.getTsInfo(),
+                  rpmdb_before=rpmdb_before)
         conduit.info(3, 'Installed products updated.')
     except Exception, e:
         conduit.error(3, str(e))
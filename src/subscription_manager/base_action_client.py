@@ -16,6 +16,7 @@
 import logging
 
 from subscription_manager import injection as inj
+from subscription_manager.cache import get_consumer_cache
 
 from rhsm.connection import GoneException, ExpiredIdentityCertException
 
@@ -48,12 +49,16 @@ class BaseActionClient(object):
         @rtype: list
         """
         lock = self.lock
+        # The libs share the consumer documents they fetch for this update
+        consumer_cache = get_consumer_cache()
 
         # TODO: move to using a lock context manager
         try:
             lock.acquire()
+            consumer_cache.begin()
             self.update_reports = self._run_updates(autoheal)
         finally:
+            consumer_cache.end()
             lock.release()
 
     def _run_update(self, lib):
@@ -19,18 +19,25 @@ this with the current state, and perform an update on the server if
 necessary.
 """
 
+import atexit
 import gettext
+import hashlib
 import logging
 import os
 import socket
 import threading
+import time
+from iniparse.compat import NoSectionError, NoOptionError
 from M2Crypto import SSL
 
 from rhsm.config import initConfig
 import rhsm.connection as connection
-from rhsm.profile import get_profile, RPMProfile
+from rhsm.profile import get_profile, Package, RPMProfile
+from subscription_manager import cacheformat
+from subscription_manager.certdirectory import Path
 import subscription_manager.injection as inj
 from subscription_manager.jsonwrapper import PoolWrapper
+from subscription_manager.utils import write_file_atomic
 from rhsm import ourjson as json
 
 _ = gettext.gettext
@@ -40,6 +47,122 @@ PACKAGES_RESOURCE = "packages"
 
 cfg = initConfig()
 
+# Restlib only hands back the parsed body of a response, conditional
+# requests need its status and headers. Older python-rhsm does not have it.
+BaseRestLib = getattr(connection, 'BaseRestLib', None)
+
+
+def _raw_get(conn, handler, headers):
+    """
+    GET handler on a Restlib connection. Returns a dict of the 'status',
+    'headers' and unparsed 'content' of the response.
+    """
+    return BaseRestLib._request(conn, "GET", handler, headers=headers)
+
+
+class PersistenceQueue(object):
+    """
+    Writes cache files in the background, from one thread per process.
+
+    put() queues a callable that writes the file at path. A write queued
+    for a path that is still waiting replaces the waiting one, so only
+    the latest data is written. flush() waits until everything queued has
+    been written, and runs when the process exits.
+
+    The writers must not log, logging from this thread can cause a
+    segfault, BZ 988861 and 988430.
+    """
+
+    def __init__(self):
+        # path -> writer, for writes that have not started yet
+        self._pending = {}
+        # path being written right now
+        self._writing = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def put(self, path, writer):
+        self._cond.acquire()
+        try:
+            self._pending[path] = writer
+            if self._thread is None or not self._thread.isAlive():
+                self._thread = threading.Thread(target=self._run,
+                                                name="PersistenceQueueThread")
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def discard(self, path):
+        """
+        Drop a waiting write to path, and wait for one in progress.
+        """
+        self._cond.acquire()
+        try:
+            self._pending.pop(path, None)
+            while self._writing == path:
+                self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def flush(self):
+        self._cond.acquire()
+        try:
+            while self._pending or self._writing is not None:
+                if self._thread is None or not self._thread.isAlive():
+                    # Nothing is left to do the writing, e.g. after a fork
+                    break
+                self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        while True:
+            self._cond.acquire()
+            try:
+                while not self._pending:
+                    self._cond.wait()
+                path, writer = self._pending.popitem()
+                self._writing = path
+            finally:
+                self._cond.release()
+
+            try:
+                writer()
+            except Exception:
+                pass
+
+            self._cond.acquire()
+            try:
+                self._writing = None
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+
+persistence_queue = PersistenceQueue()
+atexit.register(persistence_queue.flush)
+
+
+# rpmdb files that are rewritten whenever packages are installed or
+# removed, relative to the install root
+RPMDB_FILES = ['var/lib/rpm/Packages', 'var/lib/rpm/rpmdb.sqlite']
+
+
+def rpmdb_signature():
+    """
+    Return a signature of the rpmdb that changes whenever the installed
+    packages change, or None if no rpmdb could be found.
+    """
+    for name in RPMDB_FILES:
+        try:
+            st = os.stat(Path.abs(name))
+        except OSError:
+            continue
+        return [name, st.st_size, st.st_mtime, st.st_ino]
+    return None
+
 
 class CacheManager(object):
     """
@@ -52,6 +175,15 @@ class CacheManager(object):
     # Fields the subclass must override:
     CACHE_FILE = None
 
+    # Format the cache is written in, cacheformat.JSON or COMPACT. A cache
+    # in either format is read, so changing this migrates the cache the
+    # next time it is written.
+    #
+    # A compact cache is not named .json, so nothing reads it as JSON.
+    # Until it is first written, the .json cache of the same name is read
+    # instead, and that is removed once the compact cache is written.
+    CACHE_FORMAT = cacheformat.JSON
+
     def to_dict(self):
         """
         Returns the data for this collection as a dict to be serialized
@@ -66,6 +198,26 @@ class CacheManager(object):
         """
         raise NotImplementedError
 
+    def _load_compact_data(self, data):
+        """
+        Build the data the sub-class uses from what to_dict returned when
+        the cache was written in the compact format.
+        """
+        return data
+
+    def _dump_data(self):
+        """
+        Return the contents of the cache file in CACHE_FORMAT.
+        """
+        data = self.to_dict()
+        if self.CACHE_FORMAT == cacheformat.COMPACT:
+            try:
+                return cacheformat.dumps(data)
+            except ValueError:
+                # Holds something marshal can not store, JSON may.
+                pass
+        return json.dumps(data, default=json.encode)
+
     def _sync_with_server(self, uep, consumer_uuid):
         """
         Sync the latest data to/from the server.
@@ -79,15 +231,40 @@ class CacheManager(object):
         """
         raise NotImplementedError
 
+    @classmethod
+    def _json_cache_file(cls, cache_file):
+        """
+        Return the JSON cache that a compact cache at cache_file replaces,
+        or None.
+        """
+        if cls.CACHE_FORMAT != cacheformat.COMPACT:
+            return None
+        json_file = "%s.json" % os.path.splitext(cache_file)[0]
+        if json_file == cache_file:
+            return None
+        return json_file
+
+    def _existing_cache_file(self):
+        """
+        Return the file the cache is read from: CACHE_FILE, or the JSON
+        cache it replaces if only that exists.
+        """
+        if not os.path.exists(self.CACHE_FILE):
+            json_file = self._json_cache_file(self.CACHE_FILE)
+            if json_file is not None and os.path.exists(json_file):
+                return json_file
+        return self.CACHE_FILE
+
     @classmethod
     def delete_cache(cls):
         """ Delete the cache for this collection from disk. """
-        if os.path.exists(cls.CACHE_FILE):
-            log.debug("Deleting cache: %s" % cls.CACHE_FILE)
-            os.remove(cls.CACHE_FILE)
+        for cache_file in [cls.CACHE_FILE, cls._json_cache_file(cls.CACHE_FILE)]:
+            if cache_file is not None and os.path.exists(cache_file):
+                log.debug("Deleting cache: %s" % cache_file)
+                os.remove(cache_file)
 
     def _cache_exists(self):
-        return os.path.exists(self.CACHE_FILE)
+        return os.path.exists(self._existing_cache_file())
 
     def write_cache(self, debug=True):
         """
@@ -103,12 +280,13 @@ class CacheManager(object):
         try:
             if not os.access(os.path.dirname(self.CACHE_FILE), os.R_OK):
                 os.makedirs(os.path.dirname(self.CACHE_FILE))
-            f = open(self.CACHE_FILE, "w+")
-            json.dump(self.to_dict(), f, default=json.encode)
-            f.close()
+            write_file_atomic(self.CACHE_FILE, self._dump_data())
+            json_file = self._json_cache_file(self.CACHE_FILE)
+            if json_file is not None and os.path.exists(json_file):
+                os.remove(json_file)
             if debug:
                 log.debug("Wrote cache: %s" % self.CACHE_FILE)
-        except IOError, e:
+        except (IOError, OSError), e:
             if debug:
                 log.error("Unable to write cache: %s" %
                         self.CACHE_FILE)
@@ -120,9 +298,14 @@ class CacheManager(object):
         Returns none if no cache file exists.
         """
         try:
-            f = open(self.CACHE_FILE)
-            data = self._load_data(f)
-            f.close()
+            f = open(self._existing_cache_file())
+            try:
+                if cacheformat.is_compact(f):
+                    data = self._load_compact_data(cacheformat.load(f))
+                else:
+                    data = self._load_data(f)
+            finally:
+                f.close()
             return data
         except IOError:
             log.error("Unable to read cache: %s" % self.CACHE_FILE)
@@ -160,26 +343,177 @@ class StatusCache(CacheManager):
     """
     Unlike other cache managers, this one gets info from the server rather
     than sending it.
+
+    Next to the cache, the consumer uuid, the time the server was last
+    asked and the validators (ETag and Last-Modified) of the response are
+    kept. The cache is used without asking the server for TTL_OPTION
+    seconds, after that the server is asked with a conditional request.
     """
+    # Server path of the status, formatted with the consumer uuid. Needed
+    # for conditional requests.
+    STATUS_PATH = None
+
+    # [rhsm] option with the number of seconds the cache is used without
+    # asking the server. 0, the default, always asks.
+    TTL_OPTION = None
+
     def __init__(self):
         self.server_status = None
         self.last_error = None
+        # Validators of the current server_status, to write with the cache
+        self.validators = None
+
+    def _get_validators_file(self):
+        return "%s_validators.json" % os.path.splitext(self.CACHE_FILE)[0]
+
+    def _get_ttl(self):
+        if self.TTL_OPTION is None:
+            return 0
+        try:
+            ttl = cfg.get_int('rhsm', self.TTL_OPTION)
+        except (NoSectionError, NoOptionError):
+            return 0
+        except ValueError, e:
+            log.warn(e)
+            return 0
+        return max(ttl or 0, 0)
+
+    def _read_validators(self, uuid):
+        """
+        Return the validators stored for the cached status of the consumer
+        with uuid, or an empty dict.
+        """
+        try:
+            f = open(self._get_validators_file())
+            try:
+                validators = json.loads(f.read())
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(validators, dict) or validators.get('uuid') != uuid:
+            return {}
+        return validators
+
+    def _write_validators(self):
+        # Runs in the persistence queue thread, where logging can segfault.
+        if self.validators is None:
+            return
+        try:
+            write_file_atomic(self._get_validators_file(),
+                              json.dumps(self.validators))
+        except (IOError, OSError):
+            pass
+
+    def _fresh_status(self, uuid):
+        """
+        Return the cached status if the server was asked for it less than
+        the TTL ago, otherwise None.
+        """
+        ttl = self._get_ttl()
+        if not ttl:
+            return None
+        age = time.time() - self._read_validators(uuid).get('checked', 0)
+        if not 0 <= age < ttl or not self._cache_exists():
+            return None
+        return self._read_cache()
+
+    def _set_status(self, response):
+        """
+        Set server_status from the server response.
+        """
+        self.server_status = response
+
+    def _is_kept(self, uuid):
+        """
+        True if the ConsumerCache already holds the server response for
+        the consumer with uuid.
+        """
+        return False
+
+    def _keep(self, uuid, response):
+        """
+        Hand a server response fetched by _sync to the ConsumerCache.
+        """
+        pass
+
+    def _sync(self, uep, uuid):
+        """
+        Get the status from the server, conditionally if the connection
+        allows it and there is a cache to validate. A response the
+        ConsumerCache already holds for this run is used as is.
+
+        Returns False if the server reports the cached status is current,
+        True otherwise.
+        """
+        if self._is_kept(uuid):
+            self._sync_with_server(uep, uuid)
+            self.validators = {'uuid': uuid, 'checked': time.time()}
+            return True
+
+        conn = getattr(uep, 'conn', None)
+        if self.STATUS_PATH is None or BaseRestLib is None or \
+                not isinstance(conn, BaseRestLib):
+            self._sync_with_server(uep, uuid)
+            self.validators = {'uuid': uuid, 'checked': time.time()}
+            return True
+
+        handler = self.STATUS_PATH % uep.sanitize(uuid)
+        validators = self._read_validators(uuid)
+        headers = {}
+        if self._cache_exists():
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        result = _raw_get(conn, handler, headers)
+        if str(result['status']) == "304":
+            if self._read_cache() is not None:
+                validators['checked'] = time.time()
+                self.validators = validators
+                return False
+            log.debug("Cache %s is gone, asking again" % self.CACHE_FILE)
+            result = _raw_get(conn, handler, {})
+
+        response = None
+        if result['content']:
+            response = json.loads(result['content'])
+            self._keep(uuid, response)
+        self._set_status(response)
+
+        response_headers = result.get('headers') or {}
+        self.validators = {'uuid': uuid,
+                           'checked': time.time(),
+                           'etag': response_headers.get('etag'),
+                           'last_modified': response_headers.get('last-modified')}
+        return True
 
     def load_status(self, uep, uuid):
         """
         Load status from wherever is appropriate.
 
-        If server is reachable, return it's response
-        and cache the results to disk.
+        If the cache is within its TTL, return it. Otherwise if server is
+        reachable, return it's response and cache the results to disk.
 
         If the server is not reachable, return the latest cache if
         it is still reasonable to use it.
 
         Returns None if we cannot reach the server, or use the cache.
         """
+        fresh_status = self._fresh_status(uuid)
+        if fresh_status is not None:
+            log.debug("Using cache within its TTL: %s" % self.CACHE_FILE)
+            self.last_error = False
+            return fresh_status
+
         try:
-            self._sync_with_server(uep, uuid)
-            self.write_cache()
+            if self._sync(uep, uuid):
+                self.write_cache()
+            else:
+                log.debug("Server status not modified, using cache: %s" %
+                          self.CACHE_FILE)
+                self._write_validators()
             self.last_error = False
             return self.server_status
         except SSL.SSLError, ex:
@@ -264,18 +598,26 @@ class StatusCache(CacheManager):
 
     def write_cache(self):
         """
-        This is threaded because it should never block in runtime.
+        This is queued because it should never block in runtime.
         Writing to disk means it will be read from memory for the rest of this run.
         """
-        threading.Thread(target=super(StatusCache, self).write_cache,
-                         args=[True],
-                         name="WriteCache%sThread" % self.__class__.__name__).start()
-        log.debug("Started thread to write cache: %s" % self.CACHE_FILE)
+        persistence_queue.put(self.CACHE_FILE, self._write_cache_and_validators)
+        log.debug("Queued write of cache: %s" % self.CACHE_FILE)
+
+    def _write_cache_and_validators(self):
+        # The validators go last, so they never describe an older cache.
+        super(StatusCache, self).write_cache(False)
+        self._write_validators()
 
     # we override a @classmethod with an instance method in the sub class?
     def delete_cache(self):
+        persistence_queue.discard(self.CACHE_FILE)
         super(StatusCache, self).delete_cache()
+        validators_file = self._get_validators_file()
+        if os.path.exists(validators_file):
+            os.remove(validators_file)
         self.server_status = None
+        self.validators = None
 
 
 class EntitlementStatusCache(StatusCache):
@@ -285,9 +627,17 @@ class EntitlementStatusCache(StatusCache):
     than sending it.
     """
     CACHE_FILE = "/var/lib/rhsm/cache/entitlement_status.json"
+    STATUS_PATH = "/consumers/%s/compliance"
+    TTL_OPTION = "entitlement_status_cache_ttl"
+
+    def _is_kept(self, uuid):
+        return get_consumer_cache().has_compliance(uuid)
+
+    def _keep(self, uuid, response):
+        get_consumer_cache().keep_compliance(uuid, response)
 
     def _sync_with_server(self, uep, uuid):
-        self.server_status = uep.getCompliance(uuid)
+        self.server_status = get_consumer_cache().get_compliance(uep, uuid)
 
 
 class ProductStatusCache(StatusCache):
@@ -295,11 +645,20 @@ class ProductStatusCache(StatusCache):
     Manages the system cache of installed product valid date ranges.
     """
     CACHE_FILE = "/var/lib/rhsm/cache/product_status.json"
+    STATUS_PATH = "/consumers/%s"
+    TTL_OPTION = "product_status_cache_ttl"
+
+    def _is_kept(self, uuid):
+        return get_consumer_cache().has_consumer(uuid)
+
+    def _keep(self, uuid, response):
+        get_consumer_cache().keep_consumer(uuid, response)
 
     def _sync_with_server(self, uep, uuid):
-        consumer_data = uep.getConsumer(uuid)
+        self._set_status(get_consumer_cache().get_consumer(uep, uuid))
 
-        if 'installedProducts' not in consumer_data:
+    def _set_status(self, consumer_data):
+        if not consumer_data or 'installedProducts' not in consumer_data:
             log.warn("Server does not support product date ranges.")
         else:
             self.server_status = consumer_data['installedProducts']
@@ -310,6 +669,8 @@ class OverrideStatusCache(StatusCache):
     Manages the cache of yum repo overrides set on the server.
     """
     CACHE_FILE = "/var/lib/rhsm/cache/content_overrides.json"
+    STATUS_PATH = "/consumers/%s/content_overrides"
+    TTL_OPTION = "override_status_cache_ttl"
 
     def _sync_with_server(self, uep, consumer_uuid):
         self.server_status = uep.getContentOverrides(consumer_uuid)
@@ -320,6 +681,8 @@ class ReleaseStatusCache(StatusCache):
     Manages the cache of the consumers 'release' setting applied to yum repos.
     """
     CACHE_FILE = "/var/lib/rhsm/cache/releasever.json"
+    STATUS_PATH = "/consumers/%s/release"
+    TTL_OPTION = "release_status_cache_ttl"
 
     def _sync_with_server(self, uep, consumer_uuid):
         def get_release(uuid):
@@ -334,18 +697,45 @@ class ReleaseStatusCache(StatusCache):
     # we are yum specific, and not triggered till late.
 
 
+def _digest_field(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def profile_digest(profile):
+    """
+    Return a digest of the packages in profile, that does not depend on
+    their order.
+    """
+    lines = sorted("\0".join([_digest_field(pkg.name), _digest_field(pkg.epoch),
+                              _digest_field(pkg.version), _digest_field(pkg.release),
+                              _digest_field(pkg.arch), _digest_field(pkg.vendor)])
+                   for pkg in profile.packages)
+    return hashlib.sha256("\n".join(lines)).hexdigest()
+
+
 # this is injected normally
 class ProfileManager(CacheManager):
     """
     Manages the profile of packages installed on this system.
+
+    Next to the cache, the digest of the cached profile and the signature
+    of the rpmdb it was collected from are kept. While the rpmdb signature
+    is the same, the packages have not changed and the rpmdb is not read.
+    Otherwise the digest of the current profile is compared, rather than
+    loading the cached profile.
     """
-    CACHE_FILE = "/var/lib/rhsm/packages/packages.json"
+    CACHE_FILE = "/var/lib/rhsm/packages/packages.cache"
+    CACHE_FORMAT = cacheformat.COMPACT
 
     def __init__(self, current_profile=None):
 
         # Could be None, we'll read the system's current profile later once
         # we're sure we actually need the data.
         self._current_profile = current_profile
+        # rpmdb signature from before the current profile was read from it
+        self._rpmdb = None
         self._report_package_profile = cfg.get_int('rhsm', 'report_package_profile')
 
     # give tests a chance to use something other than RPMProfile
@@ -355,11 +745,15 @@ class ProfileManager(CacheManager):
     def _get_current_profile(self):
         # If we weren't given a profile, load the current systems packages:
         if not self._current_profile:
+            # Taken first, so packages changed while the profile is read
+            # give a different signature next time.
+            self._rpmdb = rpmdb_signature()
             self._current_profile = self._get_profile('rpm')
         return self._current_profile
 
     def _set_current_profile(self, value):
         self._current_profile = value
+        self._rpmdb = None
 
     def _set_report_package_profile(self, value):
         self._report_package_profile = value
@@ -372,6 +766,18 @@ class ProfileManager(CacheManager):
     def _load_data(self, open_file):
         return RPMProfile(from_file=open_file)
 
+    def _load_compact_data(self, data):
+        # RPMProfile can only be built from a JSON file or the rpmdb
+        profile = RPMProfile.__new__(RPMProfile)
+        profile.packages = [Package(name=pkg_dict['name'],
+                                    version=pkg_dict['version'],
+                                    release=pkg_dict['release'],
+                                    arch=pkg_dict['arch'],
+                                    epoch=pkg_dict['epoch'],
+                                    vendor=pkg_dict['vendor'])
+                            for pkg_dict in data]
+        return profile
+
     def update_check(self, uep, consumer_uuid, force=False):
         """
         Check if packages have changed, and push an update if so.
@@ -393,8 +799,63 @@ class ProfileManager(CacheManager):
             log.debug("Cache does not exist")
             return True
 
-        cached_profile = self._read_cache()
-        return not cached_profile == self.current_profile
+        stored = self._read_digest()
+        if not self._current_profile and stored.get('rpmdb') is not None and \
+                stored['rpmdb'] == rpmdb_signature():
+            log.debug("rpmdb has not changed since the cache was written")
+            return False
+
+        digest = profile_digest(self.current_profile)
+        if stored.get('digest'):
+            changed = stored['digest'] != digest
+        else:
+            # Written before digests were kept
+            cached_profile = self._read_cache()
+            changed = not cached_profile == self.current_profile
+
+        if not changed and (stored.get('digest') != digest or
+                            (self._rpmdb is not None and stored.get('rpmdb') != self._rpmdb)):
+            self._write_digest(digest)
+        return changed
+
+    @staticmethod
+    def _digest_file(cache_file):
+        return "%s_digest.json" % os.path.splitext(cache_file)[0]
+
+    def _read_digest(self):
+        """
+        Return the digest and rpmdb signature stored for the cached
+        profile, or an empty dict.
+        """
+        try:
+            f = open(self._digest_file(self.CACHE_FILE))
+            try:
+                stored = json.loads(f.read())
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(stored, dict):
+            return {}
+        return stored
+
+    def _write_digest(self, digest):
+        try:
+            write_file_atomic(self._digest_file(self.CACHE_FILE),
+                              json.dumps({'digest': digest, 'rpmdb': self._rpmdb}))
+        except (IOError, OSError), e:
+            log.debug("Unable to write package profile digest: %s" % e)
+
+    def write_cache(self, debug=True):
+        super(ProfileManager, self).write_cache(debug)
+        self._write_digest(profile_digest(self.current_profile))
+
+    @classmethod
+    def delete_cache(cls):
+        super(ProfileManager, cls).delete_cache()
+        digest_file = cls._digest_file(cls.CACHE_FILE)
+        if os.path.exists(digest_file):
+            os.remove(digest_file)
 
     def _sync_with_server(self, uep, consumer_uuid):
         uep.updatePackageProfile(consumer_uuid,
@@ -489,7 +950,7 @@ class InstalledProductsManager(CacheManager):
         return final
 
     def _sync_with_server(self, uep, consumer_uuid):
-        uep.updateConsumer(consumer_uuid,
+        get_consumer_cache().update_consumer(uep, consumer_uuid,
                 installed_products=self.format_for_server(),
                 content_tags=self.tags)
 
@@ -544,6 +1005,120 @@ class PoolTypeCache(object):
         self.pooltype_map = {}
 
 
+class ConsumerCache(object):
+    """
+    Coalesces fetches of the consumer and its compliance from the server.
+
+    Responses are only kept while a run is in progress, between begin()
+    and end(), so an action client update that needs the consumer in
+    several places fetches it once. Outside of a run, every call goes to
+    the server. Writes through update_consumer, and invalidate(), drop
+    what was kept for the consumer.
+    """
+
+    def __init__(self):
+        self._runs = 0
+        # uuid -> consumer
+        self._consumers = {}
+        # (uuid, on_date) -> compliance
+        self._compliance = {}
+        # Held while fetching, so concurrent callers wait for one request
+        self._lock = threading.RLock()
+
+    def begin(self):
+        self._lock.acquire()
+        try:
+            self._runs += 1
+        finally:
+            self._lock.release()
+
+    def end(self):
+        self._lock.acquire()
+        try:
+            self._runs -= 1
+            if not self._runs:
+                self.invalidate()
+        finally:
+            self._lock.release()
+
+    def _get(self, kept, key, fetch, *args):
+        if not self._runs:
+            return fetch(*args)
+        self._lock.acquire()
+        try:
+            if key not in kept:
+                kept[key] = fetch(*args)
+            return kept[key]
+        finally:
+            self._lock.release()
+
+    def _keep(self, kept, key, value):
+        self._lock.acquire()
+        try:
+            if self._runs:
+                kept[key] = value
+        finally:
+            self._lock.release()
+
+    def has_consumer(self, uuid):
+        """True if the consumer with uuid was fetched during this run."""
+        return bool(self._runs) and uuid in self._consumers
+
+    def has_compliance(self, uuid, on_date=None):
+        """True if the compliance of uuid was fetched during this run."""
+        return bool(self._runs) and (uuid, on_date) in self._compliance
+
+    def keep_consumer(self, uuid, consumer):
+        """Keep a consumer fetched some other way for the rest of the run."""
+        self._keep(self._consumers, uuid, consumer)
+
+    def keep_compliance(self, uuid, compliance, on_date=None):
+        """Keep a compliance fetched some other way for the rest of the run."""
+        self._keep(self._compliance, (uuid, on_date), compliance)
+
+    def get_consumer(self, uep, uuid):
+        return self._get(self._consumers, uuid, uep.getConsumer, uuid)
+
+    def get_compliance(self, uep, uuid, on_date=None):
+        if on_date is None:
+            return self._get(self._compliance, (uuid, None), uep.getCompliance, uuid)
+        return self._get(self._compliance, (uuid, on_date), uep.getCompliance,
+                         uuid, on_date)
+
+    def update_consumer(self, uep, uuid, **kwargs):
+        try:
+            return uep.updateConsumer(uuid, **kwargs)
+        finally:
+            self.invalidate(uuid)
+
+    def invalidate(self, uuid=None):
+        """
+        Drop what is kept for the consumer with uuid, or for all consumers.
+        """
+        self._lock.acquire()
+        try:
+            if uuid is None:
+                self._consumers.clear()
+                self._compliance.clear()
+                return
+            self._consumers.pop(uuid, None)
+            for key in [key for key in self._compliance if key[0] == uuid]:
+                del self._compliance[key]
+        finally:
+            self._lock.release()
+
+
+def get_consumer_cache():
+    """
+    Return the injected ConsumerCache. A yum plugin can run with an older
+    injection setup, in which case every call goes to the server.
+    """
+    try:
+        return inj.require(inj.CONSUMER_CACHE)
+    except KeyError:
+        return ConsumerCache()
+
+
 class WrittenOverrideCache(CacheManager):
     '''
     Cache to keep track of the overrides used last time the a redhat.repo
@@ -569,3 +1144,47 @@ class WrittenOverrideCache(CacheManager):
             # ignore json file parse errors, we are going to generate
             # a new as if it didn't exist
             pass
+
+
+class RepoFingerprintCache(CacheManager):
+    '''
+    Cache of the fingerprint of what redhat.repo was last generated
+    from, and of the redhat.repo file that was written.
+    '''
+
+    CACHE_FILE = "/var/lib/rhsm/cache/repo_fingerprint.json"
+
+    def __init__(self):
+        self.fingerprint = None
+        self._loaded = False
+
+    def to_dict(self):
+        return {'fingerprint': self.fingerprint}
+
+    def _load_data(self, open_file):
+        return json.loads(open_file.read())
+
+    def read(self):
+        """Return the last written fingerprint, or None."""
+        if not self._loaded:
+            self._loaded = True
+            data = None
+            if self._cache_exists():
+                data = self._read_cache()
+            if data:
+                self.fingerprint = data.get('fingerprint')
+        return self.fingerprint
+
+    def write(self, fingerprint):
+        self._loaded = True
+        self.fingerprint = fingerprint
+        try:
+            self.write_cache(debug=False)
+        except OSError, e:
+            # Most likely not running as root, without a fingerprint the
+            # repos are just regenerated every time.
+            log.debug("Unable to write repo fingerprint %s: %s" % (self.CACHE_FILE, e))
+
+    def delete_cache(self):
+        super(RepoFingerprintCache, self).delete_cache()
+        self.fingerprint = None
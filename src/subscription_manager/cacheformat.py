@@ -0,0 +1,101 @@
+#
+# Copyright (c) 2015 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+"""
+Compact binary format for the on disk caches.
+
+Large caches, like the package profile, are read on every run just to
+see if anything changed. Parsing them as JSON is a good part of that.
+
+A compact cache is a header followed by the marshalled data. The header
+holds a magic string, the format version, the major version of the
+python that wrote it, and the length and CRC32 of the data. A cache
+written with another format version or python, or that does not match
+its length or checksum, fails to load with CacheFormatError. The magic
+can not start a JSON document, so the format of a cache file can be
+told from its first bytes, and JSON caches written before keep working.
+
+The cache files are only written by root, marshal is not safe to load
+from files anyone else could write.
+"""
+
+import marshal
+import struct
+import sys
+import zlib
+
+# Values for CacheManager.CACHE_FORMAT
+JSON = "json"
+COMPACT = "compact"
+
+MAGIC = "\x93RHC"
+
+# Bump this whenever the layout of compact caches changes.
+FORMAT_VERSION = 1
+
+# magic, format version, python major version, data length, data crc32
+HEADER = struct.Struct(">4sBBII")
+
+# marshal format written, 2 is the newest python 2 can write
+MARSHAL_VERSION = 2
+
+
+class CacheFormatError(ValueError):
+    """Raised when a compact cache can not be loaded."""
+    pass
+
+
+def is_compact(open_file):
+    """
+    True if the file is a compact cache. Leaves the file at its start.
+    """
+    magic = open_file.read(len(MAGIC))
+    open_file.seek(0)
+    return magic == MAGIC
+
+
+def dumps(data):
+    """
+    Return data in the compact format. Raises ValueError if data holds
+    a value marshal can not store.
+    """
+    payload = marshal.dumps(data, MARSHAL_VERSION)
+    return HEADER.pack(MAGIC, FORMAT_VERSION, sys.version_info[0],
+                       len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def loads(buf):
+    """
+    Return the data of a compact cache.
+    """
+    if len(buf) < HEADER.size:
+        raise CacheFormatError("Truncated cache header")
+    magic, version, python, length, checksum = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise CacheFormatError("Not a compact cache")
+    if version != FORMAT_VERSION or python != sys.version_info[0]:
+        raise CacheFormatError("Compact cache version %s for python %s" %
+                               (version, python))
+    payload = buf[HEADER.size:]
+    if len(payload) != length or zlib.crc32(payload) & 0xffffffff != checksum:
+        raise CacheFormatError("Corrupt compact cache")
+    try:
+        return marshal.loads(payload)
+    except (EOFError, TypeError), e:
+        raise CacheFormatError(e)
+
+
+def load(open_file):
+    return loads(open_file.read())
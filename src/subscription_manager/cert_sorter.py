@@ -20,6 +20,7 @@ import logging
 from rhsm.certificate import GMT
 from rhsm.connection import RestlibException
 import subscription_manager.injection as inj
+from subscription_manager.cache import get_consumer_cache
 from subscription_manager.isodate import parse_date
 from subscription_manager.reasons import Reasons
 from subscription_manager import file_monitor
@@ -54,6 +55,31 @@ RHSM_PARTIALLY_VALID = 4
 RHSM_REGISTRATION_REQUIRED = 5
 
 
+class EntitlementCertBuckets(object):
+    """
+    Sorts entitlement certs by their validity on a date (now by default),
+    looking at each cert once.
+
+    valid: certs valid on the date.
+    future: certs that only start after the date.
+    expired: certs that ended before the date.
+    """
+
+    def __init__(self, ent_certs, on_date=None):
+        self.on_date = on_date or datetime.now(GMT())
+        self.valid = []
+        self.future = []
+        self.expired = []
+
+        for ent_cert in ent_certs:
+            if ent_cert.valid_range.begin() > self.on_date:
+                self.future.append(ent_cert)
+            elif ent_cert.valid_range.end() < self.on_date:
+                self.expired.append(ent_cert)
+            else:
+                self.valid.append(ent_cert)
+
+
 class ComplianceManager(object):
 
     def __init__(self, on_date=None):
@@ -106,14 +132,18 @@ class ComplianceManager(object):
 
         self.system_status = 'unknown'
 
-        self.valid_entitlement_certs = []
+        # Entitlement certs sorted by their validity today, filled in
+        # by _scan_entitlement_certs:
+        self.entitlement_buckets = EntitlementCertBuckets([])
+        self.valid_entitlement_certs = self.entitlement_buckets.valid
 
         self._parse_server_status()
 
     def get_compliance_status(self):
         # Defaults to now
         try:
-            return self.cp_provider.get_consumer_auth_cp().getCompliance(self.identity.uuid, self.on_date)
+            return get_consumer_cache().get_compliance(
+                self.cp_provider.get_consumer_auth_cp(), self.identity.uuid, self.on_date)
         except Exception, e:
             log.warn("Failed to get compliance data from the server")
             log.exception(e)
@@ -211,38 +241,28 @@ class ComplianceManager(object):
         Scan entitlement certs looking for unentitled products which may
         have expired, or be entitled in future.
 
-        Also builds up a list of valid certs today. (used when determining
-        if anything is in it's warning period)
+        Also sorts the certs into self.entitlement_buckets, which gives the
+        list of valid certs today. (used when determining if anything is in
+        it's warning period)
         """
         # Subtract out the valid and partially valid items from the
         # list of installed products
-        unknown_products = dict((k, v) for (k, v) in self.installed_products.items() if
-                                k not in self.valid_products.keys() and
-                                k not in self.partially_valid_products.keys())
-        ent_certs = self.entitlement_dir.list()
-
-        on_date = datetime.now(GMT())
-        for ent_cert in ent_certs:
-
-            # Builds the list of valid entitlement certs today:
-            if ent_cert.is_valid():
-                self.valid_entitlement_certs.append(ent_cert)
-
-            for product in ent_cert.products:
-                if product.id in unknown_products.keys():
-                    # If the entitlement starts after the date we're checking, we
-                    # consider this a future entitlement. Technically it could be
-                    # partially stacked on that date, but we cannot determine that
-                    # without recursively cert sorting again on that date.
-                    if ent_cert.valid_range.begin() > on_date:
-                        product_dict = self.future_products
-                    # Check if entitlement has already expired:
-                    elif ent_cert.valid_range.end() < on_date:
-                        product_dict = self.expired_products
-                    else:
-                        continue
-
-                    product_dict.setdefault(product.id, []).append(ent_cert)
+        unknown_pids = set(self.installed_products) - \
+            set(self.valid_products) - set(self.partially_valid_products)
+
+        self.entitlement_buckets = EntitlementCertBuckets(self.entitlement_dir.list())
+        self.valid_entitlement_certs = self.entitlement_buckets.valid
+
+        # If the entitlement starts after the date we're checking, we
+        # consider this a future entitlement. Technically it could be
+        # partially stacked on that date, but we cannot determine that
+        # without recursively cert sorting again on that date.
+        for (certs, product_dict) in [(self.entitlement_buckets.future, self.future_products),
+                                      (self.entitlement_buckets.expired, self.expired_products)]:
+            for ent_cert in certs:
+                for product in ent_cert.products:
+                    if product.id in unknown_pids:
+                        product_dict.setdefault(product.id, []).append(ent_cert)
 
     def get_system_status(self):
         return STATUS_MAP.get(self.system_status, STATUS_MAP['unknown'])
@@ -325,18 +345,38 @@ class CertSorter(ComplianceManager):
         super(CertSorter, self).__init__()
         self.callbacks = set()
 
-        cert_dir_monitors = [file_monitor.MonitorDirectory(inj.require(inj.PROD_DIR).path,
-                                                           self.on_prod_dir_changed),
-                             file_monitor.MonitorDirectory(inj.require(inj.ENT_DIR).path,
-                                                           self.on_ent_dir_changed),
-                             file_monitor.MonitorDirectory(inj.require(inj.IDENTITY).cert_dir_path,
-                                                           self.on_identity_changed)]
-
-        # Note: no timer is setup to poll file_monitor by cert_sorter itself,
-        # the gui can add one.
+        # Note: no timer or io watch is setup to run file_monitor by
+        # cert_sorter itself, the gui can add one. Until something registers
+        # a callback, the cert dirs are only polled when force_cert_check()
+        # is called, so the cli, yum plugin and rhsmd don't hold inotify fds
+        # nobody reads.
+        self.cert_monitor = self._create_cert_monitor(file_monitor.MonitorDirectory)
+        self._watching = False
+
+    def _create_cert_monitor(self, create_monitor):
+        cert_dir_monitors = [create_monitor(inj.require(inj.PROD_DIR).path,
+                                            self.on_prod_dir_changed),
+                             create_monitor(inj.require(inj.ENT_DIR).path,
+                                            self.on_ent_dir_changed),
+                             create_monitor(inj.require(inj.IDENTITY).cert_dir_path,
+                                            self.on_identity_changed)]
+        return file_monitor.MonitorDirectories(dir_monitors=cert_dir_monitors,
+                                               changed_callback=self.on_certs_changed)
+
+    def _start_watching(self):
+        if self._watching:
+            return
+        self.cert_monitor.close()
         self.cert_monitor = \
-            file_monitor.MonitorDirectories(dir_monitors=cert_dir_monitors,
-                                            changed_callback=self.on_certs_changed)
+            self._create_cert_monitor(file_monitor.create_monitor_directory)
+        self._watching = True
+
+    def _stop_watching(self):
+        if not self._watching:
+            return
+        self.cert_monitor.close()
+        self.cert_monitor = self._create_cert_monitor(file_monitor.MonitorDirectory)
+        self._watching = False
 
     def get_compliance_status(self):
         status_cache = inj.require(inj.ENTITLEMENT_STATUS_CACHE)
@@ -362,13 +402,20 @@ class CertSorter(ComplianceManager):
 
     def add_callback(self, cb):
         self.callbacks.add(cb)
+        self._start_watching()
 
     def remove_callback(self, cb):
         try:
             self.callbacks.remove(cb)
-            return True
         except KeyError:
             return False
+        if not self.callbacks:
+            self._stop_watching()
+        return True
+
+    def close(self):
+        self.callbacks.clear()
+        self._stop_watching()
 
     def on_change(self):
         self.load()
@@ -378,14 +425,16 @@ class CertSorter(ComplianceManager):
         # Now that local data has been refreshed, updated compliance
         self.on_change()
 
-    def on_prod_dir_changed(self):
-        self.product_dir.refresh()
+    def on_prod_dir_changed(self, changes=None):
+        log.debug("Product directory changed: %s" % changes)
+        self.product_dir.refresh(changes)
         self.update_product_manager()
 
-    def on_ent_dir_changed(self):
-        self.entitlement_dir.refresh()
+    def on_ent_dir_changed(self, changes=None):
+        log.debug("Entitlement directory changed: %s" % changes)
+        self.entitlement_dir.refresh(changes)
 
-    def on_identity_changed(self):
+    def on_identity_changed(self, changes=None):
         self.identity.reload()
         self.cp_provider.clean()
 
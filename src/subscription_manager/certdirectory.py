@@ -18,6 +18,9 @@
 import gettext
 import logging
 import os
+import shutil
+import stat
+import tempfile
 
 from rhsm.certificate import Key, create_from_file
 from rhsm.config import initConfig
@@ -97,31 +100,162 @@ class Directory(object):
         return self.path
 
 
+class CertificateListingIndex(object):
+    """
+    Lookup tables over one certificate listing.
+
+    Each table is built on first use with a single pass over the listing,
+    so repeated lookups by serial, product id or stacking id cost a dict
+    access instead of a scan of every certificate.
+    """
+
+    def __init__(self, listing):
+        self.listing = listing
+        self._size = len(listing)
+        self._by_serial = None
+        self._by_product = None
+        self._by_stacking_id = None
+
+    def is_current(self, listing):
+        # Stub directories append to their listing in place, so the
+        # size is checked as well as the identity.
+        return listing is self.listing and len(listing) == self._size
+
+    @property
+    def by_serial(self):
+        if self._by_serial is None:
+            self._by_serial = {}
+            for c in self.listing:
+                # first certificate wins, as it did for a scan
+                self._by_serial.setdefault(c.serial, c)
+        return self._by_serial
+
+    @property
+    def by_product(self):
+        """Maps product id to the certificates providing it, in listing order."""
+        if self._by_product is None:
+            self._by_product = {}
+            for c in self.listing:
+                for p in c.products:
+                    self._by_product.setdefault(p.id, []).append(c)
+        return self._by_product
+
+    @property
+    def by_stacking_id(self):
+        if self._by_stacking_id is None:
+            self._by_stacking_id = {}
+            for c in self.listing:
+                if (c.order and c.order.stacking_id):
+                    self._by_stacking_id.setdefault(c.order.stacking_id, set()).add(c)
+        return self._by_stacking_id
+
+
 class CertificateDirectory(Directory):
 
     KEY = 'key.pem'
 
+    # Rebuilt whenever list() returns a different listing.
+    _listing_index = None
+    _listing = None
+
     def __init__(self, path):
         super(CertificateDirectory, self).__init__(path)
         self.create()
         self._listing = None
+        self._index = None
 
-    def refresh(self):
-        # simply clear the cache. the next list() will reload.
-        self._listing = None
+    def refresh(self, changes=None):
+        """
+        Drop the cached listing so the next list() rescans the directory.
+        Certificates whose files did not change are reused, not reloaded.
+
+        If changes (a file_monitor.DirectoryChanges) is given, the listing
+        is updated for just the files it names instead.
+        """
+        if changes is None or changes.full_rescan or self._listing is None:
+            self._listing = None
+            return
+
+        index = self._get_index()
+        changed = changes.created | changes.modified | changes.deleted
+        listing = [c for c in self._listing
+                   if os.path.basename(c.path) not in changed]
+        for fn in changed:
+            if not self._is_cert_file(fn):
+                continue
+            path = self.abspath(fn)
+            if fn in changes.deleted or not os.path.exists(path):
+                index.discard(path)
+                continue
+            listing.append(index.get(path, create_from_file))
+        index.save(prune=False)
+        self._listing = listing
+
+    def add_cert(self, cert):
+        """
+        Add a certificate just written into this directory to the listing,
+        replacing any certificate previously listed for the same file.
+
+        The index is not written, call save_index() once the batch of
+        certificates being written is done.
+        """
+        index = self._get_index()
+        index.add(cert.path, cert)
+        if self._listing is not None:
+            self._listing = [c for c in self._listing if c.path != cert.path]
+            self._listing.append(cert)
+
+    def save_index(self):
+        """Write the certificate index if add_cert() changed it."""
+        self._get_index().save(prune=False)
+
+    def _is_cert_file(self, fn):
+        return fn.endswith('.pem') and not fn.endswith(self.KEY)
+
+    def signature(self):
+        """
+        Return a signature of the files in the directory that changes
+        whenever a certificate or key is added, removed or rewritten.
+        Only stats the files, nothing is parsed.
+        """
+        signature = []
+        for p, fn in self.list_all():
+            try:
+                st = os.stat(self.abspath(fn))
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                continue
+            signature.append([fn, st.st_size, st.st_mtime, st.st_ino])
+        return sorted(signature)
+
+    def _get_index(self):
+        if self._index is None:
+            # to avoid circular imports (certindex -> cache -> utils)
+            from subscription_manager.certindex import CertificateIndex
+            self._index = CertificateIndex(self.path)
+        return self._index
 
     def list(self):
         if self._listing is not None:
             return self._listing
+        index = self._get_index()
         listing = []
         for p, fn in Directory.list(self):
-            if not fn.endswith('.pem') or fn.endswith(self.KEY):
+            if not self._is_cert_file(fn):
                 continue
             path = self.abspath(fn)
-            listing.append(create_from_file(path))
+            listing.append(index.get(path, create_from_file))
+        index.save()
         self._listing = listing
         return listing
 
+    def _get_listing_index(self):
+        listing = self.list()
+        if self._listing_index is None or not self._listing_index.is_current(listing):
+            self._listing_index = CertificateListingIndex(listing)
+        return self._listing_index
+
     def list_valid(self):
         valid = []
         for c in self.list():
@@ -138,43 +272,26 @@ class CertificateDirectory(Directory):
 
     def find(self, sn):
         # TODO: could optimize to just load SERIAL.pem? Maybe not in all cases.
-        for c in self.list():
-            if c.serial == sn:
-                return c
-        return None
+        return self._get_listing_index().by_serial.get(sn)
 
     def find_all_by_product(self, p_hash):
-        certs = set()
-        providing_stack_ids = set()
-        stack_id_map = {}
+        listing_index = self._get_listing_index()
+        certs = set(listing_index.by_product.get(p_hash, []))
 
-        # Note this will override a product cert for id '71' with
-        # a different product cert for id '71' if it is later in self.list
-        for c in self.list():
-            for p in c.products:
-                if p.id == p_hash:
-                    certs.add(c)
-                    # Keep track of stacks that provide our product
-                    if (c.order and c.order.stacking_id):
-                        providing_stack_ids.add(c.order.stacking_id)
-
-            # Keep track of stack ids in case we need them later.  avoids another loop
+        # Complete with all the certs of any stack providing our product
+        providing_stack_ids = set()
+        for c in certs:
             if (c.order and c.order.stacking_id):
-                if c.order.stacking_id not in stack_id_map:
-                    stack_id_map[c.order.stacking_id] = set()
-                stack_id_map[c.order.stacking_id].add(c)
-
-        # Complete
+                providing_stack_ids.add(c.order.stacking_id)
         for stack_id in providing_stack_ids:
-            certs |= stack_id_map[stack_id]
+            certs |= listing_index.by_stacking_id[stack_id]
 
         return list(certs)
 
     def find_by_product(self, p_hash):
-        for c in self.list():
-            for p in c.products:
-                if p.id == p_hash:
-                    return c
+        certs = self._get_listing_index().by_product.get(p_hash)
+        if certs:
+            return certs[0]
         return None
 
     #Set up an alias for backwards compatibility
@@ -223,19 +340,42 @@ class ProductDirectory(ProductCertificateDirectory):
         default_prod_path = default_path or DEFAULT_PRODUCT_CERT_DIR
         self.installed_prod_dir = ProductCertificateDirectory(path=installed_prod_path)
         self.default_prod_dir = ProductCertificateDirectory(path=default_prod_path)
+        self._listing = None
+        self._listing_sources = (None, None)
 
     def list(self):
         installed_prod_list = self.installed_prod_dir.list()
         default_prod_list = self.default_prod_dir.list()
 
+        # Keep returning the same merged listing until either directory
+        # is refreshed, so lookups can reuse their index.
+        installed_source, default_source = self._listing_sources
+        if self._listing is not None and installed_source is installed_prod_list \
+                and default_source is default_prod_list:
+            return self._listing
+
         # Product IDs in installed_prod dir.
         pids = set([cert.products[0].id for cert in installed_prod_list])
         # Everything from /etc/pki/product, only use product-default for pids that don't already exist
-        return installed_prod_list + filter(lambda l: l.products[0].id not in pids, default_prod_list)
+        self._listing = installed_prod_list + filter(lambda l: l.products[0].id not in pids, default_prod_list)
+        self._listing_sources = (installed_prod_list, default_prod_list)
+        return self._listing
+
+    def refresh(self, changes=None):
+        # changes are reported for the installed (writable) directory
+        self.installed_prod_dir.refresh(changes)
+        if changes is None:
+            self.default_prod_dir.refresh()
 
-    def refresh(self):
-        self.installed_prod_dir.refresh()
-        self.default_prod_dir.refresh()
+    def add_cert(self, cert):
+        self.installed_prod_dir.add_cert(cert)
+
+    def save_index(self):
+        self.installed_prod_dir.save_index()
+
+    def signature(self):
+        return [self.installed_prod_dir.signature(),
+                self.default_prod_dir.signature()]
 
     # In productid.py, ProductDirectory.path is used as path to write new certs
     # to. Souse  the installed_prod_dir (/etc/pki/product) as that is
@@ -307,12 +447,7 @@ class EntitlementDirectory(CertificateDirectory):
         Returns all entitlement certificates providing access to the given
         product ID.
         """
-        entitlements = []
-        for cert in self.list():
-            for cert_product in cert.products:
-                if product_id == cert_product.id:
-                    entitlements.append(cert)
-        return entitlements
+        return list(self._get_listing_index().by_product.get(product_id, []))
 
 
 class Path:
@@ -340,18 +475,142 @@ class Path:
 
 
 class Writer:
+    """
+    Write entitlement cert/key pairs into the entitlement directory.
+
+    Pairs are first written to a staging directory inside the entitlement
+    directory, so they are on the same filesystem, and then renamed into
+    place, key before cert. Readers never see a partly written file, or a
+    cert without its key.
+
+    write() on its own installs a single pair. Between begin() and
+    commit(), write() only stages the pair, and commit() moves all staged
+    pairs into place with one fsync of the directory for the whole batch.
+    Each staged file is fsynced when it is written, before anything is
+    renamed. If the cert of a pair can not be moved into place, its key is
+    put back the way it was.
+
+    Staging directories left behind by a process that died mid batch are
+    removed by the next batch. Entitlement certs are only written while
+    holding the rhsm lock, so there is only ever one writer.
+    """
+
+    STAGING_PREFIX = '.staging-'
 
     def __init__(self):
         self.ent_dir = require(ENT_DIR)
+        self._batch = False
+        self._staging_dir = None
+        self._staged = []
+
+    def begin(self):
+        """Stage the pairs given to write() until commit() is called."""
+        self._remove_stale_staging()
+        self._batch = True
 
     def write(self, key, cert):
-        serial = cert.serial
+        if self._batch:
+            self._stage(key, cert)
+            return
+
+        self._remove_stale_staging()
+        self._stage(key, cert)
+        failed = self.commit()
+        if failed:
+            raise failed[0][1]
+
+    def _remove_stale_staging(self):
+        if self._staging_dir is not None:
+            return
+        ent_dir_path = Path.abs(self.ent_dir.productpath())
+        try:
+            names = os.listdir(ent_dir_path)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(self.STAGING_PREFIX):
+                log.debug("Removing stale staging directory: %s" % name)
+                shutil.rmtree(os.path.join(ent_dir_path, name), ignore_errors=True)
+
+    def _stage(self, key, cert):
+        # to avoid circular imports (utils -> certdirectory)
+        from subscription_manager.utils import write_temp_file
         ent_dir_path = self.ent_dir.productpath()
+        if self._staging_dir is None:
+            self._staging_dir = tempfile.mkdtemp(prefix=self.STAGING_PREFIX,
+                                                 dir=Path.abs(ent_dir_path))
+        serial = str(cert.serial)
+        key_path = Path.join(ent_dir_path, '%s-key.pem' % serial)
+        cert_path = Path.join(ent_dir_path, '%s.pem' % serial)
+        key_tmp = write_temp_file(key_path, key.content, mode=0600,
+                                  dir=self._staging_dir, fsync=True)
+        cert_tmp = write_temp_file(cert_path, cert.pem or cert.x509.as_pem(),
+                                   mode=0644, dir=self._staging_dir, fsync=True)
+        self._staged.append((key, key_tmp, cert, cert_tmp))
+
+    def commit(self):
+        """
+        Move the staged pairs into the entitlement directory, and end the
+        batch.
 
-        key_filename = '%s-key.pem' % str(serial)
-        key_path = Path.join(ent_dir_path, key_filename)
-        key.write(key_path)
+        Returns a list of (cert, exception) for pairs that could not be
+        moved into place.
+        """
+        staging_dir = self._staging_dir
+        staged = self._staged
+        self._batch = False
+        self._staging_dir = None
+        self._staged = []
+        if staging_dir is None:
+            return []
 
-        cert_filename = '%s.pem' % str(serial)
-        cert_path = Path.join(ent_dir_path, cert_filename)
-        cert.write(cert_path)
+        ent_dir_path = self.ent_dir.productpath()
+        failed = []
+        try:
+            for (key, key_tmp, cert, cert_tmp) in staged:
+                serial = str(cert.serial)
+                key_path = Path.join(ent_dir_path, '%s-key.pem' % serial)
+                cert_path = Path.join(ent_dir_path, '%s.pem' % serial)
+                try:
+                    self._rename_pair(key_tmp, key_path, cert_tmp, cert_path)
+                except OSError, e:
+                    failed.append((cert, e))
+                    continue
+                key.path = key_path
+                cert.path = cert_path
+                self.ent_dir.add_cert(cert)
+            if len(failed) < len(staged):
+                self.ent_dir.save_index()
+                _fsync_path(Path.abs(ent_dir_path))
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        return failed
+
+    def _rename_pair(self, key_tmp, key_path, cert_tmp, cert_path):
+        # Keep a link to the key being replaced, so it can be restored if
+        # the cert rename fails and the old cert is left in place.
+        key_backup = None
+        if os.path.exists(key_path):
+            key_backup = key_tmp + '.old'
+            os.link(key_path, key_backup)
+
+        os.rename(key_tmp, key_path)
+        try:
+            os.rename(cert_tmp, cert_path)
+        except OSError:
+            try:
+                if key_backup is not None:
+                    os.rename(key_backup, key_path)
+                else:
+                    os.unlink(key_path)
+            except OSError, e:
+                log.error("Failed to restore %s: %s" % (key_path, e))
+            raise
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,402 @@
+#
+# Copyright (c) 2015 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+"""
+Persistent index of decoded certificate fields.
+
+Parsing a PEM file and decoding its X.509 extensions is expensive, and
+every process that looks at the entitlement or product certificate
+directories (yum plugins, rhsmcertd-worker, cli, gui) would otherwise
+do it again for every certificate on every run.
+
+The index maps a certificate path to the stat signature of that file
+(size, mtime and inode) and the decoded certificate fields. As long as
+the signature still matches, the certificate object is rebuilt from the
+index instead of the PEM. The raw x509 object, PEM text and extensions
+are not stored, they are read from the file the first time they are used.
+
+Most callers of list() only look at serials, validity ranges, product
+ids and the order. The content sets of entitlement certificates are kept
+in the index as an opaque JSON string, and only decoded into objects when
+first accessed.
+"""
+
+import calendar
+import logging
+import os
+import types
+from datetime import datetime
+
+from rhsm import certificate2
+from rhsm.certificate import DateRange, GMT
+from subscription_manager.cache import CacheManager
+from rhsm import ourjson as json
+
+log = logging.getLogger('rhsm-app.' + __name__)
+
+# Bump this whenever the encoding of index entries changes. Indexes
+# written with a different version are discarded.
+INDEX_VERSION = 4
+
+CERT_INDEX_DIR = "/var/lib/rhsm/cache/certindex"
+
+
+class UnindexableValue(Exception):
+    """Raised when a certificate holds a value we do not know how to store."""
+    pass
+
+
+def stat_signature(path):
+    """
+    Return the signature used to decide if an index entry is still valid
+    for the file at path.
+    """
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+
+class _Reparsed(object):
+    """
+    Attribute that is not stored in the index. The first access parses
+    the certificate file and copies the raw fields onto the instance,
+    after which normal instance attribute lookup takes over.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        obj._reparse()
+        return obj.__dict__[self.name]
+
+
+class _Deferred(object):
+    """
+    Attribute stored in the index, but only decoded on first access.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        obj._undefer()
+        return obj.__dict__.get(self.name)
+
+
+# Fields of a certificate that are too large or not serializable. These
+# are loaded from the PEM file on demand.
+REPARSED_FIELDS = ['x509', 'pem', 'extensions']
+
+# Fields that are stored in the index but decoded lazily. The order is
+# small and read by status checks, so it is not one of them.
+DEFERRED_FIELDS = ['content']
+
+# Private memoized state that is dropped from the index and rebuilt.
+RESET_FIELDS = ['_path_tree_object']
+
+
+class IndexedCertificateMixin(object):
+    """
+    Behaviour shared by certificates rebuilt from the index.
+    """
+    x509 = _Reparsed('x509')
+    pem = _Reparsed('pem')
+    extensions = _Reparsed('extensions')
+
+    def _reparse(self):
+        # Imported here, as tests patch create_from_file on the modules
+        # that use it.
+        from rhsm.certificate import create_from_file, create_from_pem
+        if self.__dict__.get('pem') is not None:
+            # Not backed by a file, the PEM was kept instead.
+            parsed = create_from_pem(self.__dict__['pem'])
+        else:
+            parsed = create_from_file(self.path)
+        for name in REPARSED_FIELDS:
+            self.__dict__[name] = getattr(parsed, name, None)
+
+    def _undefer(self):
+        deferred = self.__dict__.pop('_deferred', None)
+        if deferred:
+            self.__dict__.update(_decode(json.loads(deferred)))
+
+
+class IndexedEntitlementCertificate(IndexedCertificateMixin,
+                                    certificate2.EntitlementCertificate):
+    content = _Deferred('content')
+
+
+class IndexedProductCertificate(IndexedCertificateMixin,
+                                certificate2.ProductCertificate):
+    pass
+
+
+# Exact certificate class -> class we rebuild index entries as.
+INDEXED_CERT_CLASSES = {
+    certificate2.EntitlementCertificate: IndexedEntitlementCertificate,
+    certificate2.ProductCertificate: IndexedProductCertificate,
+    IndexedEntitlementCertificate: IndexedEntitlementCertificate,
+    IndexedProductCertificate: IndexedProductCertificate,
+}
+INDEXED_CERT_CLASSES_BY_NAME = dict((cls.__name__, cls) for cls in
+                                    INDEXED_CERT_CLASSES.values())
+
+# Simple value objects hung off of certificates, stored by their attributes.
+VALUE_CLASSES = dict((cls.__name__, cls) for cls in
+                     [getattr(certificate2, name, None) for name in
+                      ('Product', 'Content', 'Order', 'Pool', 'Version')] +
+                     [DateRange] if cls is not None)
+
+
+def encode_cert(cert):
+    """
+    Encode a certificate into a structure that can be dumped as JSON.
+
+    Raises UnindexableValue if the certificate is of an unknown type or
+    holds a value that can not be encoded.
+    """
+    cls = INDEXED_CERT_CLASSES.get(type(cert))
+    if cls is None:
+        raise UnindexableValue(type(cert))
+
+    if isinstance(cert, IndexedCertificateMixin):
+        cert._undefer()
+
+    attrs = {}
+    deferred = {}
+    for name, value in cert.__dict__.items():
+        if name in REPARSED_FIELDS:
+            continue
+        if name in RESET_FIELDS:
+            value = None
+        if name in DEFERRED_FIELDS:
+            deferred[name] = _encode(value)
+        else:
+            attrs[name] = _encode(value)
+    return {'class': cls.__name__, 'attrs': attrs,
+            'deferred': json.dumps(deferred)}
+
+
+def decode_cert(data):
+    """
+    Rebuild a certificate object from the output of encode_cert.
+    """
+    cls = INDEXED_CERT_CLASSES_BY_NAME[data['class']]
+    cert = cls.__new__(cls)
+    cert.__dict__.update(_decode(data['attrs']))
+    # Kept as a string until one of the deferred fields is used.
+    cert.__dict__['_deferred'] = data['deferred']
+    return cert
+
+
+def _encode(value):
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        # JSON reads strings back as either type, mark the byte strings
+        # so every string comes back as the type it was loaded as.
+        return {'__bytes__': value}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return {'__set__': [_encode(v) for v in value]}
+    if isinstance(value, dict):
+        for key in value:
+            if not isinstance(key, basestring):
+                raise UnindexableValue(key)
+        return {'__map__': dict((k, _encode(v)) for (k, v) in value.items())}
+    if isinstance(value, datetime):
+        return {'__datetime__': [calendar.timegm(value.utctimetuple()),
+                                 value.microsecond,
+                                 value.tzinfo is not None]}
+    # DateRange is an old style class, so look at __class__ rather than type()
+    cls = VALUE_CLASSES.get(value.__class__.__name__)
+    if cls is not None and value.__class__ is cls:
+        return {'__object__': [cls.__name__, _encode(value.__dict__)]}
+    raise UnindexableValue(value.__class__)
+
+
+def _bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _decode(value):
+    if isinstance(value, basestring):
+        # Not marked as bytes, so python-rhsm loaded it as unicode. The
+        # JSON parser returns ASCII strings as str.
+        if isinstance(value, str):
+            return value.decode('utf-8')
+        return value
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+
+    if '__bytes__' in value:
+        return _bytes(value['__bytes__'])
+    # Attribute names and the keys of the subject and issuer are byte
+    # strings.
+    if '__map__' in value:
+        return dict((_bytes(k), _decode(v)) for (k, v) in value['__map__'].items())
+    if '__set__' in value:
+        return set(_decode(v) for v in value['__set__'])
+    if '__datetime__' in value:
+        timestamp, microsecond, aware = value['__datetime__']
+        if aware:
+            result = datetime.fromtimestamp(timestamp, GMT())
+        else:
+            result = datetime.utcfromtimestamp(timestamp)
+        return result.replace(microsecond=microsecond)
+    if '__object__' in value:
+        class_name, attrs = value['__object__']
+        cls = VALUE_CLASSES[class_name]
+        if isinstance(cls, type):
+            obj = cls.__new__(cls)
+        else:
+            obj = types.InstanceType(cls)
+        obj.__dict__.update(_decode(attrs))
+        return obj
+    # Attribute dicts of encoded objects
+    return dict((_bytes(k), _decode(v)) for (k, v) in value.items())
+
+
+class CertificateIndex(CacheManager):
+    """
+    On disk index of the certificates in one certificate directory.
+
+    get() returns the certificate for a path. A certificate already
+    returned for an unchanged file is handed back again, otherwise it is
+    rebuilt from the index, or loaded with the given loader if the file is
+    new or has changed. add() records a certificate that was just written.
+    save() drops entries for files that were not asked for since the last
+    save, and writes the index if anything changed.
+    """
+
+    def __init__(self, cert_dir_path):
+        # One index per certificate directory, named after its path.
+        self.CACHE_FILE = os.path.join(CERT_INDEX_DIR, "%s.json" %
+                                       cert_dir_path.strip(os.sep).replace(os.sep, '_'))
+        self._entries = None
+        # path -> (stat signature, certificate) for certs handed out already
+        self._loaded = {}
+        self._seen = set()
+        self._dirty = False
+
+    def _get_entries(self):
+        if self._entries is None:
+            data = None
+            if self._cache_exists():
+                data = self._read_cache()
+            if not data or data.get('version') != INDEX_VERSION:
+                data = {'entries': {}}
+            self._entries = data['entries']
+        return self._entries
+
+    entries = property(_get_entries)
+
+    def to_dict(self):
+        return {'version': INDEX_VERSION, 'entries': self.entries}
+
+    def _load_data(self, open_file):
+        return json.loads(open_file.read())
+
+    def delete_cache(self):
+        if os.path.exists(self.CACHE_FILE):
+            log.debug("Deleting cache: %s" % self.CACHE_FILE)
+            os.remove(self.CACHE_FILE)
+        self._entries = None
+        self._loaded = {}
+
+    def get(self, path, loader):
+        self._seen.add(path)
+        try:
+            signature = stat_signature(path)
+        except OSError:
+            # Let the loader report the problem as it always has.
+            return loader(path)
+
+        loaded = self._loaded.get(path)
+        if loaded is not None and loaded[0] == signature:
+            return loaded[1]
+
+        cert = None
+        entry = self.entries.get(path)
+        if entry is not None and entry['stat'] == signature:
+            try:
+                cert = decode_cert(entry['cert'])
+            except Exception, e:
+                log.debug("Ignoring bad certificate index entry for %s: %s" % (path, e))
+
+        if cert is None:
+            cert = loader(path)
+            self._store(path, signature, cert)
+        self._loaded[path] = (signature, cert)
+        return cert
+
+    def add(self, path, cert):
+        """Record a certificate that was just written to path."""
+        self._seen.add(path)
+        try:
+            signature = stat_signature(path)
+        except OSError:
+            self.discard(path)
+            return
+        self._store(path, signature, cert)
+        self._loaded[path] = (signature, cert)
+
+    def discard(self, path):
+        self._seen.discard(path)
+        self._loaded.pop(path, None)
+        if self.entries.pop(path, None) is not None:
+            self._dirty = True
+
+    def _store(self, path, signature, cert):
+        try:
+            encoded = encode_cert(cert)
+        except UnindexableValue:
+            if self.entries.pop(path, None) is not None:
+                self._dirty = True
+            return
+        self.entries[path] = {'stat': signature, 'cert': encoded}
+        self._dirty = True
+
+    def save(self, prune=True):
+        """
+        Write the index if it changed. With prune, entries for any file not
+        asked for since the last save are dropped first.
+        """
+        if prune:
+            for path in set(self.entries) - self._seen:
+                del self.entries[path]
+                self._dirty = True
+            for path in set(self._loaded) - self._seen:
+                del self._loaded[path]
+            self._seen = set()
+
+        if not self._dirty:
+            return
+        try:
+            self.write_cache(debug=False)
+        except OSError, e:
+            # Most likely not running as root, the index is only an
+            # optimization so carry on without it.
+            log.debug("Unable to write certificate index %s: %s" % (self.CACHE_FILE, e))
+        self._dirty = False
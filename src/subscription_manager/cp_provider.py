@@ -87,17 +87,22 @@ class CPProvider(object):
 
     def get_consumer_auth_cp(self):
         if not self.consumer_auth_cp:
-            self.consumer_auth_cp = connection.UEPConnection(
-                    host=self.server_hostname,
-                    ssl_port=self.server_port,
-                    handler=self.server_prefix,
-                    proxy_hostname=self.proxy_hostname,
-                    proxy_port=self.proxy_port,
-                    proxy_user=self.proxy_user,
-                    proxy_password=self.proxy_password,
-                    cert_file=self.cert_file, key_file=self.key_file)
+            self.consumer_auth_cp = self.create_consumer_auth_cp()
         return self.consumer_auth_cp
 
+    # A connection of its own, not shared with anything else. Connections
+    # are not thread safe, so each thread needs one.
+    def create_consumer_auth_cp(self):
+        return connection.UEPConnection(
+                host=self.server_hostname,
+                ssl_port=self.server_port,
+                handler=self.server_prefix,
+                proxy_hostname=self.proxy_hostname,
+                proxy_port=self.proxy_port,
+                proxy_user=self.proxy_user,
+                proxy_password=self.proxy_password,
+                cert_file=self.cert_file, key_file=self.key_file)
+
     def get_basic_auth_cp(self):
         if not self.basic_auth_cp:
             self.basic_auth_cp = connection.UEPConnection(
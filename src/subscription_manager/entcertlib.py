@@ -15,8 +15,12 @@
 
 import gettext
 import logging
+import Queue
 import socket
+import sys
+import threading
 
+from iniparse.compat import NoSectionError, NoOptionError
 from rhsm.config import initConfig
 from rhsm.certificate import Key, create_from_pem
 
@@ -35,6 +39,26 @@ _ = gettext.gettext
 
 cfg = initConfig()
 
+# Number of serials asked for in one getCertificates call, and the number
+# of calls that may be in flight at once. Overridden by the
+# entitlement_cert_batch_size and entitlement_cert_workers options in
+# the [rhsm] section of rhsm.conf.
+DEFAULT_CERT_BATCH_SIZE = 100
+DEFAULT_CERT_WORKERS = 4
+
+
+def _get_cfg_int(option, default):
+    try:
+        value = cfg.get_int('rhsm', option)
+    except (NoSectionError, NoOptionError):
+        return default
+    except ValueError, e:
+        log.warn(e)
+        return default
+    if not value or value < 1:
+        return default
+    return value
+
 
 class EntCertActionInvoker(certlib.BaseActionInvoker):
     """Invoker for entitlement certificate updating actions."""
@@ -103,6 +127,8 @@ class EntCertUpdateAction(object):
 
     rogue: ent certs installed on system but not known by RHSM API.
     missing: ent certs RHSM API knows, but are not installed on system.
+
+    plan() computes these without changing anything, see EntCertUpdatePlan.
     """
     def __init__(self, report=None):
         self.cp_provider = inj.require(inj.CP_PROVIDER)
@@ -111,9 +137,14 @@ class EntCertUpdateAction(object):
         self.identity = require(IDENTITY)
         self.report = EntCertUpdateReport()
 
-    # NOTE: this is slightly at odds with the manual cert import
-    #       path, manual import certs wont get a 'report', etc
-    def perform(self):
+    def plan(self):
+        """Work out which certs perform() would install and delete.
+
+        Returns an EntCertUpdatePlan. This still refreshes the
+        EntitlementDirectory, asks RHSM API for the expected serial
+        numbers and records both in self.report, but nothing is installed
+        or deleted.
+        """
         local = self._get_local_serials()
         try:
             expected = self._get_expected_serials()
@@ -121,17 +152,22 @@ class EntCertUpdateAction(object):
             log.exception(ex)
             log.error('Cannot modify subscriptions while disconnected')
             raise Disconnected()
+        return EntCertUpdatePlan(local, expected)
 
-        missing_serials = self._find_missing_serials(local, expected)
-        rogue_serials = self._find_rogue_serials(local, expected)
+    # NOTE: this is slightly at odds with the manual cert import
+    #       path, manual import certs wont get a 'report', etc
+    def perform(self):
+        plan = self.plan()
+        log.debug('cert update plan: %s', plan)
 
-        self.delete(rogue_serials)
-        self.install(missing_serials)
+        self.delete(plan.rogue)
+        self.install(plan.missing)
+        self.report.updated = plan.find_updated(self.report.added)
 
         log.info('certs updated:\n%s', self.report)
         self.syslog_results()
 
-        if missing_serials or rogue_serials:
+        if plan.has_changes():
 
             # We call EntCertlibActionInvoker.update() solo from
             # the 'attach' cli instead of an ActionClient. So
@@ -179,18 +215,13 @@ class EntCertUpdateAction(object):
             log.debug(e)
             log.debug("Failed to update repos")
 
-    def _find_missing_serials(self, local, expected):
-        """ Find serials from the server we do not have locally. """
-        missing = [sn for sn in expected if sn not in local]
-        return missing
-
-    def _find_rogue_serials(self, local, expected):
-        """Find serials we have locally but are not on the server."""
-        rogue = [local[sn] for sn in local if not sn in expected]
-        return rogue
-
     def syslog_results(self):
         """Write generated EntCertUpdateReport info to syslog."""
+        for (old_cert, new_cert) in self.report.updated:
+            utils.system_log("Updated subscription for '%s' contract '%s' "
+                             "(serial %s replaced by %s)" %
+                             (new_cert.order.name, new_cert.order.contract,
+                              old_cert.serial, new_cert.serial))
         for cert in self.report.added:
             utils.system_log("Added subscription for '%s' contract '%s'" %
                              (cert.order.name, cert.order.contract))
@@ -238,17 +269,19 @@ class EntCertUpdateAction(object):
         return results
 
     def get_certificates_by_serial_list(self, sn_list):
-        """Fetch a list of entitlement certificates specified by a list of serial numbers."""
-        result = []
-        if sn_list:
-            sn_list = [str(sn) for sn in sn_list]
-            # NOTE: use injected IDENTITY, need to validate this
-            # handles disconnected errors properly
-            reply = self.uep.getCertificates(self.identity.getConsumerId(),
-                                              serials=sn_list)
-            for cert in reply:
-                result.append(cert)
-        return result
+        """Fetch the entitlement certificates specified by a list of serial numbers.
+
+        Returns an iterable of cert bundles, fetched in batches as it is
+        consumed. See EntitlementCertBatchFetcher.
+        """
+        if not sn_list:
+            return []
+        # NOTE: use injected IDENTITY, need to validate this
+        # handles disconnected errors properly
+        return EntitlementCertBatchFetcher(self.uep,
+                                           self.identity.getConsumerId(),
+                                           sn_list,
+                                           uep_factory=self.cp_provider.create_consumer_auth_cp)
 
     def _get_expected_serials(self):
         exp = self.get_certificate_serials_list()
@@ -274,6 +307,176 @@ class EntCertUpdateAction(object):
             self.ent_dir.refresh()
 
 
+class EntCertUpdatePlan(object):
+    """The changes needed to sync local ent certs with RHSM API.
+
+    local is a dict of serial number to installed ent cert, expected is
+    the list of serial numbers RHSM API knows for this consumer. Both are
+    compared as sets, so building a plan is linear in the number of
+    serials.
+
+    missing: expected serials with no local cert, in the order RHSM API
+        returned them.
+    rogue: local certs whose serial RHSM API does not know.
+    unchanged: serials that are both installed and expected.
+    updated: (rogue cert, installed cert) pairs for the same entitlement.
+
+    Entitlements that were regenerated by the server show up as a rogue
+    cert plus a missing serial. RHSM API only returns serial numbers, so
+    which entitlement a missing serial belongs to is only known once its
+    cert is fetched. updated stays empty until find_updated() is called
+    with the installed certs.
+    """
+
+    def __init__(self, local, expected):
+        expected_set = set()
+        self.missing = []
+        self.unchanged = []
+        for sn in expected:
+            if sn in expected_set:
+                continue
+            expected_set.add(sn)
+            if sn in local:
+                self.unchanged.append(sn)
+            else:
+                self.missing.append(sn)
+        self.rogue = [cert for (sn, cert) in local.items()
+                      if sn not in expected_set]
+        self.updated = []
+
+    def has_changes(self):
+        return bool(self.missing or self.rogue)
+
+    def find_updated(self, installed):
+        """Pair rogue certs with the installed certs that replaced them.
+
+        Certs are matched by entitlement id, or pool id if a cert has no
+        entitlement id. Sets and returns self.updated.
+        """
+        installed_by_id = {}
+        for cert in installed:
+            ent_id = _entitlement_id(cert)
+            if ent_id is not None:
+                installed_by_id[ent_id] = cert
+
+        self.updated = []
+        for cert in self.rogue:
+            new_cert = installed_by_id.get(_entitlement_id(cert))
+            if new_cert is not None:
+                self.updated.append((cert, new_cert))
+        return self.updated
+
+    def __str__(self):
+        return "missing: %s, rogue: %s, unchanged: %s, updated: %s" % \
+            (self.missing, [cert.serial for cert in self.rogue],
+             len(self.unchanged),
+             [(old.serial, new.serial) for (old, new) in self.updated])
+
+
+def _entitlement_id(cert):
+    subject = getattr(cert, 'subject', None) or {}
+    ent_id = subject.get('CN')
+    if ent_id is None and getattr(cert, 'pool', None) is not None:
+        ent_id = cert.pool.id
+    return ent_id
+
+
+class EntitlementCertBatchFetcher(object):
+    """Fetch entitlement cert bundles from RHSM API in batches.
+
+    The serial numbers are split into batches of batch_size, each fetched
+    with one getCertificates call. Given a uep_factory and more than one
+    batch, up to workers threads fetch batches while the caller installs
+    the bundles of the batches that already arrived. Each thread fetches
+    with its own connection from uep_factory, as connections are not
+    thread safe. Without a uep_factory, the batches are fetched one after
+    the other with uep.
+
+    At most 2 * workers + 1 batches are held in memory at once, however
+    many serials there are: workers waiting in the results queue, one
+    being fetched by each thread, and the one being installed. All
+    threads are joined before the iteration ends.
+
+    Iterating yields cert bundles, in no particular order across batches.
+    If fetching a batch fails, the exception is raised from the iteration
+    and no further batches are fetched.
+    """
+
+    def __init__(self, uep, consumer_uuid, sn_list, batch_size=None, workers=None,
+                 uep_factory=None):
+        self.uep = uep
+        self.uep_factory = uep_factory
+        self.consumer_uuid = consumer_uuid
+        self.batch_size = batch_size or _get_cfg_int('entitlement_cert_batch_size',
+                                                     DEFAULT_CERT_BATCH_SIZE)
+        self.workers = workers or _get_cfg_int('entitlement_cert_workers',
+                                               DEFAULT_CERT_WORKERS)
+        sn_list = [str(sn) for sn in sn_list]
+        self.batches = [sn_list[i:i + self.batch_size]
+                        for i in range(0, len(sn_list), self.batch_size)]
+
+    def fetch(self, batch, uep=None):
+        uep = uep or self.uep
+        return uep.getCertificates(self.consumer_uuid, serials=batch)
+
+    def __iter__(self):
+        if len(self.batches) < 2 or self.workers < 2 or self.uep_factory is None:
+            for batch in self.batches:
+                for bundle in self.fetch(batch):
+                    yield bundle
+            return
+
+        tasks = Queue.Queue()
+        for batch in self.batches:
+            tasks.put(batch)
+        # Bounded so workers wait for the caller instead of piling up replies.
+        results = Queue.Queue(self.workers)
+        stop = threading.Event()
+
+        threads = []
+        for i in range(min(self.workers, len(self.batches))):
+            thread = threading.Thread(target=self._work,
+                                      name="EntCertFetchThread-%d" % i,
+                                      args=(tasks, results, stop))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for i in range(len(self.batches)):
+                reply, exc_info = results.get()
+                if exc_info is not None:
+                    # keep the traceback from the thread
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                for bundle in reply:
+                    yield bundle
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _work(self, tasks, results, stop):
+        uep = None
+        while not stop.isSet():
+            try:
+                batch = tasks.get(block=False)
+            except Queue.Empty:
+                return
+            try:
+                if uep is None:
+                    uep = self.uep_factory()
+                result = (self.fetch(batch, uep), None)
+            except Exception:
+                result = (None, sys.exc_info())
+            while True:
+                try:
+                    results.put(result, timeout=0.1)
+                    break
+                except Queue.Full:
+                    if stop.isSet():
+                        return
+
+
 class EntitlementCertBundlesInstaller(object):
     """Install a list of entitlement cert bundles.
 
@@ -287,10 +490,23 @@ class EntitlementCertBundlesInstaller(object):
         self.report = report
 
     def install(self, cert_bundles):
-        """Fetch entitliement certs, install them, and update the report."""
-        bundle_installer = EntitlementCertBundleInstaller(self.report)
-        for cert_bundle in cert_bundles:
-            bundle_installer.install(cert_bundle)
+        """Fetch entitliement certs, install them, and update the report.
+
+        The certs are written as one batch, and moved into the entitlement
+        directory together once all bundles were handled, or fetching
+        them failed.
+        """
+        writer = Writer()
+        writer.begin()
+        bundle_installer = EntitlementCertBundleInstaller(self.report, writer=writer)
+        try:
+            for cert_bundle in cert_bundles:
+                bundle_installer.install(cert_bundle)
+        finally:
+            for cert, e in writer.commit():
+                log.error('Failed to install certificate %s: %s' % (cert.serial, e))
+                self.report.added.remove(cert)
+                self.report._exceptions.append(e)
         self.exceptions = bundle_installer.exceptions
         self.post_install()
 
@@ -326,15 +542,16 @@ class EntitlementCertBundleInstaller(object):
     bundles, while this is pre/post each ent cert bundle.
     """
 
-    def __init__(self, report):
+    def __init__(self, report, writer=None):
         self.exceptions = []
         self.report = report
+        self.writer = writer
 
     def install(self, bundle):
         """Persist an ent cert and it's key after splitting it from the bundle."""
         self.pre_install(bundle)
 
-        cert_bundle_writer = Writer()
+        cert_bundle_writer = self.writer or Writer()
         try:
             key, cert = self.build_cert(bundle)
             cert_bundle_writer.write(key, cert)
@@ -386,6 +603,8 @@ class EntCertUpdateReport(certlib.ActionReport):
         self.expected = []
         self.added = []
         self.rogue = []
+        # (deleted, added) pairs of certs for the same entitlement
+        self.updated = []
         self._exceptions = []
 
     def updates(self):
@@ -427,4 +646,10 @@ class EntCertUpdateReport(certlib.ActionReport):
         s.append(_('Expected (UEP) serial# %s') % self.expected)
         self.write(s, _('Added (new)'), self.added)
         self.write(s, _('Deleted (rogue):'), self.rogue)
+        if self.updated:
+            s.append(_('Updated (regenerated):'))
+            for (old_cert, new_cert) in self.updated:
+                s.append('  [sn:%d -> sn:%d (%s)]' %
+                         (old_cert.serial, new_cert.serial,
+                          new_cert.order.name))
         return '\n'.join(s)
@@ -20,7 +20,8 @@ import os
 import rhsm.config
 
 from subscription_manager.injection import PLUGIN_MANAGER, require
-from subscription_manager.cache import CacheManager
+from subscription_manager import cacheformat
+from subscription_manager.cache import CacheManager, get_consumer_cache
 import subscription_manager.injection as inj
 from rhsm import ourjson as json
 
@@ -41,7 +42,8 @@ class Facts(CacheManager):
     Includes both those hard coded in the app itself, as well as custom
     facts to be loaded from /etc/rhsm/facts/.
     """
-    CACHE_FILE = "/var/lib/rhsm/facts/facts.json"
+    CACHE_FILE = "/var/lib/rhsm/facts/facts.cache"
+    CACHE_FORMAT = cacheformat.COMPACT
 
     def __init__(self, ent_dir=None, prod_dir=None):
         self.facts = {}
@@ -60,7 +62,7 @@ class Facts(CacheManager):
 
     def get_last_update(self):
         try:
-            return datetime.fromtimestamp(os.stat(self.CACHE_FILE).st_mtime)
+            return datetime.fromtimestamp(os.stat(self._existing_cache_file()).st_mtime)
         except Exception:
             return None
 
@@ -151,7 +153,8 @@ class Facts(CacheManager):
 
     def _sync_with_server(self, uep, consumer_uuid):
         log.debug("Updating facts on server")
-        uep.updateConsumer(consumer_uuid, facts=self.get_facts())
+        get_consumer_cache().update_consumer(uep, consumer_uuid,
+                                             facts=self.get_facts())
 
     def _load_data(self, open_file):
         json_str = open_file.read()
@@ -15,19 +15,84 @@
 
 """
 Watch for and be notified of changes in a file.
+
+Where the kernel supports it, directories are watched with inotify so a
+monitor only does work when something changed. Otherwise the directory
+mtime is polled.
+
+Per directory callbacks are passed a DirectoryChanges object describing
+which files were created, modified or deleted.
 """
+import ctypes
+import ctypes.util
+import errno
+import logging
 import os
+import struct
+
+log = logging.getLogger('rhsm-app.' + __name__)
+
+
+class DirectoryChanges(object):
+    """
+    Names of the files created, modified and deleted in a directory.
+
+    If full_rescan is set, the exact changes are not known and anything
+    in the directory may have changed.
+    """
+    def __init__(self, created=None, modified=None, deleted=None,
+                 full_rescan=False):
+        self.created = set(created or [])
+        self.modified = set(modified or [])
+        self.deleted = set(deleted or [])
+        self.full_rescan = full_rescan
+
+    def add_created(self, name):
+        self.deleted.discard(name)
+        self.modified.discard(name)
+        self.created.add(name)
+
+    def add_modified(self, name):
+        if name not in self.created:
+            self.modified.add(name)
+
+    def add_deleted(self, name):
+        self.created.discard(name)
+        self.modified.discard(name)
+        self.deleted.add(name)
+
+    def __nonzero__(self):
+        return bool(self.created or self.modified or self.deleted or
+                    self.full_rescan)
+
+    def __str__(self):
+        if self.full_rescan:
+            return "<DirectoryChanges full_rescan>"
+        return "<DirectoryChanges created=%s modified=%s deleted=%s>" % \
+            (sorted(self.created), sorted(self.modified), sorted(self.deleted))
 
 
 class MonitorDirectory(object):
+    """
+    Polls the mtime of a directory, and works out what changed in it
+    when the mtime changes.
+    """
 
     def __init__(self, path, changed_callback=None):
         self.mtime = None
         self.exists = None
         self.path = path
         self._changed_callback = changed_callback
+        self._snapshot = {}
         self.update()
 
+    def fileno(self):
+        """Polling monitors have nothing to wait on."""
+        return None
+
+    def close(self):
+        pass
+
     def _check_mtime(self):
         mtime = 0
         try:
@@ -40,9 +105,36 @@ class MonitorDirectory(object):
     def _get_mtime(self, path):
         return os.path.getmtime(path)
 
-    def _on_changed(self):
+    def _scan(self):
+        """Map file names in the directory to their (mtime, size)."""
+        snapshot = {}
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return snapshot
+        for name in names:
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            snapshot[name] = (st.st_mtime, st.st_size)
+        return snapshot
+
+    def _diff_snapshot(self, snapshot):
+        old = self._snapshot
+        changes = DirectoryChanges(created=set(snapshot) - set(old),
+                                   deleted=set(old) - set(snapshot))
+        for name in set(snapshot) & set(old):
+            if snapshot[name] != old[name]:
+                changes.add_modified(name)
+        self._snapshot = snapshot
+        return changes
+
+    def _on_changed(self, changes=None):
         if self._changed_callback:
-            self._changed_callback()
+            if changes is None:
+                changes = DirectoryChanges(full_rescan=True)
+            self._changed_callback(changes)
 
     def _changed(self, mtime, mtime2, exists, exists2):
         return mtime != mtime2 or exists != exists2
@@ -58,18 +150,184 @@ class MonitorDirectory(object):
         self.exists = exists
 
         if result:
-            self._on_changed()
+            self._on_changed(self._diff_snapshot(self._scan()))
 
         return result
 
 
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+
+class InotifyMonitorDirectory(MonitorDirectory):
+    """
+    Watches a directory with inotify.
+
+    update() only reads events already queued by the kernel, so it is
+    cheap to call, and fileno() can be handed to a main loop to call
+    update() only when there is something to read.
+
+    If the directory goes away, the watch is lost. Until update() manages
+    to watch the directory again, fileno() is None and update() has to be
+    polled.
+
+    Raises OSError if inotify is unavailable, or the directory does not
+    exist.
+    """
+
+    def __init__(self, path, changed_callback=None):
+        self.path = path
+        self._changed_callback = changed_callback
+        self._fd = None
+        self._watch = None
+
+        libc = _get_libc()
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._fd = fd
+        try:
+            self._add_watch()
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watch(self):
+        wd = _get_libc().inotify_add_watch(self._fd, self.path, WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed: %s" %
+                          self.path)
+        self._watch = wd
+
+    def fileno(self):
+        if self._watch is None:
+            return None
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._watch = None
+
+    def _read_events(self):
+        if self._fd is None:
+            return
+        buf = ""
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not data:
+                break
+            buf += data
+
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip('\0')
+            offset += length
+            yield mask, name
+
+    def update(self):
+        changes = DirectoryChanges()
+        watch_lost = False
+        for mask, name in self._read_events():
+            if mask & IN_Q_OVERFLOW:
+                changes.full_rescan = True
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                watch_lost = True
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                changes.add_created(name)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                changes.add_deleted(name)
+            elif mask & IN_CLOSE_WRITE:
+                changes.add_modified(name)
+
+        if watch_lost:
+            self._watch = None
+            changes.full_rescan = True
+
+        if self._watch is None and self._fd is not None:
+            # The directory itself went away, pick it up again once it
+            # is recreated.
+            try:
+                self._add_watch()
+                changes.full_rescan = True
+            except OSError:
+                pass
+
+        if not changes:
+            return False
+
+        log.debug("Changes in %s: %s" % (self.path, changes))
+        self._on_changed(changes)
+        return True
+
+
+def create_monitor_directory(path, changed_callback=None):
+    """
+    Return an inotify based monitor for path if possible, falling back to
+    polling the directory mtime.
+    """
+    try:
+        return InotifyMonitorDirectory(path, changed_callback)
+    except (OSError, AttributeError), e:
+        # AttributeError if libc has no inotify support
+        log.debug("Using polling to monitor %s: %s" % (path, e))
+        return MonitorDirectory(path, changed_callback)
+
+
 class MonitorDirectories(object):
 
     def __init__(self, dir_monitors=None, changed_callback=None):
-        """Attach a timer callback to call run_check to poll periodically."""
+        """
+        Attach a timer callback to call update() to poll periodically, or
+        if needs_polling() is False, watch the filenos() for input.
+        """
         self.dir_monitors = dir_monitors or []
         self._changed_callback = changed_callback
 
+    def filenos(self):
+        return [dir_monitor.fileno() for dir_monitor in self.dir_monitors
+                if dir_monitor.fileno() is not None]
+
+    def needs_polling(self):
+        return len(self.filenos()) != len(self.dir_monitors)
+
+    def close(self):
+        for dir_monitor in self.dir_monitors:
+            dir_monitor.close()
+
     def update(self):
         # check all the dirs in a batch, to hopefully coalesce
         # related changes into one callback.
@@ -88,6 +346,6 @@ class MonitorDirectories(object):
 
     @classmethod
     def from_path_list(cls, path_list=None, changed_callback=None):
-        dir_monitors = [MonitorDirectory(path) for path in path_list]
+        dir_monitors = [create_monitor_directory(path) for path in path_list]
         return cls(dir_monitors=dir_monitors,
                    changed_callback=changed_callback)
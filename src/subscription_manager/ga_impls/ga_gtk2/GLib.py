@@ -1,5 +1,7 @@
 import gobject
 
 timeout_add = gobject.timeout_add
+io_add_watch = gobject.io_add_watch
+IO_IN = gobject.IO_IN
 
-__all__ = [timeout_add]
+__all__ = [timeout_add, io_add_watch, IO_IN]
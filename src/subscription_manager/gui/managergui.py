@@ -128,6 +128,9 @@ class Backend(object):
     def on_cert_check_timer(self):
         self.cs.force_cert_check()
 
+    def close(self):
+        self.cs.close()
+
 
 class MainWindow(widgets.SubmanBaseWidget):
     """
@@ -256,9 +259,17 @@ class MainWindow(widgets.SubmanBaseWidget):
         self.backend.cs.notify()
 
         # managergui needs cert_sort.cert_monitor.run_check() to run
-        # on a timer to detect cert changes from outside the gui
+        # to detect cert changes from outside the gui
         # (via rhsmdd for example, or manually provisioned).
-        ga_GLib.timeout_add(2000, self._on_cert_check_timer)
+        # If the cert dirs are watched with inotify, only run it when
+        # there are events to read, otherwise poll on a timer.
+        cert_monitor = self.backend.cs.cert_monitor
+        self._cert_check_timer = None
+        if cert_monitor.needs_polling():
+            self._start_cert_check_timer()
+        else:
+            for fd in cert_monitor.filenos():
+                ga_GLib.io_add_watch(fd, ga_GLib.IO_IN, self._on_cert_monitor_event)
 
         if auto_launch_registration and not self.registered():
             self._register_item_clicked(None)
@@ -266,10 +277,21 @@ class MainWindow(widgets.SubmanBaseWidget):
     def registered(self):
         return self.identity.is_valid()
 
+    def _start_cert_check_timer(self):
+        self._cert_check_timer = ga_GLib.timeout_add(2000, self._on_cert_check_timer)
+
     def _on_cert_check_timer(self):
         self.backend.on_cert_check_timer()
         return True
 
+    def _on_cert_monitor_event(self, source, condition):
+        self.backend.on_cert_check_timer()
+        # A cert dir whose inotify watch was lost is polled until it is back
+        if self._cert_check_timer is None and \
+                self.backend.cs.cert_monitor.needs_polling():
+            self._start_cert_check_timer()
+        return True
+
     def _on_sla_back_button_press(self):
         self._perform_unregister()
         self._register_item_clicked(None)
@@ -20,6 +20,7 @@ from rhsm import certificate
 
 from subscription_manager import certlib
 from subscription_manager import entcertlib
+from subscription_manager.cache import get_consumer_cache
 from subscription_manager import injection as inj
 
 log = logging.getLogger('rhsm-app.' + __name__)
@@ -72,7 +73,8 @@ class HealingUpdateAction(object):
         # inject
         identity = inj.require(inj.IDENTITY)
         uuid = identity.getConsumerId()
-        consumer = self.uep.getConsumer(uuid)
+        consumer_cache = get_consumer_cache()
+        consumer = consumer_cache.get_consumer(self.uep, uuid)
 
         if 'autoheal' not in consumer or not consumer['autoheal']:
             log.info("Auto-heal disabled on server, skipping.")
@@ -96,6 +98,7 @@ class HealingUpdateAction(object):
                         today)
                 self.plugin_manager.run("pre_auto_attach", consumer_uuid=uuid)
                 ents = self.uep.bind(uuid, today)
+                consumer_cache.invalidate(uuid)
                 self.plugin_manager.run("post_auto_attach", consumer_uuid=uuid,
                                         entitlement_data=ents)
 
@@ -116,6 +119,7 @@ class HealingUpdateAction(object):
                             tomorrow)
                     self.plugin_manager.run("pre_auto_attach", consumer_uuid=uuid)
                     ents = self.uep.bind(uuid, tomorrow)
+                    consumer_cache.invalidate(uuid)
                     self.plugin_manager.run("post_auto_attach", consumer_uuid=uuid,
                                             entitlement_data=ents)
                     self.report = cert_updater.update()
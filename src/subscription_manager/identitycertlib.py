@@ -17,6 +17,7 @@ import logging
 
 
 from subscription_manager import certlib
+from subscription_manager.cache import get_consumer_cache
 from subscription_manager import injection as inj
 
 log = logging.getLogger('rhsm-app.' + __name__)
@@ -86,5 +87,5 @@ class IdentityUpdateAction(object):
 
     def _get_consumer(self, identity):
         # FIXME: not much for error handling here
-        consumer = self.uep.getConsumer(identity.uuid)
+        consumer = get_consumer_cache().get_consumer(self.uep, identity.uuid)
         return consumer
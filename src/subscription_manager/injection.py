@@ -32,6 +32,8 @@ FACTS = "FACTS"
 PROFILE_MANAGER = "PROFILE_MANAGER"
 INSTALLED_PRODUCTS_MANAGER = "INSTALLED_PRODUCTS_MANAGER"
 RELEASE_STATUS_CACHE = "RELEASE_STATUS_CACHE"
+REPO_FINGERPRINT_CACHE = "REPO_FINGERPRINT_CACHE"
+CONSUMER_CACHE = "CONSUMER_CACHE"
 
 
 class FeatureBroker:
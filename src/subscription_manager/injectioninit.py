@@ -17,7 +17,8 @@ import subscription_manager.injection as inj
 
 from subscription_manager.cache import ProductStatusCache, \
     EntitlementStatusCache, OverrideStatusCache, ProfileManager, \
-    InstalledProductsManager, PoolTypeCache, ReleaseStatusCache
+    InstalledProductsManager, PoolTypeCache, ReleaseStatusCache, \
+    RepoFingerprintCache, ConsumerCache
 
 from subscription_manager.cert_sorter import CertSorter
 from subscription_manager.certdirectory import EntitlementDirectory
@@ -55,6 +56,8 @@ def init_dep_injection():
     inj.provide(inj.OVERRIDE_STATUS_CACHE, OverrideStatusCache, singleton=True)
     inj.provide(inj.RELEASE_STATUS_CACHE, ReleaseStatusCache,
                 singleton=False)
+    inj.provide(inj.REPO_FINGERPRINT_CACHE, RepoFingerprintCache, singleton=True)
+    inj.provide(inj.CONSUMER_CACHE, ConsumerCache, singleton=True)
 
     inj.provide(inj.PROFILE_MANAGER, ProfileManager, singleton=True)
     inj.provide(inj.INSTALLED_PRODUCTS_MANAGER, InstalledProductsManager, singleton=True)
@@ -22,20 +22,38 @@ log = logging.getLogger('rhsm-app.' + __name__)
 # be based on containers.abc.Iterable
 
 
+def intern_string(value):
+    """
+    Return the interned copy of value if it is a byte string, so repeated
+    values (content types, gpg urls, tags, cert paths) share one object.
+    """
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
 class Content(object):
     """
     A generic representation of entitled content.
+
+    There can be thousands of these, so they have no per instance dict.
     """
+    __slots__ = ('content_type', 'name', 'label', 'url', 'gpg', 'tags',
+                 'cert', 'enabled', 'metadata_expire')
+
     def __init__(self, content_type, name, label,
                  url=None, gpg=None, tags=None, cert=None,
                  enabled=None, metadata_expire=None):
-        self.content_type = content_type
+        self.content_type = intern_string(content_type)
         self.name = name
         self.label = label
 
         self.url = url
-        self.gpg = gpg
-        self.tags = tags or []
+        self.gpg = intern_string(gpg)
+        tags = tags or []
+        if isinstance(tags, list):
+            tags = [intern_string(tag) for tag in tags]
+        self.tags = tags
         self.cert = cert
         self.enabled = enabled
         self.metadata_expire = metadata_expire
@@ -55,15 +73,67 @@ class Entitlement(object):
         self.contents = contents
 
 
+class ContentIndex(object):
+    """
+    The content of a list of entitlements by lower cased content type,
+    each with its required tags as a frozenset.
+
+    find() results are kept per content type, as the installed product
+    tags they are matched against do not change.
+    """
+    def __init__(self, entitlements, product_tags):
+        self.product_tags = frozenset(product_tags)
+        self.by_type = {}
+        for entitlement in entitlements:
+            for content in entitlement.contents:
+                self.by_type.setdefault(content.content_type.lower(), []).append(
+                    (content, frozenset(content.tags)))
+        self._matches = {}
+
+    def find(self, content_type):
+        """
+        Return the content of the given type whose required tags are all
+        provided by installed products.
+        """
+        content_type = content_type.lower()
+        matches = self._matches.get(content_type)
+        if matches is None:
+            matches = [content for (content, tags) in self.by_type.get(content_type, [])
+                       if tags <= self.product_tags]
+            self._matches[content_type] = matches
+        return list(matches)
+
+
 class EntitlementSource(object):
     """Populate with info needed for plugins to find content.
 
     Acts as a iterable over entitlements.
     """
+    _content_index = None
+    # The entitlements and product tags the index was built from, with
+    # their lengths. Kept as references so their ids can not be reused.
+    _content_index_source = (None, 0, None, 0)
+
     def __init__(self):
         self._entitlements = []
         self.product_tags = []
 
+    def get_content_index(self):
+        """
+        Return the ContentIndex of these entitlements. It is built again if
+        the entitlements or product tags were replaced or resized.
+        """
+        entitlements, ent_count, product_tags, tag_count = self._content_index_source
+        if self._content_index is None or \
+                entitlements is not self._entitlements or \
+                ent_count != len(self._entitlements) or \
+                product_tags is not self.product_tags or \
+                tag_count != len(self.product_tags):
+            self._content_index = ContentIndex(self._entitlements, self.product_tags)
+            self._content_index_source = (self._entitlements, len(self._entitlements),
+                                          self.product_tags, len(self.product_tags))
+        return self._content_index
+
     def __iter__(self):
         return iter(self._entitlements)
 
@@ -81,15 +151,8 @@ def find_content(ent_source, content_type=None):
 
     Returns a list of model.Content.
     """
-    entitled_content = []
     log.debug("Searching for content of type: %s" % content_type)
-    for entitlement in ent_source:
-        for content in entitlement.contents:
-            # this is basically matching_content from repolib
-            if content.content_type.lower() == content_type.lower() and \
-                    content_tag_match(content.tags, ent_source.product_tags):
-                entitled_content.append(content)
-    return entitled_content
+    return ent_source.get_content_index().find(content_type)
 
 
 def content_tag_match(content_tags, product_tags):
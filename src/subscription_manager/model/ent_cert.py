@@ -19,6 +19,8 @@ from subscription_manager.model import Content, Entitlement, EntitlementSource
 
 
 class EntitlementCertContent(Content):
+    __slots__ = ()
+
     @classmethod
     def from_cert_content(cls, ent_cert_content, cert=None):
         """
@@ -60,6 +62,7 @@ class EntitlementDirEntitlementSource(EntitlementSource):
     """Populate with entitlement info from ent dir of ent certs."""
 
     def __init__(self):
+        super(EntitlementDirEntitlementSource, self).__init__()
         ent_dir = inj.require(inj.ENT_DIR)
         prod_dir = inj.require(inj.PROD_DIR)
 
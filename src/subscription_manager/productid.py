@@ -21,11 +21,14 @@ import logging
 import os
 import types
 import yum
+from yum.constants import TS_INSTALL_STATES, TS_REMOVE_STATES
 # for labelCompare
 import rpm
 
-from rhsm.certificate import create_from_pem
+from rhsm.certificate import create_from_pem, CertificateException
 
+from subscription_manager.cache import CacheManager, rpmdb_signature
+from subscription_manager import certindex
 from subscription_manager.certdirectory import Directory
 from subscription_manager.injection import PLUGIN_MANAGER, require
 
@@ -56,32 +59,304 @@ class ProductIdRepoMap(utils.DefaultDict):
         self.default_factory = list
 
 
-class ProductDatabase:
+def installed_package_index(rpmdb):
+    """
+    Return the set of (name, arch) of every installed package.
+
+    Built once from the rpmdb package tuples, so checking if a package
+    available from a repo is installed does not need a rpmdb search.
+    """
+    return set((name, arch) for (name, arch, epoch, ver, rel)
+               in rpmdb.simplePkgList())
+
+
+def find_active_repos(packages, installed):
+    """
+    Return the set of repo ids of packages that are installed.
+
+    packages are the available packages of the enabled repos, installed
+    is the (name, arch) index from installed_package_index.
+    """
+    active = set([])
+    for p in packages:
+        repo = p.repoid
+        # Once a repo is known to be active, the rest of its
+        # packages don't need to be looked at.
+        if repo in active:
+            continue
+
+        # The pkg is installed, so the repo it was installed
+        # from is considered 'active'
+        # yum on 5.7 list everything as "installed" instead
+        # of the repo it came from
+        if repo in (None, "installed"):
+            continue
+
+        # if a pkg is in multiple repo's, this will consider
+        # all the repo's with the pkg "active".
+        # NOTE: if a package is from a disabled repo, we won't
+        # find it with this, because 'packages' won't include it.
+        if (p.name, p.arch) not in installed:
+            # that pkg is not actually installed
+            #
+            # Effect of this is that a package that is only
+            # available from disabled repos, it is not considered
+            # an active package.
+            # If none of the packages from a repo are active, then
+            # the repo will not be considered active.
+            #
+            # Note however that packages that are installed, but
+            # from an disabled repo, but that are also available
+            # from another enabled repo will mark both repos as
+            # active. This is why add on repos that include base
+            # os packages almost never get marked for product cert
+            # deletion. Anything that could have possible come from
+            # that repo or be updated with makes the repo 'active'.
+            continue
+
+        active.add(repo)
+
+    return active
+
+
+class ActiveRepoCache(CacheManager):
+    """
+    The set of active repos, as found by ProductManager.get_active, along
+    with the rpmdb signature and enabled repo ids it was found for.
+
+    As long as neither changed, the active repos are the same.
+    """
+
+    CACHE_FILE = "/var/lib/rhsm/cache/active_repos.json"
+
+    def __init__(self):
+        self.rpmdb = None
+        self.repos = None
+        self.active = None
+        self._loaded = False
+
+    def to_dict(self):
+        return {'rpmdb': self.rpmdb,
+                'repos': self.repos,
+                'active': sorted(self.active)}
+
+    def _load_data(self, open_file):
+        return json.loads(open_file.read())
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        data = None
+        if self._cache_exists():
+            data = self._read_cache()
+        if data:
+            self.rpmdb = data.get('rpmdb')
+            self.repos = data.get('repos')
+            self.active = set(data.get('active', []))
+
+    def lookup(self, rpmdb, repos):
+        """
+        Return the cached active repos if they were found for this rpmdb
+        signature and list of enabled repo ids, otherwise None.
+        """
+        self._load()
+        if rpmdb is None or self.active is None:
+            return None
+        if self.rpmdb != rpmdb or self.repos != repos:
+            return None
+        return set(self.active)
+
+    def store(self, rpmdb, repos, active):
+        self._loaded = True
+        self.rpmdb = rpmdb
+        self.repos = repos
+        self.active = set(active)
+        if rpmdb is None:
+            return
+        try:
+            self.write_cache(debug=False)
+        except OSError, e:
+            # Most likely not running as root, the cache is only an
+            # optimization so carry on without it.
+            log.debug("Unable to write active repo cache %s: %s" % (self.CACHE_FILE, e))
+
+
+class ProductIdMetadataCache(CacheManager):
+    """
+    Product certs found in the productid metadata of repos, by repo id and
+    the checksum of that metadata listed in the repo's repomd.xml.
+
+    Repos whose productid metadata could not be loaded are recorded with
+    the error, so they are not retried until the metadata changes.
+    """
+
+    CACHE_FILE = "/var/lib/rhsm/cache/productid_metadata.json"
+
+    def __init__(self):
+        self._entries = None
+        self._seen = set()
+        self._dirty = False
+
+    def _get_entries(self):
+        if self._entries is None:
+            data = None
+            if self._cache_exists():
+                data = self._read_cache()
+            if not data or data.get('version') != certindex.INDEX_VERSION:
+                data = {'entries': {}}
+            self._entries = data['entries']
+        return self._entries
+
+    entries = property(_get_entries)
+
+    def to_dict(self):
+        return {'version': certindex.INDEX_VERSION, 'entries': self.entries}
+
+    def _load_data(self, open_file):
+        return json.loads(open_file.read())
+
+    def get(self, repo_id, checksum):
+        """
+        Return the cached (cert, error) for the productid metadata of a
+        repo with this checksum, or None if it is not cached.
+        """
+        self._seen.add(repo_id)
+        entry = self.entries.get(repo_id)
+        if entry is None or entry['checksum'] != checksum:
+            return None
+        if entry['error'] is not None:
+            return (None, entry['error'])
+        if entry['cert'] is None:
+            return (None, None)
+        try:
+            cert = certindex.decode_cert(entry['cert'])
+        except Exception, e:
+            log.debug("Ignoring bad productid metadata cache entry for %s: %s" % (repo_id, e))
+            return None
+        # Not read from a file, so keep the PEM for writing it out.
+        cert.__dict__['pem'] = entry['pem']
+        return (cert, None)
+
+    def set_cert(self, repo_id, checksum, cert):
+        self._seen.add(repo_id)
+        encoded = None
+        pem = None
+        if cert is not None:
+            try:
+                encoded = certindex.encode_cert(cert)
+            except certindex.UnindexableValue:
+                self.discard(repo_id)
+                return
+            # Only v3 certificates keep their PEM
+            pem = cert.pem or cert.x509.as_pem()
+        self.entries[repo_id] = {'checksum': checksum, 'cert': encoded,
+                                 'pem': pem, 'error': None}
+        self._dirty = True
+
+    def set_error(self, repo_id, checksum, error):
+        self._seen.add(repo_id)
+        self.entries[repo_id] = {'checksum': checksum, 'cert': None,
+                                 'pem': None, 'error': str(error)}
+        self._dirty = True
+
+    def discard(self, repo_id):
+        if self.entries.pop(repo_id, None) is not None:
+            self._dirty = True
+
+    def save(self):
+        """
+        Drop the entries of repos not looked up since the last save, and
+        write the cache if anything changed.
+        """
+        for repo_id in set(self.entries) - self._seen:
+            del self.entries[repo_id]
+            self._dirty = True
+        self._seen = set()
+
+        if not self._dirty:
+            return
+        try:
+            self.write_cache(debug=False)
+        except OSError, e:
+            # Most likely not running as root, the cache is only an
+            # optimization so carry on without it.
+            log.debug("Unable to write productid metadata cache %s: %s" % (self.CACHE_FILE, e))
+        self._dirty = False
+
+
+class ProductDatabase(object):
+    """
+    The productid.js map of product ids to the repos their product
+    certs were installed from.
+
+    The file is only parsed when the map is first used after read(), and
+    only written when it changed. Changes made between begin() and
+    commit() are written once, on commit().
+    """
 
     def __init__(self):
         self.dir = DatabaseDirectory()
-        self.content = ProductIdRepoMap()
+        self._content = ProductIdRepoMap()
+        self._needs_read = False
+        self._dirty = False
+        self._batch = False
         self.create()
 
+    def _get_content(self):
+        if self._needs_read:
+            self._needs_read = False
+            self._load()
+        return self._content
+
+    def _set_content(self, content):
+        self._needs_read = False
+        self._content = content
+
+    content = property(_get_content, _set_content)
+
     def add(self, product, repo):
         self.content[product].append(repo)
+        self._dirty = True
 
-    # TODO: need way to delete one prod->repo map
-    def delete(self, product):
-        try:
-            del self.content[product]
-        except Exception:
-            pass
+    def delete(self, product, repo=None):
+        """
+        Delete the repos of a product, or just the one given. The product
+        is dropped once it has no repos left.
+        """
+        repos = self.content.get(product)
+        if repos is None:
+            return
+        if repo is not None:
+            if repo not in repos:
+                return
+            repos.remove(repo)
+            if repos:
+                self._dirty = True
+                return
+        del self.content[product]
+        self._dirty = True
 
     def find_repos(self, product):
         return self.content.get(product, None)
 
     def create(self):
         if not os.path.exists(self.__fn()):
+            self._dirty = True
             self.write()
 
     def read(self):
-        f = open(self.__fn())
+        """Read the database again, the file is parsed on first use."""
+        self._content = ProductIdRepoMap()
+        self._needs_read = True
+        self._dirty = False
+
+    def _load(self):
+        try:
+            f = open(self.__fn())
+        except IOError, e:
+            log.debug("Unable to read product id database: %s" % e)
+            return
         try:
             d = json.load(f)
             # munge old format to new if need be
@@ -102,13 +377,27 @@ class ProductDatabase:
             else:
                 self.content[productid] = repo_data
 
+    def begin(self):
+        """Hold writes until commit()."""
+        self._batch = True
+
+    def commit(self):
+        self._batch = False
+        self.write()
+
     def write(self):
-        f = open(self.__fn(), 'w')
+        if self._batch or not self._dirty:
+            return
+
         try:
-            json.dump(self.content, f, indent=2, default=json.encode)
-        except Exception:
-            pass
-        f.close()
+            content = json.dumps(self.content, default=json.encode)
+        except Exception, e:
+            log.error("Unable to write product id database: %s" % e)
+            return
+        # Errors creating or renaming the file are raised, as opening the
+        # database for writing did before. The database stays dirty.
+        utils.write_file_atomic(self.__fn(), content, fsync=True)
+        self._dirty = False
 
     def __fn(self):
         return self.dir.abspath('productid.js')
@@ -316,7 +605,8 @@ class ProductManager:
     REPO = 'from_repo'
     PRODUCTID = 'productid'
 
-    def __init__(self, product_dir=None, product_db=None):
+    def __init__(self, product_dir=None, product_db=None, active_repo_cache=None,
+                 productid_cache=None):
 
         self.pdir = product_dir
         if not product_dir:
@@ -329,6 +619,14 @@ class ProductManager:
         self.db.read()
         self.meta_data_errors = []
 
+        self.active_repo_cache = active_repo_cache
+        if not active_repo_cache:
+            self.active_repo_cache = ActiveRepoCache()
+
+        self.productid_cache = productid_cache
+        if not productid_cache:
+            self.productid_cache = ProductIdMetadataCache()
+
         self.plugin_manager = require(PLUGIN_MANAGER)
 
     def find_temp_disabled_repos(self, enabled):
@@ -354,7 +652,14 @@ class ProductManager:
 
         return temp_disabled
 
-    def update(self, yb):
+    def update(self, yb, ts_info=None, rpmdb_before=None):
+        """
+        Install and remove product certs to match the enabled and active repos.
+
+        When called after a yum transaction, ts_info is the transaction and
+        rpmdb_before the rpmdb_signature from before it ran. They let the
+        cached active repos be updated with just the transaction members.
+        """
         # FIXME: finding enabled and finding active should
         #        be classes themselves that would be easier to mock
         #        ProductManager shouldn't know anything about YumBase
@@ -364,25 +669,30 @@ class ProductManager:
             yb = yum.YumBase()
 
         enabled = self.get_enabled(yb)
-        active = self.get_active(yb)
+        active = self.find_active(yb, ts_info, rpmdb_before)
 
         # populate the temp_disabled list so update_remove has it
         # this could likely happen later...
         temp_disabled_repos = self.find_temp_disabled_repos(enabled)
 
-        # only execute this on versions of yum that track
-        # which repo a package came from, aka, 3.2.28 and newer
-        if self._check_yum_version_tracks_repos():
-            # check that we have any repo's enabled
-            # and that we have some enabled repo's. Not just
-            # that we have packages from repo's that are
-            # not active. See #806457
-            if enabled and active:
-                self.update_removed(active, temp_disabled_repos)
-
-        # TODO: it would probably be useful to keep track of
-        # the state a bit, so we can report what we did
-        self.update_installed(enabled, active)
+        # write the product db once, for all the removals and installs
+        self.db.begin()
+        try:
+            # only execute this on versions of yum that track
+            # which repo a package came from, aka, 3.2.28 and newer
+            if self._check_yum_version_tracks_repos():
+                # check that we have any repo's enabled
+                # and that we have some enabled repo's. Not just
+                # that we have packages from repo's that are
+                # not active. See #806457
+                if enabled and active:
+                    self.update_removed(active, temp_disabled_repos)
+
+            # TODO: it would probably be useful to keep track of
+            # the state a bit, so we can report what we did
+            self.update_installed(enabled, active)
+        finally:
+            self.db.commit()
 
     def _check_yum_version_tracks_repos(self):
         major, minor, micro = yum.__version_info__
@@ -440,6 +750,7 @@ class ProductManager:
         products_to_install = []
         products_to_update_db = []
         products_installed = []
+        db_updated = False
 
         log.debug("active %s", active)
         log.debug("enabled %s", enabled)
@@ -484,7 +795,7 @@ class ProductManager:
                         pc.delete()
                         self.pdir.refresh()  # must refresh to see the removal of the cert
                         self.db.delete(pc.products[0].id)
-                        self.db.write()
+                        db_updated = True
 
             # if installing desktop cert, see if workstation exists on disk and skip
             # the write if so:
@@ -545,7 +856,6 @@ class ProductManager:
         products_to_update_db = self._desktop_workstation_cleanup(products_to_update_db)
         products_to_update = self._desktop_workstation_cleanup(products_to_update)
 
-        db_updated = False
         for (product, repo) in products_to_update_db:
             # known_repos is None means we have no repo info at all
             log.info("Updating product db with %s -> %s" % (product.id, repo))
@@ -598,9 +908,11 @@ class ProductManager:
             fn = '%s.pem' % product.id
             path = self.pdir.abspath(fn)
             cert.write(path)
-            self.pdir.refresh()
+            self.pdir.add_cert(cert)
             log.info("Installed product cert %s: %s %s" % (product.id, product.name, cert.path))
             products_installed.append(cert)
+        if products_installed:
+            self.pdir.save_index()
         return products_installed
 
     def _workstation_cert_exists(self):
@@ -735,6 +1047,8 @@ class ProductManager:
             # know anything about it's repos, it doesnt have any, or none
             # of the repos are active
             self.db.delete(product.id)
+
+        if certs_to_delete:
             self.db.write()
 
     # find the list of repo's that provide packages that
@@ -742,46 +1056,63 @@ class ProductManager:
     def get_active(self, yb):
         """find yum repos that have packages installed"""
 
-        active = set([])
-
         # If a package is in a enabled and 'protected' repo
 
         # This searches all the package sacks in this yum instances
         # package sack, aka all the enabled repos
         packages = yb.pkgSack.returnPackages()
 
-        for p in packages:
-            repo = p.repoid
-            # if a pkg is in multiple repo's, this will consider
-            # all the repo's with the pkg "active".
-            # NOTE: if a package is from a disabled repo, we won't
-            # find it with this, because 'packages' won't include it.
-            db_pkg = yb.rpmdb.searchNevra(name=p.name, arch=p.arch)
-            # that pkg is not actually installed
-            if not db_pkg:
-                # Effect of this is that a package that is only
-                # available from disabled repos, it is not considered
-                # an active package.
-                # If none of the packages from a repo are active, then
-                # the repo will not be considered active.
-                #
-                # Note however that packages that are installed, but
-                # from an disabled repo, but that are also available
-                # from another enabled repo will mark both repos as
-                # active. This is why add on repos that include base
-                # os packages almost never get marked for product cert
-                # deletion. Anything that could have possible come from
-                # that repo or be updated with makes the repo 'active'.
-                continue
+        return find_active_repos(packages, installed_package_index(yb.rpmdb))
 
-            # The pkg is installed, so the repo it was installed
-            # from is considered 'active'
-            # yum on 5.7 list everything as "installed" instead
-            # of the repo it came from
-            if repo in (None, "installed"):
-                continue
-            active.add(repo)
+    def find_active(self, yb, ts_info=None, rpmdb_before=None):
+        """
+        Find the active repos, reusing the cached set when the rpmdb
+        and enabled repos did not change since it was stored.
+        """
+        rpmdb = rpmdb_signature()
+        repos = sorted(repo.id for repo in yb.repos.listEnabled())
+
+        active = self.active_repo_cache.lookup(rpmdb, repos)
+        if active is not None:
+            log.debug("Installed packages and enabled repos unchanged, using cached active repos")
+            return active
+
+        if ts_info is not None:
+            before = self.active_repo_cache.lookup(rpmdb_before, repos)
+            if before is not None:
+                active = self.update_active(yb, before, ts_info)
 
+        if active is None:
+            active = self.get_active(yb)
+
+        self.active_repo_cache.store(rpmdb, repos, active)
+        return active
+
+    def update_active(self, yb, active, ts_info):
+        """
+        Update the active repos from before a transaction with the
+        packages it installed and removed.
+
+        Returns None if the transaction removed the last installed package
+        of a name and arch, the repos that provided it may no longer be
+        active, so they need to be found from scratch.
+        """
+        installed = set((m.name, m.arch) for m in
+                        ts_info.getMembersWithState(output_states=TS_INSTALL_STATES))
+        removed = set((m.name, m.arch) for m in
+                      ts_info.getMembersWithState(output_states=TS_REMOVE_STATES))
+        removed -= installed
+
+        if removed:
+            # Another version, like an older kernel, may still be installed
+            if removed - installed_package_index(yb.rpmdb):
+                return None
+
+        active = set(active)
+        for (name, arch) in installed:
+            for p in yb.pkgSack.searchNevra(name=name, arch=arch):
+                if p.repoid not in (None, "installed"):
+                    active.add(p.repoid)
         return active
 
     def get_enabled(self, yb):
@@ -791,9 +1122,23 @@ class ProductManager:
 
         # skip repo's that we don't have productid info for...
         for repo in enabled:
+            checksum = None
             try:
-                fn = repo.retrieveMD(self.PRODUCTID)
-                cert = self._get_cert(fn)
+                checksum = self._get_productid_checksum(repo)
+                cached = None
+                if checksum is not None:
+                    cached = self.productid_cache.get(repo.id, checksum)
+                if cached is not None:
+                    cert, error = cached
+                    if error is not None:
+                        log.warn("Error loading productid metadata for %s: %s" % (repo, error))
+                        self.meta_data_errors.append(repo.id)
+                        continue
+                else:
+                    fn = repo.retrieveMD(self.PRODUCTID)
+                    cert = self._get_cert(fn)
+                    if checksum is not None:
+                        self.productid_cache.set_cert(repo.id, checksum, cert)
                 if cert is None:
                     continue
                 lst.append((cert, repo.id))
@@ -801,16 +1146,42 @@ class ProductManager:
                 # We have to look in all repos for productids, not just
                 # the ones we create, or anaconda doesn't install it.
                 self.meta_data_errors.append(repo.id)
+            except CertificateException, e:
+                # The productid metadata itself is bad, it stays bad until
+                # the repo metadata changes.
+                log.warn("Error loading productid metadata for %s." % repo)
+                log.exception(e)
+                self.meta_data_errors.append(repo.id)
+                if checksum is not None:
+                    self.productid_cache.set_error(repo.id, checksum, e)
             except Exception, e:
+                # Network and IO errors are not cached, try again next time.
                 log.warn("Error loading productid metadata for %s." % repo)
                 log.exception(e)
                 self.meta_data_errors.append(repo.id)
 
+        self.productid_cache.save()
+
         if self.meta_data_errors:
             log.debug("Unable to load productid metadata for repos: %s",
                       self.meta_data_errors)
         return lst
 
+    def _get_productid_checksum(self, repo):
+        """
+        Return the checksum of the productid metadata from the repomd.xml
+        of a yum repo, or None if it is not known.
+
+        Raises RepoMDError if the repo has no productid metadata.
+        """
+        repo_xml = getattr(repo, 'repoXML', None)
+        if repo_xml is None:
+            return None
+        checksum = repo_xml.getData(self.PRODUCTID).checksum
+        if not checksum:
+            return None
+        return list(checksum)
+
     def _get_cert(self, fn):
         if fn.endswith('.gz'):
             f = GzipFile(fn)
@@ -16,6 +16,61 @@ import gettext
 _ = gettext.gettext
 
 
+class ReasonIndex(object):
+    """
+    Reasons and valid entitlement certs indexed by product, entitlement
+    and stack id, built in one pass over each.
+    """
+
+    def __init__(self, reasons, valid_entitlement_certs):
+        # stack id -> entitlement ids of the valid certs in that stack
+        self.stack_subscriptions = {}
+        # product id -> valid certs providing it
+        self.product_subscriptions = {}
+        # entitlement id -> reason messages, for valid certs only
+        self.subscription_reasons = {}
+
+        for cert in valid_entitlement_certs:
+            for product_id in set(product.id for product in cert.products):
+                self.product_subscriptions.setdefault(product_id, []).append(cert)
+
+            ent_id = (cert.subject or {}).get('CN')
+            if ent_id is None:
+                continue
+            self.subscription_reasons[ent_id] = []
+            if cert.order.stacking_id:
+                self.stack_subscriptions.setdefault(cert.order.stacking_id,
+                                                    set()).add(ent_id)
+
+        # reason messages by the id the reason applies to, as used by
+        # Reasons.get_product_reasons
+        self.product_messages = {}
+        self.entitlement_messages = {}
+        self.stack_messages = {}
+
+        for reason in reasons:
+            attrs = reason['attributes']
+            message = reason['message']
+            if 'product_id' in attrs:
+                self.product_messages.setdefault(attrs['product_id'], set()).add(message)
+            elif 'entitlement_id' in attrs:
+                self.entitlement_messages.setdefault(attrs['entitlement_id'], set()).add(message)
+            elif 'stack_id' in attrs:
+                self.stack_messages.setdefault(attrs['stack_id'], set()).add(message)
+
+            if 'entitlement_id' in attrs:
+                # Note there are no entries for any expired certs.
+                ent_ids = [attrs['entitlement_id']]
+            elif 'stack_id' in attrs:
+                ent_ids = self.stack_subscriptions.get(attrs['stack_id'], [])
+            else:
+                continue
+            for ent_id in ent_ids:
+                messages = self.subscription_reasons.get(ent_id)
+                if messages is not None and message not in messages:
+                    messages.append(message)
+
+
 class Reasons(object):
     """
     Holds reasons and parses them for
@@ -25,40 +80,38 @@ class Reasons(object):
     def __init__(self, reasons, sorter):
         self.reasons = reasons
         self.sorter = sorter
+        self._index = None
+        self._index_key = None
+
+    def _get_index(self):
+        """
+        Return the ReasonIndex for the current reasons and valid
+        entitlement certs.
+
+        Built on first use rather than here, as the sorter only scans
+        its entitlement certs after creating the Reasons.
+        """
+        valid_certs = self.sorter.valid_entitlement_certs
+        key = (id(self.reasons), len(self.reasons), id(valid_certs), len(valid_certs))
+        if self._index is None or self._index_key != key:
+            self._index = ReasonIndex(self.reasons, valid_certs)
+            self._index_key = key
+        return self._index
 
     def get_subscription_reasons(self, sub_id):
         """
         returns reasons for sub_id, or empty list
         if there are none.
         """
-        return self.get_subscription_reasons_map().get(sub_id, [])
+        return list(self._get_index().subscription_reasons.get(sub_id, []))
 
     def get_subscription_reasons_map(self):
         """
         returns a dictionary that maps
         valid entitlements to lists of reasons.
         """
-        result = {}
-        for s in self.sorter.valid_entitlement_certs:
-            result[s.subject['CN']] = []
-
-        for reason in self.reasons:
-            if 'entitlement_id' in reason['attributes']:
-                # Note 'result' won't have entries for any expired certs, so
-                # result['some_ent_that_has_expired'] could throw a KeyError
-                ent_id = reason['attributes']['entitlement_id']
-                if ent_id in result:
-                    if reason['message'] in result[ent_id]:
-                        continue
-
-                    result[ent_id].append(reason['message'])
-
-            elif 'stack_id' in reason['attributes']:
-                for s_id in self.get_stack_subscriptions(reason['attributes']['stack_id']):
-                    if reason['message'] in result[s_id]:
-                        continue
-                    result[s_id].append(reason['message'])
-        return result
+        return dict((ent_id, list(messages)) for (ent_id, messages) in
+                    self._get_index().subscription_reasons.items())
 
     def get_name_message_map(self):
         result = {}
@@ -72,11 +125,7 @@ class Reasons(object):
         return result
 
     def get_stack_subscriptions(self, stack_id):
-        result = set([])
-        for s in self.sorter.valid_entitlement_certs:
-            if s.order.stacking_id and s.order.stacking_id == stack_id:
-                result.add(s.subject['CN'])
-        return list(result)
+        return list(self._get_index().stack_subscriptions.get(stack_id, []))
 
     def get_reason_id(self, reason):
         # returns ent/prod/stack id
@@ -103,27 +152,13 @@ class Reasons(object):
         if prod.id in self.sorter.valid_products:
             return []
 
-        result = set([])
-        subscriptions = self.get_product_subscriptions(prod)
-
-        sub_ids = []
-        stack_ids = []
-
-        for s in subscriptions:
+        index = self._get_index()
+        result = set(index.product_messages.get(prod.id, []))
+        for s in self.get_product_subscriptions(prod):
             if 'CN' in s.subject:
-                sub_ids.append(s.subject['CN'])
+                result.update(index.entitlement_messages.get(s.subject['CN'], []))
             if s.order.stacking_id:
-                stack_ids.append(s.order.stacking_id)
-        for reason in self.reasons:
-            if 'product_id' in reason['attributes']:
-                if reason['attributes']['product_id'] == prod.id:
-                    result.add(reason['message'])
-            elif 'entitlement_id' in reason['attributes']:
-                if reason['attributes']['entitlement_id'] in sub_ids:
-                    result.add(reason['message'])
-            elif 'stack_id' in reason['attributes']:
-                if reason['attributes']['stack_id'] in stack_ids:
-                    result.add(reason['message'])
+                result.update(index.stack_messages.get(s.order.stacking_id, []))
         return list(result)
 
     def get_product_subscriptions(self, prod):
@@ -131,6 +166,7 @@ class Reasons(object):
         Returns a list of subscriptions that provide
         the product.
         """
-        results = [valid_ent for valid_ent in self.sorter.valid_entitlement_certs
-                if prod in valid_ent.products]
+        results = [valid_ent for valid_ent in
+                   self._get_index().product_subscriptions.get(prod.id, [])
+                   if prod in valid_ent.products]
         return results
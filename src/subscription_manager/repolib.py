@@ -16,18 +16,27 @@
 # in this software or its documentation.
 #
 
+import calendar
+from datetime import datetime
 import gettext
+import hashlib
 from iniparse import RawConfigParser as ConfigParser
 import logging
 import os
-import string
+import re
+import time
+from StringIO import StringIO
 import subscription_manager.injection as inj
-from subscription_manager.cache import OverrideStatusCache, WrittenOverrideCache
+from subscription_manager.cache import OverrideStatusCache, RepoFingerprintCache, \
+    WrittenOverrideCache
+from subscription_manager.certindex import stat_signature
 from subscription_manager import utils
 from subscription_manager import model
 from subscription_manager.model import ent_cert
 
+from rhsm.certificate import GMT
 from rhsm.config import initConfig
+from rhsm import ourjson as json
 
 # FIXME: local imports
 
@@ -183,7 +192,15 @@ class RepoUpdateActionCommand(object):
         self.ent_dir = inj.require(inj.ENT_DIR)
         self.prod_dir = inj.require(inj.PROD_DIR)
 
-        self.ent_source = ent_cert.EntitlementDirEntitlementSource()
+        self._ent_source = None
+
+        self.cache_only = cache_only
+        self.release_source = None
+
+        try:
+            self.repo_fingerprint = inj.require(inj.REPO_FINGERPRINT_CACHE)
+        except KeyError:
+            self.repo_fingerprint = RepoFingerprintCache()
 
         self.cp_provider = inj.require(inj.CP_PROVIDER)
         self.uep = self.cp_provider.get_consumer_auth_cp()
@@ -232,6 +249,18 @@ class RepoUpdateActionCommand(object):
                     self.overrides[item['contentLabel']] = {}
                 self.overrides[item['contentLabel']][item['name']] = item['value']
 
+    def _get_ent_source(self):
+        # Built on first use, it reads the content of every valid
+        # entitlement cert, which an unchanged fingerprint avoids.
+        if self._ent_source is None:
+            self._ent_source = ent_cert.EntitlementDirEntitlementSource()
+        return self._ent_source
+
+    def _set_ent_source(self, ent_source):
+        self._ent_source = ent_source
+
+    ent_source = property(_get_ent_source, _set_ent_source)
+
     def perform(self):
         # Load the RepoFile from disk, this contains all our managed yum repo sections:
         repo_file = RepoFile()
@@ -247,6 +276,14 @@ class RepoUpdateActionCommand(object):
                 RepoActionInvoker.delete_repo_file()
             return 0
 
+        # Nothing redhat.repo is generated from changed since it was
+        # written, and it was not changed either.
+        fingerprint = self.fingerprint()
+        if fingerprint is not None and self._fingerprint_matches(fingerprint, repo_file):
+            log.debug("Repo fingerprint unchanged, skipping update of: %s" %
+                    repo_file.path)
+            return self.report
+
         repo_file.read()
         valid = set()
 
@@ -258,9 +295,8 @@ class RepoUpdateActionCommand(object):
             if existing is None:
                 repo_file.add(cont)
                 self.report_add(cont)
-            else:
-                # Updates the existing repo with new content
-                self.update_repo(existing, cont)
+            # Updates the existing repo with new content
+            elif self.update_repo(existing, cont):
                 repo_file.update(existing)
                 self.report_update(existing)
 
@@ -275,9 +311,96 @@ class RepoUpdateActionCommand(object):
             # Update with the values we just wrote
             self.written_overrides.overrides = self.overrides
             self.written_overrides.write_cache()
+        if fingerprint is not None:
+            self.repo_fingerprint.write([fingerprint, repo_file.stat_signature(),
+                                         self._next_validity_change()])
         log.info("repos updated: %s" % self.report)
         return self.report
 
+    def fingerprint(self):
+        """
+        Return a digest of everything redhat.repo is generated from: the
+        entitlement and product cert directories, overrides, the release
+        and rhsm config.
+
+        The cert directories are only stat'ed and nothing is parsed. Unless
+        cache_only is set, the release is asked from the server, through
+        the same release source the repos are expanded with, so it is only
+        fetched once. Which certs are valid also changes with time, see
+        _next_validity_change().
+        """
+        release = None
+        if self.cache_only or not self.identity.is_valid():
+            release_cache = inj.require(inj.RELEASE_STATUS_CACHE)
+            if release_cache._cache_exists():
+                release = release_cache._read_cache()
+        else:
+            release = self._get_release_source().get_expansion()
+
+        overrides = None
+        if self.override_supported and self.apply_overrides:
+            overrides = self.overrides
+
+        config_file = None
+        if CFG.config_file:
+            try:
+                config_file = stat_signature(CFG.config_file)
+            except OSError:
+                pass
+
+        config = [config_file,
+                  self.manage_repos,
+                  CFG.get('rhsm', 'baseurl'),
+                  CFG.get('rhsm', 'repo_ca_cert'),
+                  CFG.get('server', 'proxy_hostname'),
+                  CFG.get('server', 'proxy_port'),
+                  CFG.get('server', 'proxy_user'),
+                  CFG.get('server', 'proxy_password')]
+
+        inputs = [self.ent_dir.signature(),
+                  self.prod_dir.signature(),
+                  overrides,
+                  self.written_overrides.overrides,
+                  release,
+                  config]
+        try:
+            data = json.dumps(inputs, sort_keys=True)
+        except (TypeError, ValueError), e:
+            log.debug("Unable to fingerprint repo inputs: %s" % e)
+            return None
+        return hashlib.sha256(data).hexdigest()
+
+    def _fingerprint_matches(self, fingerprint, repo_file):
+        cached = self.repo_fingerprint.read()
+        if not cached or len(cached) != 3:
+            return False
+        cached_fingerprint, repo_file_signature, valid_until = cached
+        if valid_until is not None and time.time() >= valid_until:
+            # A cert started or stopped being valid since
+            return False
+        return [cached_fingerprint, repo_file_signature] == \
+            [fingerprint, repo_file.stat_signature()]
+
+    def _next_validity_change(self):
+        """
+        Return the time, in seconds since the epoch, at which the next
+        entitlement or product cert starts or stops being valid, or None.
+        """
+        now = datetime.now(GMT())
+        changes = []
+        for cert in self.ent_dir.list() + self.prod_dir.list():
+            for date in (cert.valid_range.begin(), cert.valid_range.end()):
+                if date > now:
+                    changes.append(date)
+        if not changes:
+            return None
+        return calendar.timegm(min(changes).utctimetuple())
+
+    def _get_release_source(self):
+        if self.release_source is None:
+            self.release_source = YumReleaseverSource()
+        return self.release_source
+
     def get_unique_content(self):
         # FIXME Shouldn't this skip all of the repo updating?
         if not self.manage_repos:
@@ -311,11 +434,10 @@ class RepoUpdateActionCommand(object):
         # wait until we know we have content before fetching
         # release. We could make YumReleaseverSource understand
         # cache_only as well.
-        release_source = YumReleaseverSource()
+        context = RepoBuildContext(baseurl, ca_cert, self._get_release_source())
 
         for content in matching_content:
-            repo = Repo.from_ent_cert_content(content, baseurl, ca_cert,
-                                              release_source)
+            repo = Repo.from_content(content, context)
 
             # overrides are yum repo only at the moment, but
             # content sources will likely need to learn how to
@@ -335,63 +457,63 @@ class RepoUpdateActionCommand(object):
 
         return repo
 
-    def _is_overridden(self, repo, key):
-        return key in self.overrides.get(repo.id, {})
-
-    def _was_overridden(self, repo, key, value):
-        written_value = self.written_overrides.overrides.get(repo.id, {}).get(key)
-        # Compare values as strings to avoid casting problems from io
-        return written_value is not None and value is not None and str(written_value) == str(value)
-
-    def _build_props(self, old_repo, new_repo):
-        result = {}
-        all_keys = old_repo.keys() + new_repo.keys()
-        for key in all_keys:
-            result[key] = Repo.PROPERTIES.get(key, (1, None))
-        return result
-
-    def update_repo(self, old_repo, new_repo):
+    def diff_repo(self, old_repo, new_repo):
         """
-        Checks an existing repo definition against a potentially updated
-        version created from most recent entitlement certificates and
-        configuration. Creates, updates, and removes properties as
-        appropriate and returns the number of changes made. (if any)
+        Return the changes needed to bring an existing repo definition in
+        line with one created from the most recent entitlement certificates
+        and configuration, as a list of (key, value) pairs. A value of None
+        means the key is to be removed.
         """
-        changes_made = 0
+        overrides = self.overrides.get(old_repo.id, {})
+        written_overrides = self.written_overrides.overrides.get(old_repo.id, {})
 
-        for key, (mutable, default) in self._build_props(old_repo, new_repo).items():
+        keys = list(old_repo)
+        keys.extend([key for key in new_repo if key not in old_repo])
+
+        changes = []
+        for key in keys:
             new_val = new_repo.get(key)
+            old_val = old_repo.get(key)
 
             # Mutable properties should be added if not currently defined,
             # otherwise left alone. However if we see that the property was overridden
             # but that override has since been removed, we need to revert to the default
-            # value.
-            if mutable and not self._is_overridden(old_repo, key) \
-                    and not self._was_overridden(old_repo, key, old_repo.get(key)):
-                if (new_val is not None) and (not old_repo.get(key)):
-                    if old_repo.get(key) == new_val:
-                        continue
-                    old_repo[key] = new_val
-                    changes_made += 1
+            # value. Compare override values as strings to avoid casting problems from io.
+            written_val = written_overrides.get(key)
+            was_overridden = written_val is not None and old_val is not None and \
+                str(written_val) == str(old_val)
+            if key not in Repo.IMMUTABLE_PROPERTIES and key not in overrides \
+                    and not was_overridden:
+                if (new_val is not None) and (not old_val) and old_val != new_val:
+                    changes.append((key, new_val))
 
             # Immutable properties should be always be added/updated,
             # and removed if undefined in the new repo definition.
-            else:
-                if new_val is None or (str(new_val).strip() == ""):
-                    # Immutable property should be removed:
-                    if key in old_repo.keys():
-                        del old_repo[key]
-                        changes_made += 1
-                    continue
+            elif new_val is None or (str(new_val).strip() == ""):
+                # Immutable property should be removed, unless it has
+                # no value that would be written out anyway:
+                if old_val:
+                    changes.append((key, None))
 
-                # Unchanged:
-                if old_repo.get(key) == new_val:
-                    continue
+            elif old_val != new_val:
+                changes.append((key, new_val))
 
-                old_repo[key] = new_val
-                changes_made += 1
+        return changes
 
-        return changes_made
+    def update_repo(self, old_repo, new_repo):
+        """
+        Checks an existing repo definition against a potentially updated
+        version created from most recent entitlement certificates and
+        configuration. Creates, updates, and removes properties as
+        appropriate and returns the changes made, as from diff_repo.
+        """
+        changes = self.diff_repo(old_repo, new_repo)
+        for key, value in changes:
+            if value is None:
+                del old_repo[key]
+            else:
+                old_repo[key] = value
+        return changes
 
     def report_update(self, repo):
         self.report.repo_updates.append(repo)
@@ -455,7 +577,83 @@ class RepoActionReport(ActionReport):
         return '\n'.join(s)
 
 
+# Anything yum does not expect in a repo id
+_INVALID_REPO_ID_CHARS = re.compile(r'[^a-zA-Z0-9\-_.:]')
+
+
+class RepoBuildContext(object):
+    """
+    Everything the repos of one update have in common.
+
+    The proxy settings are read from the config once, $releasever is
+    expanded at most once, and the gpg key url and client cert paths
+    are resolved once for all the content sets sharing them. Those are
+    interned, so repos built by later updates share them as well.
+    """
+    def __init__(self, baseurl, ca_cert, release_source):
+        self.baseurl = baseurl
+        self.ca_cert = ca_cert
+        self.release_source = release_source
+        self._expansion = None
+
+        proxy = ""
+        proxy_host = CFG.get('server', 'proxy_hostname')
+        # proxy_port as string is fine here
+        proxy_port = CFG.get('server', 'proxy_port')
+        if proxy_host != "":
+            proxy = "https://%s" % proxy_host
+            if proxy_port != "":
+                proxy = "%s:%s" % (proxy, proxy_port)
+        self.proxy = model.intern_string(proxy)
+        self.proxy_username = CFG.get('server', 'proxy_user')
+        self.proxy_password = CFG.get('server', 'proxy_password')
+
+        # gpg url -> joined url, shared by every repo using it
+        self._gpg_keys = {}
+        # id(cert) -> (cert, (key path, cert path))
+        self._cert_paths = {}
+
+    def expand_releasever(self, contenturl):
+        marker = self.release_source.marker
+        # no $releasever to expand
+        if marker not in contenturl:
+            return contenturl
+
+        if self._expansion is None:
+            self._expansion = self.release_source.get_expansion()
+
+        # NOTE: This is building a url from external info
+        #       so likely needs more validation. In our case, the
+        #       external source is trusted (release list from tls
+        #       mutually authed cdn, or a tls mutual auth api)
+        # NOTE: The on disk cache is more vulnerable, since it is
+        #       trusted.
+        return contenturl.replace(marker, self._expansion)
+
+    def join(self, url):
+        return utils.url_base_join(self.baseurl, url)
+
+    def gpg_key(self, gpg_url):
+        gpg_key = self._gpg_keys.get(gpg_url)
+        if gpg_key is None:
+            gpg_key = self._gpg_keys[gpg_url] = model.intern_string(self.join(gpg_url))
+        return gpg_key
+
+    def cert_paths(self, cert):
+        """Return the key and cert paths of an entitlement cert."""
+        entry = self._cert_paths.get(id(cert))
+        if entry is None:
+            # The cert is kept, so its id is not reused
+            entry = self._cert_paths[id(cert)] = (cert, (model.intern_string(cert.key_path()),
+                                                         model.intern_string(cert.path)))
+        return entry[1]
+
+
 class Repo(dict):
+    # Only the id and key order are kept as attributes, there can be
+    # thousands of these.
+    __slots__ = ('id', '_order')
+
     # (name, mutable, default) - The mutability information is only used in disconnected cases
     PROPERTIES = {
             'name': (0, None),
@@ -473,6 +671,10 @@ class Repo(dict):
             'proxy_password': (0, None),
             'ui_repoid_vars': (0, None)}
 
+    # Properties not listed above are mutable
+    IMMUTABLE_PROPERTIES = frozenset(key for key, (mutable, default) in
+                                     PROPERTIES.items() if not mutable)
+
     def __init__(self, repo_id, existing_values=None):
         # existing_values is a list of 2-tuples
         existing_values = existing_values or []
@@ -492,7 +694,7 @@ class Repo(dict):
         # they are not defined on disk. i.e. these properties will always
         # appear in this dict, but their values may be None.
         for k, (m, d) in self.PROPERTIES.items():
-            if k not in self.keys():
+            if k not in self:
                 self[k] = d
 
     @classmethod
@@ -502,6 +704,16 @@ class Repo(dict):
         And the other out of band info we need including baseurl, ca_cert, and
         the release version string.
         """
+        return cls.from_content(content,
+                                RepoBuildContext(baseurl, ca_cert, release_source))
+
+    @classmethod
+    def from_content(cls, content, context):
+        """Create an instance of Repo() from an ent_cert.EntitlementCertContent().
+
+        Everything that is the same for all repos comes from context, a
+        RepoBuildContext shared by all the repos of one update.
+        """
         repo = cls(content.label)
 
         repo['name'] = content.name
@@ -511,8 +723,7 @@ class Repo(dict):
         else:
             repo['enabled'] = "0"
 
-        expanded_url_path = Repo._expand_releasever(release_source, content.url)
-        repo['baseurl'] = utils.url_base_join(baseurl, expanded_url_path)
+        repo['baseurl'] = context.join(context.expand_releasever(content.url))
 
         # Extract the variables from the url
         repo_parts = repo['baseurl'].split("/")
@@ -526,71 +737,27 @@ class Repo(dict):
             repo['gpgkey'] = ""
             repo['gpgcheck'] = '0'
         else:
-            repo['gpgkey'] = utils.url_base_join(baseurl, gpg_url)
+            repo['gpgkey'] = context.gpg_key(gpg_url)
             # Leave gpgcheck as the default of 1
 
-        repo['sslclientkey'] = content.cert.key_path()
-        repo['sslclientcert'] = content.cert.path
-        repo['sslcacert'] = ca_cert
+        repo['sslclientkey'], repo['sslclientcert'] = context.cert_paths(content.cert)
+        repo['sslcacert'] = context.ca_cert
         repo['metadata_expire'] = content.metadata_expire
 
-        repo = Repo._set_proxy_info(repo)
-
-        return repo
-
-    @staticmethod
-    def _set_proxy_info(repo):
-        proxy = ""
-
-        # Worth passing in proxy config info to from_ent_cert_content()?
-        # That would decouple Repo some
-        proxy_host = CFG.get('server', 'proxy_hostname')
-        # proxy_port as string is fine here
-        proxy_port = CFG.get('server', 'proxy_port')
-        if proxy_host != "":
-            proxy = "https://%s" % proxy_host
-            if proxy_port != "":
-                proxy = "%s:%s" % (proxy, proxy_port)
-
+        repo['proxy'] = context.proxy
         # These could be empty string, in which case they will not be
         # set in the yum repo file:
-        repo['proxy'] = proxy
-        repo['proxy_username'] = CFG.get('server', 'proxy_user')
-        repo['proxy_password'] = CFG.get('server', 'proxy_password')
+        repo['proxy_username'] = context.proxy_username
+        repo['proxy_password'] = context.proxy_password
 
         return repo
 
-    @staticmethod
-    def _expand_releasever(release_source, contenturl):
-        # no $releasever to expand
-        if release_source.marker not in contenturl:
-            return contenturl
-
-        expansion = release_source.get_expansion()
-
-        # NOTE: This is building a url from external info
-        #       so likely needs more validation. In our case, the
-        #       external source is trusted (release list from tls
-        #       mutually authed cdn, or a tls mutual auth api)
-        # NOTE: The on disk cache is more vulnerable, since it is
-        #       trusted.
-        return contenturl.replace(release_source.marker,
-                                  expansion)
-
     def _clean_id(self, repo_id):
         """
         Format the config file id to contain only characters that yum expects
         (we'll just replace 'bad' chars with -)
         """
-        new_id = ""
-        valid_chars = string.ascii_letters + string.digits + "-_.:"
-        for byte in repo_id:
-            if byte not in valid_chars:
-                new_id += '-'
-            else:
-                new_id += byte
-
-        return new_id
+        return _INVALID_REPO_ID_CHARS.sub('-', repo_id)
 
     def items(self):
         """
@@ -629,48 +796,19 @@ class Repo(dict):
         return hash(self.id)
 
 
-class TidyWriter:
+# Runs of empty lines, at the start of the text or after a line
+_EMPTY_LINES = re.compile(r'^\n+', re.MULTILINE)
 
-    """
-    ini file reader that removes successive newlines,
-    and adds a trailing newline to the end of a file.
 
-    used to keep our repo file clean after removals and additions of
-    new sections, as iniparser's tidy function is not available in all
-    versions.
+def tidy(text):
     """
-
-    def __init__(self, backing_file):
-        self.backing_file = backing_file
-        self.ends_with_newline = False
-        self.writing_empty_lines = False
-
-    def write(self, line):
-        lines = line.split("\n")
-        i = 0
-        while i < len(lines):
-            line = lines[i]
-            if line == "":
-                if i != len(lines) - 1:
-                    if not self.writing_empty_lines:
-                        self.backing_file.write("\n")
-                    self.writing_empty_lines = True
-            else:
-                self.writing_empty_lines = False
-                self.backing_file.write(line)
-                if i != len(lines) - 1:
-                    self.backing_file.write("\n")
-
-            i += 1
-
-        if lines[-1] == "":
-            self.ends_with_newline = True
-        else:
-            self.ends_with_newline = False
-
-    def close(self):
-        if not self.ends_with_newline:
-            self.backing_file.write("\n")
+    Remove successive empty lines from text, and make sure it ends
+    with a newline.
+    """
+    text = _EMPTY_LINES.sub("\n", text)
+    if text and not text.endswith("\n"):
+        text += "\n"
+    return text
 
 
 class RepoFile(ConfigParser):
@@ -682,6 +820,8 @@ class RepoFile(ConfigParser):
         # note PATH get's expanded with chroot info, etc
         self.path = Path.join(self.PATH, name)
         self.repos_dir = Path.abs(self.PATH)
+        # contents of the file as of the last read() or write()
+        self._on_disk = None
         self.manage_repos = 1
         if CFG.has_option('rhsm', 'manage_repos'):
             self.manage_repos = CFG.get_int('rhsm', 'manage_repos')
@@ -703,38 +843,49 @@ class RepoFile(ConfigParser):
         return self.path_exists(self.path)
 
     def read(self):
-        ConfigParser.read(self, self.path)
-
-    def _configparsers_equal(self, otherparser):
-        if set(otherparser.sections()) != set(self.sections()):
-            return False
+        # Keep what was read, so write() can tell if anything changed
+        # without reading and parsing the file again.
+        try:
+            f = open(self.path)
+        except IOError:
+            # Like ConfigParser.read, a missing file is just empty.
+            self._on_disk = None
+            return
+        try:
+            self._on_disk = f.read()
+        finally:
+            f.close()
+        self.readfp(StringIO(self._on_disk), self.path)
 
-        for section in self.sections():
-            # Sometimes we end up with ints, but values must be strings to compare
-            current_items = dict([(str(k), str(v)) for (k, v) in self.items(section)])
-            if current_items != dict(otherparser.items(section)):
-                return False
-        return True
+    def stat_signature(self):
+        """Return the stat signature of the file, or None if it is missing."""
+        try:
+            return stat_signature(self.path)
+        except OSError:
+            return None
 
-    def _has_changed(self):
-        '''
-        Check if the version on disk is different from what we have loaded
-        '''
-        on_disk = ConfigParser()
-        on_disk.read(self.path)
-        return not self._configparsers_equal(on_disk)
+    def render(self):
+        """Return the contents of the repo file as it would be written."""
+        return tidy(str(self.data))
 
     def write(self):
         if not self.manage_repos:
             log.debug("Skipping write due to manage_repos setting: %s" %
                     self.path)
             return
-        if self._has_changed():
-            f = open(self.path, 'w')
-            tidy_writer = TidyWriter(f)
-            ConfigParser.write(self, tidy_writer)
-            tidy_writer.close()
-            f.close()
+
+        rendered = self.render()
+        if rendered == self._on_disk:
+            return
+        # The file was missing and there is nothing to write, don't
+        # leave an empty file behind.
+        if not rendered and self._on_disk is None:
+            return
+
+        # yum never sees a partly written file, and ignores the temp file
+        # as it does not end in .repo.
+        utils.write_file_atomic(self.path, rendered)
+        self._on_disk = rendered
 
     def add(self, repo):
         self.add_section(repo.id)
@@ -24,6 +24,7 @@ import sys
 import signal
 import socket
 import syslog
+import tempfile
 import urllib
 
 from M2Crypto.SSL import SSLError
@@ -333,6 +334,53 @@ def chroot(dirname):
     Path.ROOT = dirname
 
 
+def write_temp_file(path, content, mode=None, dir=None, fsync=False):
+    """
+    Write content to a new temp file that is to be renamed to path, and
+    return the path of the temp file.
+
+    The temp file is created next to path, or in dir, which must be on the
+    same filesystem. It gets mode, or the mode of path if that exists, or
+    0644 otherwise. If fsync is True, the content is flushed to disk before
+    returning, so a rename can not leave an empty file after a crash.
+    """
+    if mode is None:
+        try:
+            mode = os.stat(path).st_mode & 07777
+        except OSError:
+            mode = 0644
+    fd, tmp_path = tempfile.mkstemp(prefix='.%s-' % os.path.basename(path),
+                                    dir=dir or os.path.dirname(path))
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            f.write(content)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.chmod(tmp_path, mode)
+    except:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path
+
+
+def write_file_atomic(path, content, mode=None, fsync=False):
+    """
+    Write content to a temp file next to path and rename it into place,
+    so readers never see a partly written file. See write_temp_file()
+    for the mode the file gets and fsync.
+    """
+    tmp_path = write_temp_file(path, content, mode, fsync=fsync)
+    try:
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
 class CertificateFilter(object):
     def match(self, cert):
         """
@@ -20,6 +20,7 @@ from contextlib import contextmanager
 
 import stubs
 import subscription_manager.injection as inj
+from subscription_manager.cache import ConsumerCache
 
 # use instead of the normal pid file based ActionLock
 from threading import RLock
@@ -131,6 +132,8 @@ class SubManFixture(unittest.TestCase):
         inj.provide(inj.PROD_STATUS_CACHE, stubs.StubProductStatusCache())
         inj.provide(inj.OVERRIDE_STATUS_CACHE, stubs.StubOverrideStatusCache())
         inj.provide(inj.RELEASE_STATUS_CACHE, stubs.StubReleaseStatusCache())
+        inj.provide(inj.REPO_FINGERPRINT_CACHE, stubs.StubRepoFingerprintCache())
+        inj.provide(inj.CONSUMER_CACHE, ConsumerCache())
         inj.provide(inj.PROFILE_MANAGER, stubs.StubProfileManager())
         # By default set up an empty stub entitlement and product dir.
         # Tests need to modify or create their own but nothing should hit
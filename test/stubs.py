@@ -22,7 +22,8 @@ import tempfile
 from rhsm import config
 from subscription_manager.cert_sorter import CertSorter
 from subscription_manager.cache import EntitlementStatusCache, ProductStatusCache, \
-        OverrideStatusCache, ProfileManager, InstalledProductsManager, ReleaseStatusCache
+        OverrideStatusCache, ProfileManager, InstalledProductsManager, ReleaseStatusCache, \
+        RepoFingerprintCache
 from subscription_manager.facts import Facts
 from subscription_manager.lock import ActionLock
 from rhsm.certificate import GMT
@@ -299,6 +300,16 @@ class StubCertificateDirectory(EntitlementDirectory):
         """
         return True
 
+    # tests manage self.certs themselves
+    def add_cert(self, cert):
+        pass
+
+    def save_index(self):
+        pass
+
+    def signature(self):
+        return sorted([str(cert.serial), cert.path] for cert in self.certs)
+
     def getCerts(self):
         return self.certs
 
@@ -329,7 +340,7 @@ class StubProductDirectory(StubCertificateDirectory, ProductDirectory):
 
     # real version just calls refresh on it's set of ProductDirs, that don't
     # exist here, so this needs to be stubbed.
-    def refresh(self):
+    def refresh(self, changes=None):
         pass
 
 
@@ -582,6 +593,9 @@ class StubCPProvider(object):
     def get_consumer_auth_cp(self):
         return self.consumer_auth_cp
 
+    def create_consumer_auth_cp(self):
+        return self.consumer_auth_cp
+
     def get_basic_auth_cp(self):
         return self.basic_auth_cp
 
@@ -628,6 +642,18 @@ class StubReleaseStatusCache(ReleaseStatusCache):
         self.server_status = None
 
 
+class StubRepoFingerprintCache(RepoFingerprintCache):
+
+    def _cache_exists(self):
+        return False
+
+    def write_cache(self, debug=True):
+        pass
+
+    def delete_cache(self):
+        self.fingerprint = None
+
+
 class StubPool(object):
 
     def __init__(self, poolid):
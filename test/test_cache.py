@@ -18,8 +18,10 @@ import random
 import shutil
 import socket
 import tempfile
-import time
-from mock import Mock
+import threading
+import httplib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from mock import Mock, patch
 
 # used to get a user readable cfg class for test cases
 from stubs import StubProduct, StubProductCertificate, StubCertificateDirectory, \
@@ -29,12 +31,15 @@ from fixture import SubManFixture
 from rhsm import ourjson as json
 from subscription_manager.cache import ProfileManager, \
         InstalledProductsManager, EntitlementStatusCache, \
-        PoolTypeCache, ReleaseStatusCache
+        PoolTypeCache, ReleaseStatusCache, ProductStatusCache, ConsumerCache, \
+        PersistenceQueue, persistence_queue, profile_digest
 
 from rhsm.profile import Package, RPMProfile
 
+from rhsm import connection
 from rhsm.connection import RestlibException, UnauthorizedException
 
+from subscription_manager import cacheformat
 from subscription_manager import injection as inj
 
 log = logging.getLogger(__name__)
@@ -152,6 +157,136 @@ class TestProfileManager(unittest.TestCase):
         self.assertTrue(self.profile_mgr.has_changed())
         self.profile_mgr._read_cache.assert_called_with()
 
+    def _cache_file(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.profile_mgr.CACHE_FILE = os.path.join(cache_dir, 'packages.cache')
+        return self.profile_mgr.CACHE_FILE
+
+    def test_write_compact_cache(self):
+        cache_file = self._cache_file()
+        self.profile_mgr.write_cache()
+        self.assertTrue(cacheformat.is_compact(open(cache_file)))
+        self.assertEquals(self.current_profile, self.profile_mgr._read_cache())
+        self.assertFalse(self.profile_mgr.has_changed())
+
+    def test_read_json_cache(self):
+        cache_file = self._cache_file()
+        json_file = os.path.join(os.path.dirname(cache_file), 'packages.json')
+        f = open(json_file, 'w')
+        json.dump(self.current_profile.collect(), f)
+        f.close()
+        self.assertFalse(self.profile_mgr.has_changed())
+
+        # and is migrated on the next write
+        self.profile_mgr.write_cache()
+        self.assertTrue(cacheformat.is_compact(open(cache_file)))
+        self.assertFalse(os.path.exists(json_file))
+        self.assertFalse(self.profile_mgr.has_changed())
+
+    def test_delete_cache_removes_json_cache(self):
+        cache_file = self._cache_file()
+        self.profile_mgr.write_cache()
+        json_file = os.path.join(os.path.dirname(cache_file), 'packages.json')
+        open(json_file, 'w').close()
+        with patch.object(ProfileManager, 'CACHE_FILE', cache_file):
+            ProfileManager.delete_cache()
+        self.assertEquals([], os.listdir(os.path.dirname(cache_file)))
+
+    def test_corrupt_compact_cache(self):
+        cache_file = self._cache_file()
+        self.profile_mgr.write_cache()
+        buf = open(cache_file).read()
+        f = open(cache_file, 'w')
+        f.write(buf[:-1])
+        f.close()
+        self.assertEquals(None, self.profile_mgr._read_cache())
+        os.remove(self.profile_mgr._digest_file(cache_file))
+        self.assertTrue(self.profile_mgr.has_changed())
+
+    def test_digest_written_with_cache(self):
+        self._cache_file()
+        self.profile_mgr.write_cache()
+        self.profile_mgr._read_cache = Mock()
+        self.assertFalse(self.profile_mgr.has_changed())
+
+        self.profile_mgr.current_profile = self._mock_pkg_profile([
+                Package(name="package1", version="1.0.1", release=1, arch="x86_64")])
+        self.assertTrue(self.profile_mgr.has_changed())
+        self.assertEquals(0, self.profile_mgr._read_cache.call_count)
+
+    def test_digest_recorded_for_cache_without_one(self):
+        cache_file = self._cache_file()
+        f = open(os.path.join(os.path.dirname(cache_file), 'packages.json'), 'w')
+        json.dump(self.current_profile.collect(), f)
+        f.close()
+        self.assertFalse(self.profile_mgr.has_changed())
+        self.assertTrue(os.path.exists(self.profile_mgr._digest_file(cache_file)))
+
+        self.profile_mgr._read_cache = Mock()
+        self.assertFalse(self.profile_mgr.has_changed())
+        self.assertEquals(0, self.profile_mgr._read_cache.call_count)
+
+    def _rpmdb_profile_mgr(self, cache_file):
+        profile_mgr = ProfileManager()
+        profile_mgr.CACHE_FILE = cache_file
+        profile_mgr._get_profile = Mock(return_value=self.current_profile)
+        return profile_mgr
+
+    @patch('subscription_manager.cache.rpmdb_signature')
+    def test_unchanged_rpmdb_not_read(self, mock_rpmdb_signature):
+        mock_rpmdb_signature.return_value = ['Packages', 1, 2, 3]
+        cache_file = self._cache_file()
+        self._rpmdb_profile_mgr(cache_file).write_cache()
+
+        profile_mgr = self._rpmdb_profile_mgr(cache_file)
+        self.assertFalse(profile_mgr.has_changed())
+        self.assertEquals(0, profile_mgr._get_profile.call_count)
+
+    @patch('subscription_manager.cache.rpmdb_signature')
+    def test_changed_rpmdb_same_packages(self, mock_rpmdb_signature):
+        mock_rpmdb_signature.return_value = ['Packages', 1, 2, 3]
+        cache_file = self._cache_file()
+        self._rpmdb_profile_mgr(cache_file).write_cache()
+
+        mock_rpmdb_signature.return_value = ['Packages', 1, 5, 3]
+        profile_mgr = self._rpmdb_profile_mgr(cache_file)
+        self.assertFalse(profile_mgr.has_changed())
+        self.assertEquals(1, profile_mgr._get_profile.call_count)
+
+        # the new signature was recorded
+        profile_mgr = self._rpmdb_profile_mgr(cache_file)
+        self.assertFalse(profile_mgr.has_changed())
+        self.assertEquals(0, profile_mgr._get_profile.call_count)
+
+    @patch('subscription_manager.cache.rpmdb_signature')
+    def test_no_rpmdb_signature(self, mock_rpmdb_signature):
+        mock_rpmdb_signature.return_value = None
+        cache_file = self._cache_file()
+        self._rpmdb_profile_mgr(cache_file).write_cache()
+
+        profile_mgr = self._rpmdb_profile_mgr(cache_file)
+        self.assertFalse(profile_mgr.has_changed())
+        self.assertEquals(1, profile_mgr._get_profile.call_count)
+
+    def test_delete_cache_removes_digest(self):
+        cache_file = self._cache_file()
+        self.profile_mgr.write_cache()
+        with patch.object(ProfileManager, 'CACHE_FILE', cache_file):
+            ProfileManager.delete_cache()
+        self.assertFalse(os.path.exists(cache_file))
+        self.assertFalse(os.path.exists(self.profile_mgr._digest_file(cache_file)))
+
+    def test_profile_digest(self):
+        reordered = self._mock_pkg_profile([
+                Package(name="package2", version="2.0.0", release=2, arch="x86_64"),
+                Package(name=u"package1", version="1.0.0", release="1", arch="x86_64")])
+        changed = self._mock_pkg_profile([
+                Package(name="package2", version="2.0.0", release=2, arch="x86_64"),
+                Package(name="package1", version="1.0.0", release=1, arch="i686")])
+        self.assertEquals(profile_digest(self.current_profile), profile_digest(reordered))
+        self.assertNotEquals(profile_digest(self.current_profile), profile_digest(changed))
+
     @staticmethod
     def _mock_pkg_profile(packages):
         """
@@ -420,25 +555,9 @@ class TestEntitlementStatusCache(SubManFixture):
         cache_file = os.path.join(cache_dir, 'status_cache.json')
         status_cache.CACHE_FILE = cache_file
         status_cache.write_cache()
+        persistence_queue.flush()
 
-        # try to load the file 5 times, if
-        # we still can't read it, fail
-        # we don't know when the write_cache thread ends or
-        # when it starts. Need to track the cache threads
-        # but we do not...
-
-        tries = 0
-        while tries <= 5:
-            try:
-                new_status_buf = open(cache_file).read()
-                new_status = json.loads(new_status_buf)
-                break
-            except Exception, e:
-                log.exception(e)
-                tries += 1
-                time.sleep(.1)
-                continue
-
+        new_status = json.loads(open(cache_file).read())
         shutil.rmtree(cache_dir)
         self.assertEquals(new_status, mock_server_status)
 
@@ -448,6 +567,337 @@ class TestEntitlementStatusCache(SubManFixture):
         self.assertEquals(None, self.status_cache.load_status(uep, "aaa"))
 
 
+class StandInServer(HTTPServer):
+    """
+    Local HTTP server answering GETs of its resources, with ETags and
+    If-None-Match support.
+    """
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        # path -> (etag, body)
+        self.resources = {}
+        # (path, status) of every request
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs={'poll_interval': 0.01})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, handler, headers):
+        conn = httplib.HTTPConnection(*self.server_address)
+        conn.request("GET", handler, headers=headers)
+        response = conn.getresponse()
+        result = {'content': response.read(),
+                  'status': response.status,
+                  'headers': dict(response.getheaders())}
+        conn.close()
+        return result
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        etag, body = self.server.resources[self.path]
+        if self.headers.get('If-None-Match') == etag:
+            self.server.requests.append((self.path, 304))
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.server.requests.append((self.path, 200))
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestStatusCachePolicy(SubManFixture):
+    uuid = "THISISAUUID"
+    path = "/consumers/THISISAUUID/compliance"
+
+    def setUp(self):
+        super(TestStatusCachePolicy, self).setUp()
+        self.cache_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.server = StandInServer()
+        self.server.resources[self.path] = ('"1"', json.dumps({'status': 'valid'}))
+
+        raw_get_patcher = patch('subscription_manager.cache._raw_get',
+                                side_effect=lambda conn, handler, headers:
+                                self.server.get(handler, headers))
+        raw_get_patcher.start()
+        self.addCleanup(raw_get_patcher.stop)
+        self.cfg_patcher = patch('subscription_manager.cache.cfg')
+        self.mock_cfg = self.cfg_patcher.start()
+        self.mock_cfg.get_int.return_value = 0
+        self.addCleanup(self.cfg_patcher.stop)
+
+        cache_file_patcher = patch.object(EntitlementStatusCache, 'CACHE_FILE',
+                                          os.path.join(self.cache_dir,
+                                                       'entitlement_status.json'))
+        cache_file_patcher.start()
+        self.addCleanup(cache_file_patcher.stop)
+
+        self.uep = Mock()
+        self.uep.conn = Mock(spec=connection.BaseRestLib)
+        self.uep.sanitize.side_effect = lambda value: value
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+        super(TestStatusCachePolicy, self).tearDown()
+
+    def _status_cache(self):
+        status_cache = EntitlementStatusCache()
+        # write in this thread, not in the background
+        status_cache.write_cache = status_cache._write_cache_and_validators
+        return status_cache
+
+    def test_not_modified(self):
+        self.assertEquals({'status': 'valid'},
+                          self._status_cache().load_status(self.uep, self.uuid))
+        self.assertEquals({'status': 'valid'},
+                          self._status_cache().load_status(self.uep, self.uuid))
+        self.assertEquals([(self.path, 200), (self.path, 304)], self.server.requests)
+
+    def test_modified(self):
+        self._status_cache().load_status(self.uep, self.uuid)
+        self.server.resources[self.path] = ('"2"', json.dumps({'status': 'invalid'}))
+        self.assertEquals({'status': 'invalid'},
+                          self._status_cache().load_status(self.uep, self.uuid))
+        self.assertEquals({'status': 'invalid'},
+                          self._status_cache().load_status(self.uep, self.uuid))
+        self.assertEquals([(self.path, 200), (self.path, 200), (self.path, 304)],
+                          self.server.requests)
+
+    def test_fresh_cache_skips_server(self):
+        self.mock_cfg.get_int.return_value = 3600
+        self._status_cache().load_status(self.uep, self.uuid)
+        self.assertEquals({'status': 'valid'},
+                          self._status_cache().load_status(self.uep, self.uuid))
+        self.assertEquals([(self.path, 200)], self.server.requests)
+        self.mock_cfg.get_int.assert_called_with('rhsm', 'entitlement_status_cache_ttl')
+
+    def test_other_consumer_ignores_cache(self):
+        self.mock_cfg.get_int.return_value = 3600
+        self._status_cache().load_status(self.uep, self.uuid)
+        other_path = "/consumers/OTHERUUID/compliance"
+        self.server.resources[other_path] = ('"1"', json.dumps({'status': 'partial'}))
+        self.assertEquals({'status': 'partial'},
+                          self._status_cache().load_status(self.uep, "OTHERUUID"))
+        self.assertEquals([(self.path, 200), (other_path, 200)], self.server.requests)
+
+    def test_missing_cache_fetched_again(self):
+        self._status_cache().load_status(self.uep, self.uuid)
+        os.remove(os.path.join(self.cache_dir, 'entitlement_status.json'))
+        self.assertEquals({'status': 'valid'},
+                          self._status_cache().load_status(self.uep, self.uuid))
+        self.assertEquals([(self.path, 200), (self.path, 200)], self.server.requests)
+
+    def test_delete_cache_removes_validators(self):
+        status_cache = self._status_cache()
+        status_cache.load_status(self.uep, self.uuid)
+        status_cache.delete_cache()
+        self.assertEquals([], os.listdir(self.cache_dir))
+
+    def test_ttl_without_conditional_requests(self):
+        self.mock_cfg.get_int.return_value = 3600
+        uep = Mock()
+        uep.getCompliance.return_value = {'status': 'valid'}
+        self._status_cache().load_status(uep, self.uuid)
+        self.assertEquals({'status': 'valid'},
+                          self._status_cache().load_status(uep, self.uuid))
+        self.assertEquals(1, uep.getCompliance.call_count)
+
+    def test_uses_kept_compliance(self):
+        consumer_cache = ConsumerCache()
+        inj.provide(inj.CONSUMER_CACHE, consumer_cache)
+        self.uep.getCompliance.return_value = {'status': 'partial'}
+        consumer_cache.begin()
+        consumer_cache.get_compliance(self.uep, self.uuid)
+        self.assertEquals({'status': 'partial'},
+                          self._status_cache().load_status(self.uep, self.uuid))
+        self.assertEquals([], self.server.requests)
+        self.assertEquals(1, self.uep.getCompliance.call_count)
+
+    def test_fetched_compliance_kept(self):
+        consumer_cache = ConsumerCache()
+        inj.provide(inj.CONSUMER_CACHE, consumer_cache)
+        consumer_cache.begin()
+        self._status_cache().load_status(self.uep, self.uuid)
+        self.assertEquals({'status': 'valid'},
+                          consumer_cache.get_compliance(self.uep, self.uuid))
+        self.assertFalse(self.uep.getCompliance.called)
+        self.assertEquals([(self.path, 200)], self.server.requests)
+
+    def test_fetched_consumer_kept(self):
+        consumer_path = "/consumers/%s" % self.uuid
+        consumer = {'uuid': self.uuid, 'installedProducts': []}
+        self.server.resources[consumer_path] = ('"1"', json.dumps(consumer))
+        consumer_cache = ConsumerCache()
+        inj.provide(inj.CONSUMER_CACHE, consumer_cache)
+        consumer_cache.begin()
+        with patch.object(ProductStatusCache, 'CACHE_FILE',
+                          os.path.join(self.cache_dir, 'product_status.json')):
+            status_cache = ProductStatusCache()
+            status_cache.write_cache = status_cache._write_cache_and_validators
+            self.assertEquals([], status_cache.load_status(self.uep, self.uuid))
+        self.assertEquals(consumer, consumer_cache.get_consumer(self.uep, self.uuid))
+        self.assertFalse(self.uep.getConsumer.called)
+
+
+class TestPersistenceQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = PersistenceQueue()
+        self.cache_dir = tempfile.mkdtemp()
+        self.written = []
+        # Holds the queue thread in its first write until set
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.queue.flush()
+        shutil.rmtree(self.cache_dir)
+
+    def _writer(self, name):
+        return lambda: self.written.append(name)
+
+    def _block(self):
+        self.queue.put('blocker', self.release.wait)
+
+    def test_flush_waits_for_writes(self):
+        self.queue.put('a', self._writer('a'))
+        self.queue.put('b', self._writer('b'))
+        self.queue.flush()
+        self.assertEquals(['a', 'b'], sorted(self.written))
+
+    def test_coalesces_waiting_writes(self):
+        self._block()
+        self.queue.put('a', self._writer('first'))
+        self.queue.put('a', self._writer('second'))
+        self.release.set()
+        self.queue.flush()
+        self.assertEquals(['second'], self.written)
+
+    def test_discard_waiting_write(self):
+        self._block()
+        self.queue.put('a', self._writer('a'))
+        self.queue.discard('a')
+        self.release.set()
+        self.queue.flush()
+        self.assertEquals([], self.written)
+
+    def test_failed_write_does_not_stop_queue(self):
+        self.queue.put('a', Mock(side_effect=IOError))
+        self.queue.flush()
+        self.queue.put('b', self._writer('b'))
+        self.queue.flush()
+        self.assertEquals(['b'], self.written)
+
+    def test_one_thread(self):
+        self.queue.put('a', self._writer('a'))
+        thread = self.queue._thread
+        self.queue.flush()
+        self.queue.put('b', self._writer('b'))
+        self.queue.flush()
+        self.assertTrue(thread is self.queue._thread)
+
+
+class TestConsumerCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ConsumerCache()
+        self.uep = Mock()
+        self.uep.getConsumer.return_value = {'uuid': 'abcd'}
+        self.uep.getCompliance.return_value = {'status': 'valid'}
+
+    def test_passes_through_outside_run(self):
+        self.cache.get_consumer(self.uep, 'abcd')
+        self.cache.get_consumer(self.uep, 'abcd')
+        self.assertEquals(2, self.uep.getConsumer.call_count)
+        self.assertFalse(self.cache.has_consumer('abcd'))
+
+    def test_kept_during_run(self):
+        self.cache.begin()
+        self.assertEquals({'uuid': 'abcd'}, self.cache.get_consumer(self.uep, 'abcd'))
+        self.cache.get_consumer(self.uep, 'abcd')
+        self.cache.get_compliance(self.uep, 'abcd')
+        self.cache.get_compliance(self.uep, 'abcd')
+        self.assertEquals(1, self.uep.getConsumer.call_count)
+        self.assertEquals(1, self.uep.getCompliance.call_count)
+        self.assertTrue(self.cache.has_consumer('abcd'))
+
+    def test_keep(self):
+        self.cache.keep_consumer('abcd', {'uuid': 'abcd'})
+        self.assertFalse(self.cache.has_consumer('abcd'))
+        self.cache.begin()
+        self.cache.keep_consumer('abcd', {'uuid': 'abcd'})
+        self.cache.keep_compliance('abcd', {'status': 'valid'})
+        self.assertTrue(self.cache.has_consumer('abcd'))
+        self.assertTrue(self.cache.has_compliance('abcd'))
+        self.assertFalse(self.cache.has_compliance('abcd', on_date='2026-01-01'))
+        self.assertEquals({'status': 'valid'}, self.cache.get_compliance(self.uep, 'abcd'))
+        self.cache.get_consumer(self.uep, 'abcd')
+        self.assertFalse(self.uep.getConsumer.called)
+        self.assertFalse(self.uep.getCompliance.called)
+
+    def test_compliance_kept_per_date(self):
+        self.cache.begin()
+        self.cache.get_compliance(self.uep, 'abcd')
+        self.cache.get_compliance(self.uep, 'abcd', on_date='2026-01-01')
+        self.cache.get_compliance(self.uep, 'abcd', on_date='2026-01-01')
+        self.assertEquals(2, self.uep.getCompliance.call_count)
+        self.uep.getCompliance.assert_called_with('abcd', '2026-01-01')
+
+    def test_end_drops_kept(self):
+        self.cache.begin()
+        self.cache.get_consumer(self.uep, 'abcd')
+        self.cache.end()
+        self.cache.begin()
+        self.cache.get_consumer(self.uep, 'abcd')
+        self.assertEquals(2, self.uep.getConsumer.call_count)
+
+    def test_nested_runs(self):
+        self.cache.begin()
+        self.cache.begin()
+        self.cache.get_consumer(self.uep, 'abcd')
+        self.cache.end()
+        self.cache.get_consumer(self.uep, 'abcd')
+        self.assertEquals(1, self.uep.getConsumer.call_count)
+
+    def test_update_consumer_invalidates(self):
+        self.cache.begin()
+        self.cache.get_consumer(self.uep, 'abcd')
+        self.cache.get_compliance(self.uep, 'abcd')
+        self.cache.update_consumer(self.uep, 'abcd', facts={'a': 'b'})
+        self.uep.updateConsumer.assert_called_with('abcd', facts={'a': 'b'})
+        self.assertFalse(self.cache.has_consumer('abcd'))
+        self.cache.get_compliance(self.uep, 'abcd')
+        self.assertEquals(2, self.uep.getCompliance.call_count)
+
+    def test_failed_update_invalidates(self):
+        self.uep.updateConsumer.side_effect = RestlibException(500, "error")
+        self.cache.begin()
+        self.cache.get_consumer(self.uep, 'abcd')
+        self.assertRaises(RestlibException, self.cache.update_consumer,
+                          self.uep, 'abcd', facts={})
+        self.assertFalse(self.cache.has_consumer('abcd'))
+
+    def test_failed_fetch_not_kept(self):
+        self.uep.getConsumer.side_effect = [RestlibException(500, "error"),
+                                            {'uuid': 'abcd'}]
+        self.cache.begin()
+        self.assertRaises(RestlibException, self.cache.get_consumer,
+                          self.uep, 'abcd')
+        self.assertEquals({'uuid': 'abcd'}, self.cache.get_consumer(self.uep, 'abcd'))
+
+
 class TestPoolTypeCache(SubManFixture):
 
     def setUp(self):
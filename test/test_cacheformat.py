@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2015 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+import unittest
+from StringIO import StringIO
+
+from mock import patch
+
+from rhsm import ourjson as json
+from subscription_manager import cacheformat
+
+DATA = [{'name': 'package1', 'version': '1.0.0', 'release': '1',
+         'arch': 'x86_64', 'epoch': 0, 'vendor': None},
+        {'name': u'p\xe4ckage2', 'version': '2.0.0', 'release': '2',
+         'arch': 'noarch', 'epoch': 1, 'vendor': 'Red Hat, Inc.'}]
+
+
+class TestCacheFormat(unittest.TestCase):
+
+    def test_round_trip(self):
+        self.assertEquals(DATA, cacheformat.loads(cacheformat.dumps(DATA)))
+
+    def test_load_file(self):
+        f = StringIO(cacheformat.dumps(DATA))
+        self.assertTrue(cacheformat.is_compact(f))
+        self.assertEquals(DATA, cacheformat.load(f))
+
+    def test_json_is_not_compact(self):
+        f = StringIO(json.dumps(DATA))
+        self.assertFalse(cacheformat.is_compact(f))
+        self.assertEquals(0, f.tell())
+
+    def test_empty_file_is_not_compact(self):
+        self.assertFalse(cacheformat.is_compact(StringIO('')))
+
+    def test_truncated(self):
+        buf = cacheformat.dumps(DATA)
+        self.assertRaises(cacheformat.CacheFormatError, cacheformat.loads, buf[:-1])
+        self.assertRaises(cacheformat.CacheFormatError, cacheformat.loads, buf[:5])
+
+    def test_corrupt(self):
+        buf = cacheformat.dumps(DATA)
+        corrupt = buf[:-2] + chr(ord(buf[-2]) ^ 0xff) + buf[-1]
+        self.assertRaises(cacheformat.CacheFormatError, cacheformat.loads, corrupt)
+
+    def test_other_version(self):
+        buf = cacheformat.dumps(DATA)
+        with patch('subscription_manager.cacheformat.FORMAT_VERSION', 0):
+            self.assertRaises(cacheformat.CacheFormatError, cacheformat.loads, buf)
+
+    def test_error_is_value_error(self):
+        # CacheManager treats a cache it can not parse as missing
+        self.assertTrue(issubclass(cacheformat.CacheFormatError, ValueError))
+
+    def test_unmarshallable(self):
+        self.assertRaises(ValueError, cacheformat.dumps, {'a': object()})
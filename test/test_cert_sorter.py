@@ -21,11 +21,13 @@ from stubs import StubEntitlementCertificate, StubProduct, StubProductCertificat
     StubEntitlementDirectory, StubProductDirectory, \
     StubUEP, StubCertSorter
 import subscription_manager.cert_sorter
-from subscription_manager.cert_sorter import CertSorter, UNKNOWN
+from subscription_manager.cert_sorter import CertSorter, EntitlementCertBuckets, \
+    UNKNOWN
 from subscription_manager.cache import EntitlementStatusCache
 from datetime import timedelta, datetime
 from mock import Mock, patch
 from rhsm import ourjson as json
+from rhsm.certificate import GMT
 
 
 def cert_list_has_product(cert_list, product_id):
@@ -236,6 +238,14 @@ class CertSorterTests(SubManFixture):
 
         self.assertEquals(3, len(sorter.valid_entitlement_certs))
 
+    def test_in_warning_period(self):
+        self.assertFalse(self.sorter.in_warning_period())
+        expiring = StubEntitlementCertificate(StubProduct("a"),
+                start_date=datetime.now() - timedelta(days=365),
+                end_date=datetime.now() + timedelta(days=2))
+        self.sorter.valid_entitlement_certs = [expiring]
+        self.assertTrue(self.sorter.in_warning_period())
+
     def test_get_system_status(self):
         self.assertEquals('Invalid', self.sorter.get_system_status())
         self.sorter.system_status = 'valid'
@@ -243,6 +253,59 @@ class CertSorterTests(SubManFixture):
         self.sorter.system_status = 'partial'
         self.assertEquals('Insufficient', self.sorter.get_system_status())
 
+    @patch('subscription_manager.file_monitor.create_monitor_directory')
+    def test_watch_only_with_callbacks(self, mock_create):
+        mock_create.return_value = Mock()
+        self.assertFalse(mock_create.called)
+        polling_monitor = self.sorter.cert_monitor
+
+        cb = Mock()
+        self.sorter.add_callback(cb)
+        self.assertEquals(3, mock_create.call_count)
+        watching_monitor = self.sorter.cert_monitor
+        self.assertNotEqual(polling_monitor, watching_monitor)
+
+        # a second consumer shares the same watches
+        cb2 = Mock()
+        self.sorter.add_callback(cb2)
+        self.assertEquals(3, mock_create.call_count)
+
+        self.sorter.remove_callback(cb)
+        self.assertFalse(mock_create.return_value.close.called)
+        self.sorter.remove_callback(cb2)
+        self.assertEquals(3, mock_create.return_value.close.call_count)
+        self.assertNotEqual(watching_monitor, self.sorter.cert_monitor)
+        # polling still works for force_cert_check
+        self.sorter.force_cert_check()
+
+
+class EntitlementCertBucketsTests(SubManFixture):
+
+    def test_buckets(self):
+        valid = StubEntitlementCertificate(StubProduct("a"))
+        expiring = StubEntitlementCertificate(StubProduct("b"),
+                start_date=datetime.now() - timedelta(days=365),
+                end_date=datetime.now() + timedelta(days=2))
+        expired = StubEntitlementCertificate(StubProduct("c"),
+                start_date=datetime.now() - timedelta(days=365),
+                end_date=datetime.now() - timedelta(days=2))
+        future = StubEntitlementCertificate(StubProduct("d"),
+                start_date=datetime.now() + timedelta(days=365),
+                end_date=datetime.now() + timedelta(days=730))
+
+        buckets = EntitlementCertBuckets([valid, expiring, expired, future])
+        self.assertEquals([valid, expiring], buckets.valid)
+        self.assertEquals([expired], buckets.expired)
+        self.assertEquals([future], buckets.future)
+
+    def test_on_date(self):
+        cert = StubEntitlementCertificate(StubProduct("a"))
+        on_date = datetime.now(GMT()) + timedelta(days=730)
+        buckets = EntitlementCertBuckets([cert], on_date)
+        self.assertEquals([cert], buckets.expired)
+        self.assertEquals([], buckets.valid)
+
+
 SAMPLE_COMPLIANCE_JSON = json.loads("""
 {
   "date" : "2013-04-26T13:43:12.436+0000",
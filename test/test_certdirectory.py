@@ -17,13 +17,17 @@ import tempfile
 import unittest
 import os
 
-from mock import patch, MagicMock
+from mock import patch, MagicMock, Mock
 from shutil import rmtree
 
-from stubs import StubProduct, StubEntitlementCertificate, \
+import certdata
+from rhsm.certificate import create_from_file, create_from_pem
+from stubs import StubProduct, StubEntitlementCertificate, StubEntitlementDirectory, \
     StubProductCertificate
 from subscription_manager.certdirectory import Path, EntitlementDirectory, \
-    ProductDirectory, ProductCertificateDirectory, Directory
+    ProductDirectory, ProductCertificateDirectory, Directory, CertificateDirectory, \
+    Writer
+from subscription_manager.file_monitor import DirectoryChanges
 from subscription_manager.repolib import RepoFile
 from subscription_manager.productid import ProductDatabase
 
@@ -411,3 +415,296 @@ class AlsoProductDirectoryTest(unittest.TestCase):
         self.assertEquals(1, len(results))
         resulting_ids = [cert.products[0].id for cert in results]
         self.assertTrue("top" in resulting_ids)
+
+
+class CertificateListingIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cert1 = StubEntitlementCertificate(StubProduct("product1"),
+                                                provided_products=["provided1"],
+                                                stacking_id="stack1")
+        self.cert2 = StubEntitlementCertificate(StubProduct("product2"),
+                                                stacking_id="stack1")
+        self.cert3 = StubEntitlementCertificate(StubProduct("product1"))
+        self.ent_dir = StubEntitlementDirectory([self.cert1, self.cert2, self.cert3])
+
+    def test_find(self):
+        self.assertEquals(self.cert2, self.ent_dir.find(self.cert2.serial))
+        self.assertEquals(None, self.ent_dir.find(1))
+
+    def test_find_after_listing_changed(self):
+        self.ent_dir.find(self.cert1.serial)
+        cert4 = StubEntitlementCertificate(StubProduct("product4"))
+        self.ent_dir.certs.append(cert4)
+        self.assertEquals(cert4, self.ent_dir.find(cert4.serial))
+        self.assertEquals(cert4, self.ent_dir.find_by_product("product4"))
+
+    def test_find_by_product_first_match(self):
+        self.assertEquals(self.cert1, self.ent_dir.find_by_product("product1"))
+        self.assertEquals(self.cert1, self.ent_dir.find_by_product("provided1"))
+        self.assertEquals(None, self.ent_dir.find_by_product("nope"))
+
+    def test_list_for_product(self):
+        self.assertEquals([self.cert1, self.cert3],
+                          self.ent_dir.list_for_product("product1"))
+        self.assertEquals([], self.ent_dir.list_for_product("nope"))
+
+    def test_list_for_product_returns_copy(self):
+        self.ent_dir.list_for_product("product1").append(self.cert2)
+        self.assertEquals(2, len(self.ent_dir.list_for_product("product1")))
+
+    def test_find_all_by_product_includes_stack(self):
+        res = self.ent_dir.find_all_by_product("provided1")
+        self.assertEquals(set([self.cert1, self.cert2]), set(res))
+
+    def test_find_all_by_product_stacked_top_product(self):
+        res = self.ent_dir.find_all_by_product("product2")
+        self.assertEquals(set([self.cert1, self.cert2]), set(res))
+        self.assertEquals([], self.ent_dir.find_all_by_product("nope"))
+
+
+class ProductDirectoryListingTest(unittest.TestCase):
+    @patch('os.path.exists')
+    def test_listing_reused_until_refresh(self, MockExists):
+        MockExists.return_value = True
+        pd = ProductDirectory()
+        installed = [StubProductCertificate(StubProduct("top"), [])]
+        default = []
+        pd.installed_prod_dir.list = lambda: installed
+        pd.default_prod_dir.list = lambda: default
+        self.assertTrue(pd.list() is pd.list())
+        self.assertEquals(installed[0], pd.find_by_product("top"))
+
+        installed = installed + [StubProductCertificate(StubProduct("other"), [])]
+        self.assertEquals(2, len(pd.list()))
+        self.assertEquals(installed[1], pd.find_by_product("other"))
+
+
+class IncrementalRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.index_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.index_dir_patcher = patch('subscription_manager.certindex.CERT_INDEX_DIR',
+                                       self.index_dir)
+        self.index_dir_patcher.start()
+        self.cff_patcher = patch('subscription_manager.certdirectory.create_from_file',
+                                 Mock(side_effect=create_from_file))
+        self.mock_cff = self.cff_patcher.start()
+
+        self._write('1.pem', certdata.ENTITLEMENT_CERT_V1_0)
+        self.cert_dir = CertificateDirectory(self.temp_dir)
+
+    def tearDown(self):
+        self.cff_patcher.stop()
+        self.index_dir_patcher.stop()
+        rmtree(self.temp_dir)
+        rmtree(self.index_dir)
+
+    def _write(self, name, pem):
+        f = open(os.path.join(self.temp_dir, name), 'w')
+        f.write(pem)
+        f.close()
+
+    def test_refresh_reuses_unchanged_certs(self):
+        cert = self.cert_dir.list()[0]
+        self.cert_dir.refresh()
+        self.assertTrue(cert is self.cert_dir.list()[0])
+        self.assertEquals(1, self.mock_cff.call_count)
+
+    def test_refresh_reloads_new_certs(self):
+        self.cert_dir.list()
+        self._write('2.pem', certdata.ENTITLEMENT_CERT_V3_0)
+        self.cert_dir.refresh()
+        self.assertEquals(2, len(self.cert_dir.list()))
+        self.assertEquals(2, self.mock_cff.call_count)
+
+    def test_refresh_with_changes(self):
+        cert = self.cert_dir.list()[0]
+        self._write('2.pem', certdata.ENTITLEMENT_CERT_V3_0)
+        self._write('2-key.pem', "not a cert")
+        self.cert_dir.refresh(DirectoryChanges(created=['2.pem', '2-key.pem']))
+        listing = self.cert_dir.list()
+        self.assertEquals(2, len(listing))
+        self.assertTrue(cert in listing)
+
+        os.unlink(os.path.join(self.temp_dir, '1.pem'))
+        self.cert_dir.refresh(DirectoryChanges(deleted=['1.pem']))
+        listing = self.cert_dir.list()
+        self.assertEquals(1, len(listing))
+        self.assertFalse(cert in listing)
+
+    def test_refresh_full_rescan(self):
+        self.cert_dir.list()
+        self._write('2.pem', certdata.ENTITLEMENT_CERT_V3_0)
+        self.cert_dir.refresh(DirectoryChanges(full_rescan=True))
+        self.assertEquals(2, len(self.cert_dir.list()))
+
+    def test_add_cert(self):
+        self.cert_dir.list()
+        cert = create_from_pem(certdata.ENTITLEMENT_CERT_V3_0)
+        cert.write(os.path.join(self.temp_dir, '2.pem'))
+        self.cert_dir.add_cert(cert)
+        self.assertTrue(cert in self.cert_dir.list())
+        self.assertEquals(cert, self.cert_dir.find(cert.serial))
+        self.assertEquals(1, self.mock_cff.call_count)
+
+    def test_add_cert_saved_once(self):
+        self.cert_dir.list()
+        index = self.cert_dir._get_index()
+        index.save = Mock()
+        for pem in [certdata.ENTITLEMENT_CERT_V3_0, certdata.ENTITLEMENT_CERT_V1_0]:
+            cert = create_from_pem(pem)
+            cert.write(os.path.join(self.temp_dir, '%s.pem' % cert.serial))
+            self.cert_dir.add_cert(cert)
+        self.assertFalse(index.save.called)
+        self.cert_dir.save_index()
+        index.save.assert_called_once_with(prune=False)
+
+    def test_add_cert_replaces_same_path(self):
+        old_cert = self.cert_dir.list()[0]
+        cert = create_from_pem(certdata.ENTITLEMENT_CERT_V3_0)
+        cert.write(old_cert.path)
+        self.cert_dir.add_cert(cert)
+        self.assertEquals([cert], self.cert_dir.list())
+
+    def test_signature(self):
+        signature = self.cert_dir.signature()
+        self.assertEquals(['1.pem'], [entry[0] for entry in signature])
+        self.assertFalse(self.mock_cff.called)
+
+        os.mkdir(os.path.join(self.temp_dir, 'subdir'))
+        self.assertEquals(signature, self.cert_dir.signature())
+        self._write('1-key.pem', "not a cert")
+        self.assertNotEqual(signature, self.cert_dir.signature())
+
+
+class StubKey(object):
+    def __init__(self, content):
+        self.content = content
+        self.path = None
+
+
+class WriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.ent_dir = Mock()
+        self.ent_dir.productpath.return_value = self.temp_dir
+        self.require_patcher = patch('subscription_manager.certdirectory.require',
+                                     Mock(return_value=self.ent_dir))
+        self.require_patcher.start()
+
+    def tearDown(self):
+        self.require_patcher.stop()
+        rmtree(self.temp_dir)
+
+    def _pair(self, pem=certdata.ENTITLEMENT_CERT_V1_0):
+        cert = create_from_pem(pem)
+        return StubKey("key for %s" % cert.serial), cert
+
+    def test_write(self):
+        key, cert = self._pair()
+        Writer().write(key, cert)
+        self.assertEquals(sorted(['%s.pem' % cert.serial, '%s-key.pem' % cert.serial]),
+                          sorted(os.listdir(self.temp_dir)))
+        self.assertEquals(os.path.join(self.temp_dir, '%s.pem' % cert.serial), cert.path)
+        self.assertEquals(cert.serial, create_from_file(cert.path).serial)
+        self.assertEquals(key.content, open(key.path).read())
+        self.assertEquals(0600, os.stat(key.path).st_mode & 07777)
+        self.ent_dir.add_cert.assert_called_once_with(cert)
+
+    def test_batch_is_staged_until_commit(self):
+        writer = Writer()
+        writer.begin()
+        key, cert = self._pair()
+        other_key, other_cert = self._pair(certdata.ENTITLEMENT_CERT_V3_0)
+        writer.write(key, cert)
+        writer.write(other_key, other_cert)
+        # only the staging directory is visible
+        self.assertEquals(1, len(os.listdir(self.temp_dir)))
+        self.assertFalse(self.ent_dir.add_cert.called)
+
+        self.assertEquals([], writer.commit())
+        self.assertEquals(4, len(os.listdir(self.temp_dir)))
+        self.assertEquals(2, self.ent_dir.add_cert.call_count)
+        self.ent_dir.save_index.assert_called_once_with()
+        self.assertEquals(other_cert.serial, create_from_file(other_cert.path).serial)
+
+    def test_commit_replaces_existing_files(self):
+        key, cert = self._pair()
+        Writer().write(key, cert)
+        key.content = "new key"
+        Writer().write(key, cert)
+        self.assertEquals(2, len(os.listdir(self.temp_dir)))
+        self.assertEquals("new key", open(key.path).read())
+
+    def test_commit_reports_failures(self):
+        writer = Writer()
+        writer.begin()
+        key, cert = self._pair()
+        writer.write(key, cert)
+        with patch('os.rename', Mock(side_effect=OSError("no space"))):
+            failed = writer.commit()
+        self.assertEquals(1, len(failed))
+        self.assertEquals(cert, failed[0][0])
+        self.assertEquals([], os.listdir(self.temp_dir))
+        self.assertFalse(self.ent_dir.add_cert.called)
+
+    def test_files_synced_before_rename(self):
+        calls = []
+        writer = Writer()
+        real_rename = os.rename
+        with patch('os.fsync', Mock(side_effect=lambda fd: calls.append('fsync'))):
+            with patch('os.rename', Mock(side_effect=lambda src, dst:
+                                         (calls.append('rename'), real_rename(src, dst)))):
+                writer.begin()
+                writer.write(*self._pair())
+                writer.write(*self._pair(certdata.ENTITLEMENT_CERT_V3_0))
+                writer.commit()
+        # one fsync per staged file, then the renames, then one fsync
+        # of the directory for the whole batch
+        self.assertEquals(['fsync'] * 4 + ['rename'] * 4 + ['fsync'], calls)
+
+    def _fail_cert_rename(self, cert):
+        real_rename = os.rename
+        cert_path = os.path.join(self.temp_dir, '%s.pem' % cert.serial)
+
+        def rename(src, dst):
+            if dst == cert_path:
+                raise OSError("no space")
+            real_rename(src, dst)
+        return patch('os.rename', Mock(side_effect=rename))
+
+    def test_failed_cert_rename_removes_key(self):
+        key, cert = self._pair()
+        with self._fail_cert_rename(cert):
+            self.assertRaises(OSError, Writer().write, key, cert)
+        self.assertEquals([], os.listdir(self.temp_dir))
+
+    def test_failed_cert_rename_restores_key(self):
+        key, cert = self._pair()
+        Writer().write(key, cert)
+        old_key_path = key.path
+        key.content = "new key"
+        with self._fail_cert_rename(cert):
+            self.assertRaises(OSError, Writer().write, key, cert)
+        self.assertEquals(2, len(os.listdir(self.temp_dir)))
+        self.assertEquals("key for %s" % cert.serial, open(old_key_path).read())
+
+    def test_stale_staging_removed(self):
+        stale = os.path.join(self.temp_dir, '.staging-stale')
+        os.mkdir(stale)
+        open(os.path.join(stale, '1.pem'), 'w').close()
+        writer = Writer()
+        writer.begin()
+        self.assertEquals([], os.listdir(self.temp_dir))
+        writer.write(*self._pair())
+        writer.commit()
+        self.assertEquals(2, len(os.listdir(self.temp_dir)))
+
+    def test_commit_without_writes(self):
+        writer = Writer()
+        writer.begin()
+        self.assertEquals([], writer.commit())
+        self.assertEquals([], os.listdir(self.temp_dir))
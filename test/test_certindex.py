@@ -0,0 +1,216 @@
+#
+# Copyright (c) 2015 Red Hat, Inc.
+#
+# This software is licensed to you under the GNU General Public License,
+# version 2 (GPLv2). There is NO WARRANTY for this software, express or
+# implied, including the implied warranties of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. You should have received a copy of GPLv2
+# along with this software; if not, see
+# http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt.
+#
+# Red Hat trademarks are not licensed under GPLv2. No permission is
+# granted to use or replicate Red Hat trademarks that are incorporated
+# in this software or its documentation.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+import certdata
+from stubs import StubEntitlementCertificate, StubProduct
+from rhsm.certificate import create_from_file, create_from_pem
+from subscription_manager import certindex
+
+
+class TestEncodeCert(unittest.TestCase):
+
+    def _round_trip(self, pem):
+        cert = create_from_pem(pem)
+        return cert, certindex.decode_cert(certindex.encode_cert(cert))
+
+    def test_entitlement_cert_v1(self):
+        cert, indexed = self._round_trip(certdata.ENTITLEMENT_CERT_V1_0)
+        self.assertTrue(isinstance(indexed, certindex.IndexedEntitlementCertificate))
+        self.assertEquals(cert.serial, indexed.serial)
+        self.assertEquals(cert.valid_range.begin(), indexed.valid_range.begin())
+        self.assertEquals(cert.valid_range.end(), indexed.valid_range.end())
+        self.assertEquals([p.id for p in cert.products],
+                          [p.id for p in indexed.products])
+        self.assertEquals([c.label for c in cert.content],
+                          [c.label for c in indexed.content])
+        self.assertEquals(cert.order.name, indexed.order.name)
+        self.assertEquals(cert.subject, indexed.subject)
+
+    def test_entitlement_cert_v3(self):
+        cert, indexed = self._round_trip(certdata.ENTITLEMENT_CERT_V3_0)
+        self.assertEquals(cert.serial, indexed.serial)
+        self.assertEquals(cert.version.major, indexed.version.major)
+        self.assertEquals(cert.order.sku, indexed.order.sku)
+
+    def test_product_cert(self):
+        cert, indexed = self._round_trip(certdata.PRODUCT_CERT_V1_0)
+        self.assertTrue(isinstance(indexed, certindex.IndexedProductCertificate))
+        self.assertEquals(cert.products[0].id, indexed.products[0].id)
+        self.assertEquals(cert.products[0].provided_tags,
+                          indexed.products[0].provided_tags)
+        self.assertTrue(isinstance(indexed.products[0].id, str))
+        self.assertTrue(isinstance(indexed.products[0].name, unicode))
+
+    def test_content_deferred(self):
+        cert, indexed = self._round_trip(certdata.ENTITLEMENT_CERT_V1_0)
+        self.assertFalse('content' in indexed.__dict__)
+        self.assertEquals(cert.order.sku, indexed.order.sku)
+        # the order does not decode the content
+        self.assertFalse('content' in indexed.__dict__)
+        self.assertEquals(len(cert.content), len(indexed.content))
+
+    def test_product_cert_has_no_order(self):
+        cert, indexed = self._round_trip(certdata.PRODUCT_CERT_V1_0)
+        self.assertFalse(hasattr(indexed, 'order'))
+
+    def test_encode_indexed_cert(self):
+        cert, indexed = self._round_trip(certdata.ENTITLEMENT_CERT_V1_0)
+        again = certindex.decode_cert(certindex.encode_cert(indexed))
+        self.assertEquals(cert.order.name, again.order.name)
+        self.assertEquals([c.label for c in cert.content],
+                          [c.label for c in again.content])
+
+    def test_reparse_from_kept_pem(self):
+        cert, indexed = self._round_trip(certdata.PRODUCT_CERT_V1_0)
+        indexed.__dict__['pem'] = cert.x509.as_pem()
+        self.assertEquals(cert.x509.as_pem(), indexed.x509.as_pem())
+
+    def test_unknown_cert_type(self):
+        cert = StubEntitlementCertificate(StubProduct('product'))
+        self.assertRaises(certindex.UnindexableValue, certindex.encode_cert, cert)
+
+    def test_unknown_value(self):
+        cert = create_from_pem(certdata.PRODUCT_CERT_V1_0)
+        cert.something = object()
+        self.assertRaises(certindex.UnindexableValue, certindex.encode_cert, cert)
+
+
+class TestCertificateIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.cert_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.index_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.index_dir_patcher = patch('subscription_manager.certindex.CERT_INDEX_DIR',
+                                       self.index_dir)
+        self.index_dir_patcher.start()
+        self.loader = Mock(side_effect=create_from_file)
+
+    def tearDown(self):
+        self.index_dir_patcher.stop()
+        shutil.rmtree(self.cert_dir)
+        shutil.rmtree(self.index_dir)
+
+    def _write_cert(self, name, pem):
+        path = os.path.join(self.cert_dir, name)
+        f = open(path, 'w')
+        f.write(pem)
+        f.close()
+        return path
+
+    def _index(self):
+        return certindex.CertificateIndex(self.cert_dir)
+
+    def test_cold_index_uses_loader(self):
+        path = self._write_cert('1.pem', certdata.ENTITLEMENT_CERT_V1_0)
+        index = self._index()
+        index.get(path, self.loader)
+        index.save()
+        self.assertEquals(1, self.loader.call_count)
+        self.assertTrue(os.path.exists(index.CACHE_FILE))
+
+    def test_warm_index_skips_loader(self):
+        path = self._write_cert('1.pem', certdata.ENTITLEMENT_CERT_V1_0)
+        index = self._index()
+        expected = index.get(path, self.loader)
+        index.save()
+
+        cert = self._index().get(path, self.loader)
+        self.assertEquals(1, self.loader.call_count)
+        self.assertEquals(expected.serial, cert.serial)
+        self.assertEquals(path, cert.path)
+
+    def test_warm_index_keeps_string_types(self):
+        path = self._write_cert('1.pem', certdata.ENTITLEMENT_CERT_V1_0)
+
+        def load_non_ascii(path):
+            cert = create_from_file(path)
+            cert.products[0].name = u'Awesome OS \xe9'
+            cert.order.name = u'\u2603 subscription'
+            return cert
+        index = self._index()
+        index.get(path, load_non_ascii)
+        index.save()
+
+        fresh = load_non_ascii(path)
+        cert = self._index().get(path, self.loader)
+        self.assertFalse(self.loader.called)
+        for (expected, value) in [(fresh.products[0].name, cert.products[0].name),
+                                  (fresh.products[0].id, cert.products[0].id),
+                                  (fresh.order.name, cert.order.name),
+                                  (fresh.order.sku, cert.order.sku),
+                                  (fresh.content[0].url, cert.content[0].url),
+                                  (fresh.subject['CN'], cert.subject['CN']),
+                                  (fresh.path, cert.path)]:
+            self.assertEquals(expected, value)
+            self.assertEquals(type(expected), type(value))
+
+    def test_indexed_cert_reparses_pem(self):
+        path = self._write_cert('1.pem', certdata.ENTITLEMENT_CERT_V1_0)
+        index = self._index()
+        index.get(path, self.loader)
+        index.save()
+
+        cert = self._index().get(path, self.loader)
+        self.assertFalse('pem' in cert.__dict__)
+        self.assertEquals(create_from_file(path).pem, cert.pem)
+
+    def test_changed_file_is_reloaded(self):
+        path = self._write_cert('1.pem', certdata.ENTITLEMENT_CERT_V1_0)
+        index = self._index()
+        index.get(path, self.loader)
+        index.save()
+
+        self._write_cert('1.pem', certdata.ENTITLEMENT_CERT_V3_0)
+        cert = self._index().get(path, self.loader)
+        self.assertEquals(2, self.loader.call_count)
+        self.assertEquals(create_from_file(path).serial, cert.serial)
+
+    def test_save_drops_missing_entries(self):
+        path = self._write_cert('1.pem', certdata.ENTITLEMENT_CERT_V1_0)
+        other_path = self._write_cert('2.pem', certdata.ENTITLEMENT_CERT_V3_0)
+        index = self._index()
+        index.get(path, self.loader)
+        index.get(other_path, self.loader)
+        index.save()
+
+        index = self._index()
+        index.get(path, self.loader)
+        index.save()
+        self.assertEquals([path], self._index().entries.keys())
+
+    def test_unindexable_cert_not_stored(self):
+        path = self._write_cert('1.pem', certdata.ENTITLEMENT_CERT_V1_0)
+        stub_cert = StubEntitlementCertificate(StubProduct('product'))
+        index = self._index()
+        self.assertEquals(stub_cert, index.get(path, Mock(return_value=stub_cert)))
+        index.save()
+        self.assertFalse(os.path.exists(index.CACHE_FILE))
+
+    def test_other_index_version_ignored(self):
+        path = self._write_cert('1.pem', certdata.ENTITLEMENT_CERT_V1_0)
+        index = self._index()
+        index.get(path, self.loader)
+        index.save()
+
+        with patch('subscription_manager.certindex.INDEX_VERSION', -1):
+            self._index().get(path, self.loader)
+        self.assertEquals(2, self.loader.call_count)
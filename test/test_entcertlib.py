@@ -14,6 +14,12 @@
 # in this software or its documentation.
 #
 
+import socket
+import sys
+import threading
+import time
+import traceback
+
 from mock import Mock, patch
 from datetime import timedelta, datetime
 
@@ -62,6 +68,179 @@ class TestEntCertUpdateReport(fixture.SubManFixture):
         return stub_ent_cert
 
 
+class TestEntCertUpdatePlan(fixture.SubManFixture):
+    def setUp(self):
+        super(TestEntCertUpdatePlan, self).setUp()
+        self.kept = StubEntitlementCertificate(StubProduct("Kept"))
+        self.rogue = StubEntitlementCertificate(StubProduct("Rogue"))
+        self.local = {self.kept.serial: self.kept,
+                      self.rogue.serial: self.rogue}
+
+    def test_diff(self):
+        plan = entcertlib.EntCertUpdatePlan(self.local, [3, self.kept.serial, 1])
+        self.assertEquals([3, 1], plan.missing)
+        self.assertEquals([self.rogue], plan.rogue)
+        self.assertEquals([self.kept.serial], plan.unchanged)
+        self.assertTrue(plan.has_changes())
+
+    def test_duplicate_expected_serials(self):
+        plan = entcertlib.EntCertUpdatePlan({}, [3, 3, 1])
+        self.assertEquals([3, 1], plan.missing)
+
+    def test_no_changes(self):
+        plan = entcertlib.EntCertUpdatePlan(self.local, [self.rogue.serial,
+                                                        self.kept.serial])
+        self.assertEquals([], plan.missing)
+        self.assertEquals([], plan.rogue)
+        self.assertFalse(plan.has_changes())
+
+    def test_plan_changes_nothing(self):
+        mock_uep = Mock()
+        mock_uep.getCertificateSerials.return_value = [{'serial': self.kept.serial},
+                                                       {'serial': 3}]
+        self.set_consumer_auth_cp(mock_uep)
+        inj.provide(inj.ENT_DIR, StubEntitlementDirectory([self.kept, self.rogue]))
+
+        plan = TestingUpdateAction().plan()
+        self.assertEquals([3], plan.missing)
+        self.assertEquals([self.rogue], plan.rogue)
+        self.assertFalse(self.rogue.is_deleted)
+        self.assertFalse(mock_uep.getCertificates.called)
+
+    def test_find_updated(self):
+        old = StubEntitlementCertificate(StubProduct("Prod"), ent_id="ent1")
+        gone = StubEntitlementCertificate(StubProduct("Gone"), ent_id="ent3")
+        new = StubEntitlementCertificate(StubProduct("Prod"), ent_id="ent1")
+        other = StubEntitlementCertificate(StubProduct("Other"), ent_id="ent2")
+        plan = entcertlib.EntCertUpdatePlan({old.serial: old, gone.serial: gone},
+                                            [new.serial, other.serial])
+        self.assertEquals([], plan.updated)
+        self.assertEquals([(old, new)], plan.find_updated([new, other]))
+        self.assertEquals([(old, new)], plan.updated)
+
+    @patch("subscription_manager.entcertlib.utils.system_log")
+    @patch("subscription_manager.entcertlib.EntitlementCertBundleInstaller.build_cert")
+    @patch.object(Writer, "write")
+    def test_perform_reports_updated(self, write_mock, build_cert_mock, syslog_mock):
+        old = StubEntitlementCertificate(StubProduct("Prod"), ent_id="ent1")
+        new = StubEntitlementCertificate(StubProduct("Prod"), ent_id="ent1")
+        build_cert_mock.side_effect = lambda bundle: (bundle['key'], bundle['cert'])
+        mock_uep = Mock()
+        mock_uep.getCertificateSerials.return_value = [{'serial': new.serial}]
+        mock_uep.getCertificates.return_value = [{'key': Mock(), 'cert': new}]
+        self.set_consumer_auth_cp(mock_uep)
+        inj.provide(inj.ENT_DIR, StubEntitlementDirectory([old]))
+
+        update_action = TestingUpdateAction()
+        update_action.repo_hook = Mock()
+        update_action.branding_hook = Mock()
+        report = update_action.perform()
+
+        self.assertTrue(old.is_deleted)
+        self.assertEquals([(old, new)], report.updated)
+        self.assertTrue("sn:%d -> sn:%d" % (old.serial, new.serial) in str(report))
+        messages = [args[0][0] for args in syslog_mock.call_args_list]
+        self.assertTrue([m for m in messages if m.startswith("Updated subscription")])
+
+
+class BatchingUEP(object):
+    """Local stand-in for the UEP getCertificates call."""
+    def __init__(self, serials, delay=0, fail_on=None):
+        self.bundles = dict((str(sn), {'key': 'key-%s' % sn, 'cert': sn})
+                            for sn in serials)
+        self.delay = delay
+        self.fail_on = fail_on
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def getCertificates(self, consumer_uuid, serials=None):
+        self.lock.acquire()
+        self.calls.append(serials)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        self.lock.release()
+        try:
+            time.sleep(self.delay)
+            if self.fail_on in serials:
+                raise socket.error("connection reset")
+            return [self.bundles[sn] for sn in serials]
+        finally:
+            self.lock.acquire()
+            self.active -= 1
+            self.lock.release()
+
+
+class TestEntitlementCertBatchFetcher(fixture.SubManFixture):
+    def _fetch(self, uep, serials, batch_size, workers):
+        return entcertlib.EntitlementCertBatchFetcher(uep, 'uuid', serials,
+                                                      batch_size=batch_size,
+                                                      workers=workers,
+                                                      uep_factory=lambda: uep)
+
+    def test_batches(self):
+        uep = BatchingUEP(range(5))
+        bundles = list(self._fetch(uep, range(5), 2, 1))
+        self.assertEquals([['0', '1'], ['2', '3'], ['4']], uep.calls)
+        self.assertEquals(range(5), [b['cert'] for b in bundles])
+
+    def test_parallel_batches(self):
+        uep = BatchingUEP(range(20), delay=0.01)
+        bundles = list(self._fetch(uep, range(20), 2, 3))
+        self.assertEquals(10, len(uep.calls))
+        self.assertEquals(range(20), sorted(b['cert'] for b in bundles))
+        self.assertTrue(uep.max_active <= 3)
+
+    def test_failed_batch_raises(self):
+        uep = BatchingUEP(range(20), fail_on='7')
+        fetcher = self._fetch(uep, range(20), 2, 3)
+        self.assertRaises(socket.error, list, fetcher)
+
+    def test_connection_per_worker(self):
+        uep = BatchingUEP(range(20), delay=0.01)
+        factory = Mock(return_value=uep)
+        fetcher = entcertlib.EntitlementCertBatchFetcher(Mock(), 'uuid', range(20),
+                                                         batch_size=2, workers=3,
+                                                         uep_factory=factory)
+        self.assertEquals(20, len(list(fetcher)))
+        self.assertTrue(factory.call_count <= 3)
+        self.assertEquals(10, len(uep.calls))
+
+    def test_no_factory_fetches_serially(self):
+        uep = BatchingUEP(range(20), delay=0.001)
+        fetcher = entcertlib.EntitlementCertBatchFetcher(uep, 'uuid', range(20),
+                                                         batch_size=2, workers=3)
+        self.assertEquals(20, len(list(fetcher)))
+        self.assertEquals(1, uep.max_active)
+
+    def test_failed_batch_keeps_traceback(self):
+        uep = BatchingUEP(range(20), fail_on='7')
+        try:
+            list(self._fetch(uep, range(20), 2, 3))
+        except socket.error:
+            tb = traceback.extract_tb(sys.exc_info()[2])
+            self.assertEquals('getCertificates', tb[-1][2])
+        else:
+            self.fail("socket.error not raised")
+
+    def test_failed_batch_raises_serial(self):
+        uep = BatchingUEP(range(4), fail_on='3')
+        self.assertRaises(socket.error, list, self._fetch(uep, range(4), 2, 1))
+
+    def test_stop_early(self):
+        uep = BatchingUEP(range(40))
+        fetcher = iter(self._fetch(uep, range(40), 1, 2))
+        fetcher.next()
+        fetcher.close()
+        self.assertTrue(len(uep.calls) < 40)
+
+    def test_defaults(self):
+        fetcher = entcertlib.EntitlementCertBatchFetcher(Mock(), 'uuid', range(5))
+        self.assertEquals(entcertlib.DEFAULT_CERT_BATCH_SIZE, fetcher.batch_size)
+        self.assertEquals(entcertlib.DEFAULT_CERT_WORKERS, fetcher.workers)
+
+
 class UpdateActionTests(fixture.SubManFixture):
 
     @patch("subscription_manager.entcertlib.EntitlementCertBundleInstaller.build_cert")
@@ -103,6 +282,44 @@ class UpdateActionTests(fixture.SubManFixture):
         self.assertTrue(valid_ent.serial in update_report.expected)
         self.assertTrue(expired_ent.serial in update_report.expected)
 
+    @patch("subscription_manager.entcertlib.EntitlementCertBundleInstaller.build_cert")
+    @patch.object(Writer, "write")
+    @patch.object(entcertlib, "DEFAULT_CERT_BATCH_SIZE", 2)
+    def test_install_in_batches(self, write_mock, build_cert_mock):
+        cp_certificates = [StubEntitlementCertificate(StubProduct("P%s" % i))
+                           for i in range(5)]
+        uep = BatchingUEP([])
+        uep.bundles = dict((str(c.serial), {'key': Mock(), 'cert': c})
+                           for c in cp_certificates)
+        build_cert_mock.side_effect = lambda bundle: (bundle['key'], bundle['cert'])
+        self.set_consumer_auth_cp(uep)
+        inj.provide(inj.ENT_DIR, StubEntitlementDirectory([]))
+
+        update_action = TestingUpdateAction()
+        update_action.install([c.serial for c in cp_certificates])
+
+        self.assertEquals(3, len(uep.calls))
+        self.assertEquals(5, len(update_action.report.added))
+        self.assertEquals(5, write_mock.call_count)
+
+    @patch("subscription_manager.entcertlib.EntitlementCertBundleInstaller.build_cert")
+    @patch.object(Writer, "commit")
+    @patch.object(Writer, "write")
+    def test_failed_commit_not_reported_added(self, write_mock, commit_mock, build_cert_mock):
+        ents = [StubEntitlementCertificate(StubProduct("P%s" % i)) for i in range(2)]
+        build_cert_mock.side_effect = lambda bundle: (bundle['key'], bundle['cert'])
+        error = OSError("no space left")
+        commit_mock.return_value = [(ents[1], error)]
+        inj.provide(inj.ENT_DIR, StubEntitlementDirectory([]))
+
+        report = entcertlib.EntCertUpdateReport()
+        installer = entcertlib.EntitlementCertBundlesInstaller(report)
+        installer.install([{'key': Mock(), 'cert': ent} for ent in ents])
+
+        self.assertEquals([ents[0]], report.added)
+        self.assertEquals([error], report.exceptions())
+        self.assertEquals(1, commit_mock.call_count)
+
     def test_delete(self):
         ent = StubEntitlementCertificate(StubProduct("Prod"))
         ent.delete = Mock(side_effect=OSError("Cert has already been deleted"))
@@ -4,6 +4,7 @@ from mock import patch
 
 import fixture
 from stubs import StubEntitlementDirectory, StubProductDirectory
+from subscription_manager import cacheformat
 from subscription_manager import facts
 from rhsm import ourjson as json
 
@@ -129,13 +130,13 @@ class TestFacts(fixture.SubManFixture):
         super(TestFacts, self).setUp()
 
         self.fact_cache_dir = tempfile.mkdtemp()
-        fact_cache = self.fact_cache_dir + "/facts.json"
-        fd = open(fact_cache, "w")
+        # a JSON cache, from before facts were cached compact
+        fd = open(self.fact_cache_dir + "/facts.json", "w")
         fd.write(facts_buf)
         fd.close()
         self.f = facts.Facts(ent_dir=StubEntitlementDirectory([]),
                              prod_dir=StubProductDirectory([]))
-        self.f.CACHE_FILE = fact_cache
+        self.f.CACHE_FILE = self.fact_cache_dir + "/facts.cache"
 
     def tearDown(self):
         super(TestFacts, self).tearDown()
@@ -278,7 +279,7 @@ class TestFacts(fixture.SubManFixture):
              'cpu.cpu_socket(s)': '128',
              'newstuff': 'newstuff_is_true'}
         fact_cache_dir = tempfile.mkdtemp()
-        fact_cache = fact_cache_dir + "/facts.json"
+        fact_cache = fact_cache_dir + "/facts.cache"
 
         # write to a new file
         self.f.fact_cache_dir = fact_cache_dir
@@ -289,7 +290,7 @@ class TestFacts(fixture.SubManFixture):
         self.f.write_cache()
 
         new_facts_buf = open(fact_cache).read()
-        new_facts = json.loads(new_facts_buf)
+        new_facts = cacheformat.loads(new_facts_buf)
         self.assertEquals(new_facts['newstuff'], 'newstuff_is_true')
 
     @patch('subscription_manager.facts.Facts._load_custom_facts',
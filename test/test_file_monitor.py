@@ -3,6 +3,7 @@ import shutil
 import os
 
 import mock
+from nose.plugins.skip import SkipTest
 
 import fixture
 
@@ -56,6 +57,116 @@ class TestMonitorDirectory(fixture.SubManFixture):
             shutil.rmtree(self.temp_dir)
 
 
+class TestDirectoryChanges(fixture.SubManFixture):
+    def test_empty(self):
+        self.assertFalse(file_monitor.DirectoryChanges())
+
+    def test_full_rescan(self):
+        self.assertTrue(file_monitor.DirectoryChanges(full_rescan=True))
+
+    def test_created_then_deleted(self):
+        changes = file_monitor.DirectoryChanges()
+        changes.add_created('1.pem')
+        changes.add_modified('1.pem')
+        self.assertEquals(set(['1.pem']), changes.created)
+        self.assertEquals(set(), changes.modified)
+        changes.add_deleted('1.pem')
+        self.assertEquals(set(), changes.created)
+        self.assertEquals(set(['1.pem']), changes.deleted)
+
+
+class TestMonitorDirectoryChanges(fixture.SubManFixture):
+    klass = file_monitor.MonitorDirectory
+
+    def setUp(self):
+        super(TestMonitorDirectoryChanges, self).setUp()
+        self.temp_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp-file_monitor')
+        self.changes = []
+        self.md = self.klass(self.temp_dir, self.changes.append)
+        self.changes[:] = []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, name, content="something"):
+        f = open(os.path.join(self.temp_dir, name), 'w')
+        f.write(content)
+        f.close()
+
+    def _update_until_changed(self, change):
+        # the polling monitor only notices a change of the dir mtime
+        mtime = os.path.getmtime(self.temp_dir)
+        change()
+        while not self.md.update():
+            os.utime(self.temp_dir, (mtime + 1, mtime + 1))
+
+    def test_created(self):
+        self._update_until_changed(lambda: self._write('1.pem'))
+        self.assertEquals(set(['1.pem']), self.changes[-1].created)
+
+    def test_deleted(self):
+        self._update_until_changed(lambda: self._write('1.pem'))
+        self._update_until_changed(lambda: os.unlink(os.path.join(self.temp_dir, '1.pem')))
+        self.assertEquals(set(['1.pem']), self.changes[-1].deleted)
+
+
+class TestInotifyMonitorDirectory(TestMonitorDirectoryChanges):
+    klass = file_monitor.InotifyMonitorDirectory
+
+    def setUp(self):
+        try:
+            file_monitor.InotifyMonitorDirectory(tempfile.gettempdir()).close()
+        except OSError:
+            raise SkipTest("inotify is not available")
+        super(TestInotifyMonitorDirectory, self).setUp()
+
+    def tearDown(self):
+        self.md.close()
+        super(TestInotifyMonitorDirectory, self).tearDown()
+
+    def test_no_events(self):
+        self.assertFalse(self.md.update())
+        self.assertEquals([], self.changes)
+
+    def test_modified(self):
+        self._write('1.pem')
+        self.md.update()
+        self._write('1.pem', "something else")
+        self.assertTrue(self.md.update())
+        self.assertEquals(set(['1.pem']), self.changes[-1].modified)
+
+    def test_fileno(self):
+        fm = file_monitor.MonitorDirectories(dir_monitors=[self.md])
+        self.assertEquals([self.md.fileno()], fm.filenos())
+        self.assertFalse(fm.needs_polling())
+
+    def test_watch_lost_until_recreated(self):
+        shutil.rmtree(self.temp_dir)
+        self.assertTrue(self.md.update())
+        self.assertTrue(self.changes[-1].full_rescan)
+        self.assertEquals(None, self.md.fileno())
+        fm = file_monitor.MonitorDirectories(dir_monitors=[self.md])
+        self.assertTrue(fm.needs_polling())
+
+        self.assertFalse(self.md.update())
+
+        os.mkdir(self.temp_dir)
+        self.assertTrue(self.md.update())
+        self.assertTrue(self.changes[-1].full_rescan)
+        self.assertFalse(fm.needs_polling())
+
+        self._write('1.pem')
+        self.assertTrue(self.md.update())
+        self.assertEquals(set(['1.pem']), self.changes[-1].created)
+
+    def test_close(self):
+        fm = file_monitor.MonitorDirectories(dir_monitors=[self.md])
+        fm.close()
+        self.assertEquals(None, self.md.fileno())
+        self._write('1.pem')
+        self.assertFalse(self.md.update())
+
+
 class TestMonitorDirectories(fixture.SubManFixture):
     def setUp(self):
         super(TestMonitorDirectories, self).setUp()
@@ -75,6 +186,12 @@ class TestMonitorDirectories(fixture.SubManFixture):
         fm.update()
         self.assertEquals(callback_result, [])
 
+    def test_needs_polling(self):
+        mock_dir = file_monitor.MonitorDirectory("/not/a/real/path")
+        fm = file_monitor.MonitorDirectories(dir_monitors=[mock_dir])
+        self.assertTrue(fm.needs_polling())
+        self.assertEquals([], fm.filenos())
+
     def test_from_path_list(self):
         self.temp_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp-file_monitor')
 
@@ -30,6 +30,21 @@ class TestContent(fixture.SubManFixture):
         self._check_attrs(content)
         self.assertTrue(isinstance(content.tags, list))
 
+    def test_no_instance_dict(self):
+        content = model.Content("yum", "content name", "content-label")
+        self.assertFalse(hasattr(content, '__dict__'))
+
+    def test_repeated_strings_shared(self):
+        # built at runtime, so not already interned constants
+        gpg = ''.join(["http://example.com/", "gpg"])
+        tag = ''.join(["awesomeos-", "1"])
+        first = model.Content("yum", "first", "first", gpg=gpg, tags=[tag])
+        second = model.Content("yum", "second", "second",
+                               gpg=''.join(["http://example.com/", "gpg"]),
+                               tags=[''.join(["awesomeos-", "1"])])
+        self.assertTrue(first.gpg is second.gpg)
+        self.assertTrue(first.tags[0] is second.tags[0])
+
     def _check_attrs(self, content):
         attrs = ['content_type', 'name', 'label', 'url', 'gpg', 'tags', 'cert']
         for attr in attrs:
@@ -406,3 +421,44 @@ class TestFindContent(fixture.SubManFixture):
                                          content_type="ostree")
         self.assertEquals(1, len(ostree_list))
         self.assertEquals('ostree_content', ostree_list[0].name)
+
+
+class TestContentIndex(fixture.SubManFixture):
+    def _ent_source(self):
+        esb = EntitlementSourceBuilder()
+        es = esb.ent_source()
+        es.product_tags = ['awesomeos-1']
+        return es
+
+    def test_content_type_case(self):
+        content = create_mock_content(name="container_content",
+                                      content_type="containerImage")
+        index = model.ContentIndex([model.Entitlement(contents=[content])], [])
+        self.assertEquals([content], index.find('containerimage'))
+        self.assertEquals([content], index.find('CONTAINERIMAGE'))
+        self.assertEquals([], index.find('yum'))
+
+    def test_find_returns_copy(self):
+        index = self._ent_source().get_content_index()
+        index.find('yum').pop()
+        self.assertEquals(4, len(index.find('yum')))
+
+    def test_index_reused(self):
+        es = self._ent_source()
+        self.assertTrue(es.get_content_index() is es.get_content_index())
+
+    def test_index_rebuilt_for_new_product_tags(self):
+        es = self._ent_source()
+        index = es.get_content_index()
+        es.product_tags = ['awesomeos-2']
+        self.assertFalse(index is es.get_content_index())
+        self.assertEquals(frozenset(['awesomeos-2']),
+                          es.get_content_index().product_tags)
+
+    def test_index_rebuilt_for_added_entitlement(self):
+        es = self._ent_source()
+        index = es.get_content_index()
+        content = create_mock_content(name="ostree_content", content_type="ostree")
+        es._entitlements.append(model.Entitlement(contents=[content]))
+        self.assertFalse(index is es.get_content_index())
+        self.assertEquals([content], model.find_content(es, content_type="ostree"))
@@ -6,10 +6,12 @@ import unittest
 
 import yum
 
+import certdata
 import stubs
 from subscription_manager import productid
 from subscription_manager import certdirectory
 
+from rhsm.certificate import create_from_pem, CertificateException
 from rhsm.certificate2 import Product
 
 from mock import Mock, patch
@@ -261,7 +263,7 @@ class TestProductDatabase(unittest.TestCase):
         self.pdb.add("product", "repo")
         self.pdb.write()
 
-    @patch('subscription_manager.productid.json.dump', side_effect=IOError)
+    @patch('subscription_manager.productid.json.dumps', side_effect=IOError)
     def test_write_exception(self, mock_dumps):
         self.pdb.add("product", "repo")
         # mostly looking for no exception here
@@ -299,6 +301,76 @@ class TestProductDatabase(unittest.TestCase):
         repo = self.pdb.find_repos("product")
         self.assertTrue("repo" in repo)
 
+    def _written(self):
+        pdb = productid.ProductDatabase()
+        pdb.read()
+        return pdb.content
+
+    def test_read_is_lazy(self):
+        self.pdb.add("product", "repo")
+        self.pdb.write()
+        pdb = productid.ProductDatabase()
+        with patch('subscription_manager.productid.json.load') as mock_load:
+            mock_load.return_value = {"product": ["repo"]}
+            pdb.read()
+            self.assertFalse(mock_load.called)
+            self.assertEquals(["repo"], pdb.find_repos("product"))
+            self.assertEquals(1, mock_load.call_count)
+
+    def test_delete_repo(self):
+        self.pdb.add("product", "repo1")
+        self.pdb.add("product", "repo2")
+        self.pdb.delete("product", "repo1")
+        self.assertEquals(["repo2"], self.pdb.find_repos("product"))
+        self.pdb.delete("product", "repo2")
+        self.assertEquals(None, self.pdb.find_repos("product"))
+
+    def test_delete_unknown(self):
+        self.pdb.delete("product")
+        self.pdb.delete("product", "repo")
+        self.assertFalse(self.pdb._dirty)
+
+    @patch('subscription_manager.productid.json.dumps')
+    def test_write_unchanged(self, mock_dump):
+        self.pdb.read()
+        self.pdb.write()
+        self.assertFalse(mock_dump.called)
+
+    def test_write_batched(self):
+        self.pdb.begin()
+        self.pdb.add("product", "repo1")
+        self.pdb.write()
+        self.assertEquals({}, self._written())
+        self.pdb.add("product", "repo2")
+        self.pdb.commit()
+        self.assertEquals({"product": ["repo1", "repo2"]}, self._written())
+        self.assertEquals(['productid.js'], os.listdir(self.temp_dir))
+
+    @patch('subscription_manager.productid.log')
+    @patch('subscription_manager.productid.json.dumps', side_effect=IOError)
+    def test_write_exception_keeps_database(self, mock_dump, mock_log):
+        self.pdb.add("product", "repo")
+        self.pdb.write()
+        self.assertTrue(mock_log.error.called)
+        self.assertEquals({}, self._written())
+        self.assertEquals(['productid.js'], os.listdir(self.temp_dir))
+
+    def test_write_rename_error_raises(self):
+        self.pdb.add("product", "repo")
+        with patch('os.rename', side_effect=OSError):
+            self.assertRaises(OSError, self.pdb.write)
+        self.assertEquals({}, self._written())
+        self.assertEquals(['productid.js'], os.listdir(self.temp_dir))
+        # still dirty, so the next write tries again
+        self.pdb.write()
+        self.assertEquals({"product": ["repo"]}, self._written())
+
+    @patch('os.fsync')
+    def test_write_fsyncs(self, mock_fsync):
+        self.pdb.add("product", "repo")
+        self.pdb.write()
+        self.assertEquals(1, mock_fsync.call_count)
+
     def test_find_repos_old_format(self):
         self.pdb.populate_content({'product': 'repo'})
         repo = self.pdb.find_repos("product")
@@ -361,9 +433,26 @@ class TestProductManager(SubManFixture):
         SubManFixture.setUp(self)
         self.prod_dir = stubs.StubProductDirectory([])
         self.prod_db_mock = Mock()
+        self.cache_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.cache_file_patcher = patch.object(productid.ActiveRepoCache, 'CACHE_FILE',
+                                               os.path.join(self.cache_dir, 'active_repos.json'))
+        self.cache_file_patcher.start()
+        self.productid_cache_patcher = patch.object(productid.ProductIdMetadataCache, 'CACHE_FILE',
+                                                    os.path.join(self.cache_dir, 'productid.json'))
+        self.productid_cache_patcher.start()
+        self.rpmdb_patcher = patch('subscription_manager.productid.rpmdb_signature')
+        self.mock_rpmdb_signature = self.rpmdb_patcher.start()
+        self.mock_rpmdb_signature.return_value = None
         self.prod_mgr = productid.ProductManager(product_dir=self.prod_dir,
                 product_db=self.prod_db_mock)
 
+    def tearDown(self):
+        self.rpmdb_patcher.stop()
+        self.cache_file_patcher.stop()
+        self.productid_cache_patcher.stop()
+        shutil.rmtree(self.cache_dir)
+        SubManFixture.tearDown(self)
+
     def test_removed(self):
         # non rhel cert, not in active, with enabled repo
         self.prod_db_mock.find_repos.return_value = ["repo1"]
@@ -419,11 +508,80 @@ class TestProductManager(SubManFixture):
         self.assertTrue(mock_repo.id in self.prod_mgr.meta_data_errors)
         self.assertFalse(mock_log.exception.called)
 
+    def _create_revisioned_repo(self, repo_id, checksum):
+        mock_repo = self._create_mock_repo(repo_id)
+        mock_repo.repoXML = Mock()
+        mock_repo.repoXML.getData.return_value.checksum = ('sha256', checksum)
+        return mock_repo
+
+    def _get_enabled_with_new_manager(self, mock_repo):
+        prod_mgr = productid.ProductManager(product_dir=self.prod_dir,
+                                            product_db=self.prod_db_mock)
+        prod_mgr._get_cert = Mock(return_value=create_from_pem(certdata.PRODUCT_CERT_V1_0))
+        mock_yb = Mock(spec=yum.YumBase)
+        mock_yb.repos.listEnabled.return_value = [mock_repo]
+        return prod_mgr, prod_mgr.get_enabled(mock_yb)
+
+    def test_get_enabled_cached(self):
+        mock_repo = self._create_revisioned_repo('rhel-6-server', 'abc')
+        prod_mgr, enabled = self._get_enabled_with_new_manager(mock_repo)
+        self.assertEquals(1, prod_mgr._get_cert.call_count)
+
+        mock_repo.retrieveMD.reset_mock()
+        prod_mgr, cached = self._get_enabled_with_new_manager(mock_repo)
+        self.assertFalse(prod_mgr._get_cert.called)
+        self.assertFalse(mock_repo.retrieveMD.called)
+        self.assertEquals([(enabled[0][0].products[0].id, 'rhel-6-server')],
+                          [(cert.products[0].id, repo) for (cert, repo) in cached])
+        self.assertEquals(enabled[0][0].x509.as_pem(), cached[0][0].pem)
+
+    def test_get_enabled_metadata_changed(self):
+        mock_repo = self._create_revisioned_repo('rhel-6-server', 'abc')
+        self._get_enabled_with_new_manager(mock_repo)
+
+        mock_repo = self._create_revisioned_repo('rhel-6-server', 'def')
+        prod_mgr, enabled = self._get_enabled_with_new_manager(mock_repo)
+        self.assertEquals(1, prod_mgr._get_cert.call_count)
+        self.assertEquals(1, len(enabled))
+
+    @patch('subscription_manager.productid.log')
+    def test_get_enabled_cached_error(self, mock_log):
+        mock_repo = self._create_revisioned_repo('rhel-6-server', 'abc')
+        prod_mgr = productid.ProductManager(product_dir=self.prod_dir,
+                                            product_db=self.prod_db_mock)
+        prod_mgr._get_cert = Mock(side_effect=CertificateException("Error loading certificate"))
+        mock_yb = Mock(spec=yum.YumBase)
+        mock_yb.repos.listEnabled.return_value = [mock_repo]
+        prod_mgr.get_enabled(mock_yb)
+
+        prod_mgr, enabled = self._get_enabled_with_new_manager(mock_repo)
+        self.assertEquals([], enabled)
+        self.assertFalse(prod_mgr._get_cert.called)
+        self.assertEquals(['rhel-6-server'], prod_mgr.meta_data_errors)
+
+    @patch('subscription_manager.productid.log')
+    def test_get_enabled_io_error_not_cached(self, mock_log):
+        mock_repo = self._create_revisioned_repo('rhel-6-server', 'abc')
+        mock_repo.retrieveMD.side_effect = IOError("timed out")
+        prod_mgr = productid.ProductManager(product_dir=self.prod_dir,
+                                            product_db=self.prod_db_mock)
+        mock_yb = Mock(spec=yum.YumBase)
+        mock_yb.repos.listEnabled.return_value = [mock_repo]
+        prod_mgr.get_enabled(mock_yb)
+        self.assertEquals(['rhel-6-server'], prod_mgr.meta_data_errors)
+
+        mock_repo.retrieveMD.side_effect = None
+        prod_mgr, enabled = self._get_enabled_with_new_manager(mock_repo)
+        self.assertEquals(1, prod_mgr._get_cert.call_count)
+        self.assertEquals(1, len(enabled))
+        self.assertEquals([], prod_mgr.meta_data_errors)
+
     def test_get_active_no_packages(self):
         cert = self._create_server_cert()
         self.prod_dir.certs.append(cert)
         mock_yb = Mock(spec=yum.YumBase)
         mock_yb.pkgSack.returnPackages.return_value = []
+        self._set_installed(mock_yb, [])
         active = self.prod_mgr.get_active(mock_yb)
         self.assertEquals(set([]), active)
 
@@ -434,6 +592,7 @@ class TestProductManager(SubManFixture):
         mock_package.name = 'some-cool-package'
         mock_package.arch = 'noarch'
         mock_yb.pkgSack.returnPackages.return_value = [mock_package]
+        self._set_installed(mock_yb, [mock_package])
         active = self.prod_mgr.get_active(mock_yb)
         self.assertEquals(set([mock_package.repoid]), active)
 
@@ -445,10 +604,111 @@ class TestProductManager(SubManFixture):
         mock_package.arch = 'noarch'
         mock_yb.pkgSack.returnPackages.return_value = [mock_package]
         # No packages in the enabled repo 'this-is-not-a-rh-repo' are installed.
-        mock_yb.rpmdb.searchNevra.return_value = False
+        self._set_installed(mock_yb, [])
         active = self.prod_mgr.get_active(mock_yb)
         self.assertEquals(set([]), active)
 
+    def test_get_active_matches_name_and_arch(self):
+        mock_yb = Mock(spec=yum.YumBase)
+        mock_yb.pkgSack.returnPackages.return_value = \
+            self._create_mock_packages([('some-cool-package', 'x86_64', 'repo-1'),
+                                        ('some-cool-package', 'i686', 'repo-2'),
+                                        ('some-cool-package', 'x86_64', 'repo-3')])
+        self._set_installed(mock_yb, [self._create_mock_package('some-cool-package',
+                                                                'x86_64',
+                                                                'installed')])
+        active = self.prod_mgr.get_active(mock_yb)
+        self.assertEquals(set(['repo-1', 'repo-3']), active)
+
+    def _mock_ts_info(self, installed=None, removed=None):
+        members = {}
+        for (states, packages) in ((yum.constants.TS_INSTALL_STATES, installed),
+                                   (yum.constants.TS_REMOVE_STATES, removed)):
+            members[tuple(states)] = self._create_mock_packages(packages or [])
+        ts_info = Mock()
+        ts_info.getMembersWithState.side_effect = \
+            lambda output_states: members[tuple(output_states)]
+        return ts_info
+
+    def _mock_yb_with_repos(self, repo_ids):
+        mock_yb = Mock(spec=yum.YumBase)
+        mock_yb.repos.listEnabled.return_value = self._create_mock_repos(repo_ids)
+        return mock_yb
+
+    def test_find_active_cached(self):
+        self.mock_rpmdb_signature.return_value = ['Packages', 1, 2, 3]
+        mock_yb = self._mock_yb_with_repos(['repo-1', 'repo-2'])
+        self.prod_mgr.get_active = Mock(return_value=set(['repo-1']))
+        self.assertEquals(set(['repo-1']), self.prod_mgr.find_active(mock_yb))
+
+        prod_mgr = productid.ProductManager(product_dir=self.prod_dir,
+                                            product_db=self.prod_db_mock)
+        prod_mgr.get_active = Mock()
+        self.assertEquals(set(['repo-1']), prod_mgr.find_active(mock_yb))
+        self.assertFalse(prod_mgr.get_active.called)
+
+    def test_find_active_enabled_repos_changed(self):
+        self.mock_rpmdb_signature.return_value = ['Packages', 1, 2, 3]
+        self.prod_mgr.get_active = Mock(return_value=set(['repo-1']))
+        self.prod_mgr.find_active(self._mock_yb_with_repos(['repo-1']))
+        self.prod_mgr.find_active(self._mock_yb_with_repos(['repo-1', 'repo-2']))
+        self.assertEquals(2, self.prod_mgr.get_active.call_count)
+
+    def test_find_active_without_rpmdb_not_cached(self):
+        self.prod_mgr.get_active = Mock(return_value=set(['repo-1']))
+        self.prod_mgr.find_active(self._mock_yb_with_repos(['repo-1']))
+        self.prod_mgr.find_active(self._mock_yb_with_repos(['repo-1']))
+        self.assertEquals(2, self.prod_mgr.get_active.call_count)
+        self.assertFalse(os.path.exists(productid.ActiveRepoCache.CACHE_FILE))
+
+    def test_find_active_updated_from_transaction(self):
+        before = ['Packages', 1, 2, 3]
+        self.mock_rpmdb_signature.return_value = before
+        mock_yb = self._mock_yb_with_repos(['repo-1', 'repo-2'])
+        self.prod_mgr.get_active = Mock(return_value=set(['repo-1']))
+        self.prod_mgr.find_active(mock_yb)
+
+        self.mock_rpmdb_signature.return_value = ['Packages', 1, 5, 3]
+        mock_yb.pkgSack.searchNevra.return_value = \
+            self._create_mock_packages([('some-cool-package', 'noarch', 'repo-2')])
+        ts_info = self._mock_ts_info(installed=[('some-cool-package', 'noarch', 'repo-2')])
+        active = self.prod_mgr.find_active(mock_yb, ts_info, before)
+
+        self.assertEquals(set(['repo-1', 'repo-2']), active)
+        self.assertEquals(1, self.prod_mgr.get_active.call_count)
+
+    def test_find_active_removed_package_found_again(self):
+        before = ['Packages', 1, 2, 3]
+        self.mock_rpmdb_signature.return_value = before
+        mock_yb = self._mock_yb_with_repos(['repo-1', 'repo-2'])
+        self.prod_mgr.get_active = Mock(return_value=set(['repo-1', 'repo-2']))
+        self.prod_mgr.find_active(mock_yb)
+
+        self.mock_rpmdb_signature.return_value = ['Packages', 1, 5, 3]
+        self._set_installed(mock_yb, [])
+        self.prod_mgr.get_active.return_value = set(['repo-1'])
+        ts_info = self._mock_ts_info(removed=[('some-cool-package', 'noarch', 'repo-2')])
+        active = self.prod_mgr.find_active(mock_yb, ts_info, before)
+
+        self.assertEquals(set(['repo-1']), active)
+        self.assertEquals(2, self.prod_mgr.get_active.call_count)
+
+    def test_find_active_removed_other_version_still_installed(self):
+        before = ['Packages', 1, 2, 3]
+        self.mock_rpmdb_signature.return_value = before
+        mock_yb = self._mock_yb_with_repos(['repo-1'])
+        self.prod_mgr.get_active = Mock(return_value=set(['repo-1']))
+        self.prod_mgr.find_active(mock_yb)
+
+        self.mock_rpmdb_signature.return_value = ['Packages', 1, 5, 3]
+        kernel = [('kernel', 'x86_64', 'repo-1')]
+        self._set_installed(mock_yb, self._create_mock_packages(kernel))
+        ts_info = self._mock_ts_info(removed=kernel)
+        active = self.prod_mgr.find_active(mock_yb, ts_info, before)
+
+        self.assertEquals(set(['repo-1']), active)
+        self.assertEquals(1, self.prod_mgr.get_active.call_count)
+
     def test_get_active_with_active_packages_rhel57_installed_repo(self):
         """rhel5.7 says every package is in 'installed' repo"""
         mock_yb = Mock(spec=yum.YumBase)
@@ -457,6 +717,7 @@ class TestProductManager(SubManFixture):
         mock_package.name = 'some-cool-package'
         mock_package.arch = 'noarch'
         mock_yb.pkgSack.returnPackages.return_value = [mock_package]
+        self._set_installed(mock_yb, [mock_package])
         active = self.prod_mgr.get_active(mock_yb)
         self.assertEquals(set([]), active)
 
@@ -588,6 +849,7 @@ class TestProductManager(SubManFixture):
         cert = self._create_server_cert()
         self.prod_dir.certs.append(cert)
         mock_yb.pkgSack.returnPackages.return_value = []
+        self._set_installed(mock_yb, [])
         mock_yb.repos.listEnabled.return_value = []
         self.prod_mgr.update(yb=None)
 
@@ -599,6 +861,7 @@ class TestProductManager(SubManFixture):
 
         mock_yb = Mock(spec=yum.YumBase)
         mock_yb.pkgSack.returnPackages.return_value = []
+        self._set_installed(mock_yb, [])
         mock_yb.repos.listEnabled.return_value = []
 
         self.prod_mgr.update(mock_yb)
@@ -606,6 +869,22 @@ class TestProductManager(SubManFixture):
         # should be no product id db writing in this case
         self.assert_nothing_happened()
 
+    def test_update_writes_db_once(self):
+        mock_yb = Mock(spec=yum.YumBase)
+        mock_yb.pkgSack.returnPackages.return_value = []
+        self._set_installed(mock_yb, [])
+        mock_yb.repos.listEnabled.return_value = []
+
+        self.prod_mgr.update_installed = Mock(side_effect=lambda enabled, active:
+                                              self.assertTrue(self.prod_db_mock.begin.called))
+        self.prod_mgr.update(mock_yb)
+        self.assertTrue(self.prod_mgr.update_installed.called)
+        self.assertEquals(1, self.prod_db_mock.commit.call_count)
+
+    def _set_installed(self, mock_yb, packages):
+        mock_yb.rpmdb.simplePkgList.return_value = \
+            [(p.name, p.arch, '0', '1.0', '1') for p in packages]
+
     def _create_mock_package(self, name, arch, repoid):
         mock_package = Mock(spec=yum.rpmsack.RPMInstalledPackage)
         mock_package.repoid = repoid
@@ -668,10 +947,7 @@ class TestProductManager(SubManFixture):
                                                  anaconda_repo)
 
         mock_yb.pkgSack.returnPackages.return_value = [mock_package]
-
-        # we only test existince of this guy... which might not
-        # be correct?
-        mock_yb.rpmdb.searchNevra.return_value = Mock()
+        self._set_installed(mock_yb, [mock_package])
 
         self.prod_repo_map = {'69': [anaconda_repo, "rhel-6-server-rpms"]}
         self.prod_db_mock.find_repos = Mock(side_effect=self.find_repos_side_effect)
@@ -717,10 +993,7 @@ class TestProductManager(SubManFixture):
                                                  random_repo)
 
         mock_yb.pkgSack.returnPackages.return_value = [mock_package]
-
-        # we only test existince of this guy... which might not
-        # be correct?
-        mock_yb.rpmdb.searchNevra.return_value = Mock()
+        self._set_installed(mock_yb, [mock_package])
 
         # rhel6 product cert installed (by hand?)
         # but it is not in the product db
@@ -767,6 +1040,7 @@ class TestProductManager(SubManFixture):
                                                      'noarch',
                                                      'rhel-6-server-rpms')])
         mock_yb.pkgSack.returnPackages.return_value = mock_packages
+        self._set_installed(mock_yb, mock_packages)
 
         mock_yb.repos.listEnabled.return_value = self._create_mock_repos(['rhel-6-server-rpms'])
         # only one product cert, so find_repos is simple to mock
@@ -797,6 +1071,7 @@ class TestProductManager(SubManFixture):
                                                      'noarch',
                                                      'rhel-6-server-rpms')])
         mock_yb.pkgSack.returnPackages.return_value = mock_packages
+        self._set_installed(mock_yb, mock_packages)
 
         mock_repo_ids = ['rhel-6-server-rpms',
                          'rhel-6-mock-repo-2',
@@ -833,6 +1108,7 @@ class TestProductManager(SubManFixture):
                                                  'noarch',
                                                  'rhel-6-server-rpms')
         mock_yb.pkgSack.returnPackages.return_value = [mock_package]
+        self._set_installed(mock_yb, [mock_package])
 
         mock_yb.repos.listEnabled.return_value = self._create_mock_repos(['rhel-6-server-rpms'])
 
@@ -868,6 +1144,7 @@ class TestProductManager(SubManFixture):
                                                  'noarch',
                                                  'rhel-6-server-rpms')
         mock_yb.pkgSack.returnPackages.return_value = [mock_package]
+        self._set_installed(mock_yb, [mock_package])
 
         mock_yb.repos.listEnabled.return_value = self._create_mock_repos(['rhel-6-server-rpms'])
 
@@ -903,6 +1180,7 @@ class TestProductManager(SubManFixture):
                                                  'noarch',
                                                  'rhel-6-server-rpms')
         mock_yb.pkgSack.returnPackages.return_value = [mock_package]
+        self._set_installed(mock_yb, [mock_package])
 
         mock_yb.repos.listEnabled.return_value = self._create_mock_repos(['rhel-6-server-rpms'])
 
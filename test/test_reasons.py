@@ -180,6 +180,16 @@ class ReasonsTests(unittest.TestCase):
         sub_reason_map = self.sorter.reasons.get_subscription_reasons_map()
         self.assertTrue(ENT_ID_2 in sub_reason_map)
 
+    def test_index_follows_valid_certs(self):
+        self.assertEquals(1, len(self.sorter.reasons.get_subscription_reasons(ENT_ID_2)))
+        self.sorter.valid_entitlement_certs = []
+        self.assertEquals([], self.sorter.reasons.get_subscription_reasons(ENT_ID_2))
+        self.assertEquals([], self.sorter.reasons.get_product_subscriptions(PROD_4))
+
+    def test_get_subscription_reasons_returns_copy(self):
+        self.sorter.reasons.get_subscription_reasons(ENT_ID_2).append('changed')
+        self.assertEquals(1, len(self.sorter.reasons.get_subscription_reasons(ENT_ID_2)))
+
     def test_get_reason_id(self):
         reason = self.build_ent_reason_with_attrs(
                 'SOCKETS', 'some message', '8', '6', ent='1234')
@@ -14,19 +14,20 @@
 # in this software or its documentation.
 #
 
+import os
 import re
+import shutil
+import tempfile
 import unittest
 
-from iniparse import RawConfigParser
-from mock import Mock, patch
-from StringIO import StringIO
+from mock import Mock, NonCallableMock, patch
 
 import fixture
 from stubs import StubCertificateDirectory, StubProductCertificate, \
         StubProduct, StubEntitlementCertificate, StubContent, \
         StubProductDirectory, StubConsumerIdentity, StubEntitlementDirectory
 from subscription_manager.repolib import Repo, RepoActionInvoker, \
-        RepoUpdateActionCommand, TidyWriter, RepoFile, YumReleaseverSource
+        RepoUpdateActionCommand, RepoFile, YumReleaseverSource
 from subscription_manager import injection as inj
 
 from subscription_manager import repolib
@@ -121,6 +122,78 @@ class RepoTests(unittest.TestCase):
         existing_repo['fake_prop'] = 'fake'
         self.assertTrue(('fake_prop', 'fake') in existing_repo.items())
 
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(Repo('testrepo'), '__dict__'))
+
+
+class RepoBuildContextTests(unittest.TestCase):
+    def _content(self, label, url, gpg=None, cert=None):
+        content = Mock()
+        content.label = label
+        content.name = label
+        content.enabled = True
+        content.url = url
+        content.gpg = gpg
+        content.cert = cert or Mock()
+        content.metadata_expire = None
+        return content
+
+    def _context(self, release_source=None):
+        if release_source is None:
+            release_source = Mock()
+            release_source.marker = YumReleaseverSource.marker
+            release_source.get_expansion.return_value = '7Server'
+        return repolib.RepoBuildContext("http://example.com", "/ca.pem",
+                                        release_source)
+
+    def test_releasever_expanded_once(self):
+        context = self._context()
+        repos = [Repo.from_content(self._content('r%d' % i, '/$releasever/%d' % i),
+                                   context) for i in range(3)]
+        self.assertEquals('http://example.com/7Server/2', repos[2]['baseurl'])
+        self.assertEquals(1, context.release_source.get_expansion.call_count)
+
+    def test_releasever_not_needed(self):
+        context = self._context()
+        repo = Repo.from_content(self._content('r', '/path'), context)
+        self.assertEquals('http://example.com/path', repo['baseurl'])
+        self.assertFalse(context.release_source.get_expansion.called)
+
+    def test_shared_values(self):
+        context = self._context()
+        cert = Mock()
+        cert.path = '/etc/pki/entitlement/1.pem'
+        cert.key_path.return_value = '/etc/pki/entitlement/1-key.pem'
+        first = Repo.from_content(self._content('a', '/a', gpg='/gpg', cert=cert),
+                                  context)
+        second = Repo.from_content(self._content('b', '/b', gpg='/gpg', cert=cert),
+                                   context)
+        self.assertEquals('http://example.com/gpg', first['gpgkey'])
+        self.assertTrue(first['gpgkey'] is second['gpgkey'])
+        self.assertEquals('/etc/pki/entitlement/1-key.pem', second['sslclientkey'])
+        self.assertEquals('/etc/pki/entitlement/1.pem', second['sslclientcert'])
+        self.assertEquals('/ca.pem', second['sslcacert'])
+        self.assertEquals(1, cert.key_path.call_count)
+
+    @patch('subscription_manager.repolib.CFG')
+    def test_proxy(self, mock_cfg):
+        values = {'proxy_hostname': 'proxy.example.com', 'proxy_port': '3128',
+                  'proxy_user': 'user', 'proxy_password': 'secret'}
+        mock_cfg.get.side_effect = lambda section, key: values[key]
+        repo = Repo.from_content(self._content('r', '/path'), self._context())
+        self.assertEquals('https://proxy.example.com:3128', repo['proxy'])
+        self.assertEquals('user', repo['proxy_username'])
+        self.assertEquals('secret', repo['proxy_password'])
+
+    def test_shared_across_updates(self):
+        cert = Mock()
+        cert.path = '/etc/pki/entitlement/1.pem'
+        cert.key_path.return_value = '/etc/pki/entitlement/1-key.pem'
+        repos = [Repo.from_content(self._content('a', '/a', gpg='/gpg', cert=cert),
+                                   self._context()) for i in range(2)]
+        for key in ['gpgkey', 'sslclientkey', 'sslclientcert', 'proxy']:
+            self.assertTrue(repos[0][key] is repos[1][key])
+
 
 class RepoActionReportTests(fixture.SubManFixture):
     def test(self):
@@ -271,6 +344,120 @@ class RepoUpdateActionTests(fixture.SubManFixture):
         self.assertEquals('original', written_repo['gpgcheck'])
         self.assertEquals('new_key', written_repo['gpgkey'])
 
+    @patch("subscription_manager.repolib.RepoFile")
+    def test_unchanged_existing_repo_not_updated(self, mock_file):
+        self._inject_mock_invalid_consumer()
+        mock_file = mock_file.return_value
+        mock_file.section.return_value = Repo('x', [('gpgcheck', '1'), ('gpgkey', 'some_key')])
+        mock_file.sections.return_value = ['x']
+
+        def stub_content():
+            return [Repo('x', [('gpgcheck', '1'), ('gpgkey', 'some_key')])]
+
+        update_action = RepoUpdateActionCommand()
+        update_action.get_unique_content = stub_content
+        update_report = update_action.perform()
+        self.assertFalse(mock_file.update.called)
+        self.assertEquals(0, update_report.updates())
+
+    def test_diff_repo(self):
+        self._inject_mock_invalid_consumer()
+        update_action = RepoUpdateActionCommand()
+        existing_repo = Repo('testrepo', [('name', 'meow'), ('gpgcheck', '0'),
+                                          ('proxy_username', 'blah')])
+        incoming_repo = {'name': 'woof', 'gpgcheck': '1', 'metadata_expire': 2000}
+        changes = update_action.diff_repo(existing_repo, incoming_repo)
+        self.assertEquals(sorted([('name', 'woof'), ('metadata_expire', 2000),
+                                  ('proxy_username', None)]),
+                          sorted(changes))
+        # diff_repo leaves the repo alone
+        self.assertEquals('meow', existing_repo['name'])
+        self.assertEquals(changes, update_action.update_repo(existing_repo, incoming_repo))
+        self.assertEquals([], update_action.diff_repo(existing_repo, incoming_repo))
+
+    def _perform_with_signature(self, mock_file, signature, cache_only=True):
+        mock_file.reset_mock()
+        mock_file.section.return_value = None
+        mock_file.sections.return_value = []
+        mock_file.stat_signature.return_value = signature
+        update_action = RepoUpdateActionCommand(cache_only=cache_only)
+        update_action.perform()
+        return update_action
+
+    @patch("subscription_manager.repolib.RepoFile")
+    def test_update_skipped_when_fingerprint_unchanged(self, mock_file):
+        mock_file = mock_file.return_value
+        self._perform_with_signature(mock_file, [10, 1.5, 2])
+        self.assertTrue(mock_file.write.called)
+
+        self._perform_with_signature(mock_file, [10, 1.5, 2])
+        self.assertFalse(mock_file.read.called)
+        self.assertFalse(mock_file.write.called)
+
+    @patch("subscription_manager.repolib.RepoFile")
+    def test_update_when_repo_file_changed(self, mock_file):
+        mock_file = mock_file.return_value
+        self._perform_with_signature(mock_file, [10, 1.5, 2])
+        self._perform_with_signature(mock_file, [12, 3.5, 2])
+        self.assertTrue(mock_file.write.called)
+
+    @patch("subscription_manager.repolib.RepoFile")
+    def test_update_when_ent_certs_changed(self, mock_file):
+        mock_file = mock_file.return_value
+        self._perform_with_signature(mock_file, [10, 1.5, 2])
+        self.stub_ent_cert.serial = self.stub_ent_cert.serial + 1
+        self._perform_with_signature(mock_file, [10, 1.5, 2])
+        self.assertTrue(mock_file.write.called)
+
+    @patch("subscription_manager.repolib.RepoFile")
+    def test_update_when_cert_validity_changes(self, mock_file):
+        mock_file = mock_file.return_value
+        with patch.object(RepoUpdateActionCommand, '_next_validity_change',
+                          return_value=1):
+            self._perform_with_signature(mock_file, [10, 1.5, 2])
+        self._perform_with_signature(mock_file, [10, 1.5, 2])
+        self.assertTrue(mock_file.write.called)
+
+    @patch("subscription_manager.repolib.RepoFile")
+    def test_update_when_server_release_changed(self, mock_file):
+        mock_file = mock_file.return_value
+        release_cache = NonCallableMock()
+        release_cache.read_status.return_value = {'releaseVer': '7.1'}
+        inj.provide(inj.RELEASE_STATUS_CACHE, release_cache)
+        self._perform_with_signature(mock_file, [10, 1.5, 2], cache_only=False)
+        self._perform_with_signature(mock_file, [10, 1.5, 2], cache_only=False)
+        self.assertFalse(mock_file.write.called)
+
+        release_cache.read_status.return_value = {'releaseVer': '7.2'}
+        self._perform_with_signature(mock_file, [10, 1.5, 2], cache_only=False)
+        self.assertTrue(mock_file.write.called)
+
+    @patch("subscription_manager.repolib.YumReleaseverSource")
+    @patch("subscription_manager.repolib.ent_cert.EntitlementDirEntitlementSource")
+    def test_fingerprint_parses_nothing(self, mock_ent_source, mock_release_source):
+        update_action = RepoUpdateActionCommand(cache_only=True)
+        update_action.fingerprint()
+        self.assertFalse(mock_ent_source.called)
+        self.assertFalse(mock_release_source.called)
+
+    @patch("subscription_manager.repolib.YumReleaseverSource")
+    def test_fingerprint_asks_server_for_release(self, mock_release_source):
+        mock_release_source.return_value.get_expansion.return_value = '7.1'
+        update_action = RepoUpdateActionCommand()
+        fingerprint = update_action.fingerprint()
+        self.assertEquals(1, mock_release_source.return_value.get_expansion.call_count)
+
+        update_action.release_source = None
+        mock_release_source.return_value.get_expansion.return_value = '7.2'
+        self.assertNotEqual(fingerprint, update_action.fingerprint())
+
+    def test_fingerprint_follows_overrides(self):
+        update_action = RepoUpdateActionCommand()
+        update_action.override_supported = True
+        fingerprint = update_action.fingerprint()
+        update_action.overrides = {'c1': {'enabled': '0'}}
+        self.assertNotEqual(fingerprint, update_action.fingerprint())
+
     def test_no_gpg_key(self):
 
         update_action = RepoUpdateActionCommand()
@@ -507,76 +694,6 @@ class RepoUpdateActionTests(fixture.SubManFixture):
         self.assertFalse('somekey' in old_repo)
 
 
-class TidyWriterTests(unittest.TestCase):
-
-    def test_just_newlines_compressed_to_one(self):
-        output = StringIO()
-        tidy_writer = TidyWriter(output)
-
-        tidy_writer.write("\n\n\n\n")
-        tidy_writer.close()
-
-        self.assertEquals("\n", output.getvalue())
-
-    def test_newline_added_to_eof(self):
-        output = StringIO()
-        tidy_writer = TidyWriter(output)
-
-        tidy_writer.write("a line\n")
-        tidy_writer.write("another line")
-        tidy_writer.close()
-
-        self.assertEquals("a line\nanother line\n", output.getvalue())
-
-    def test_newline_preserved_on_eof(self):
-        output = StringIO()
-        tidy_writer = TidyWriter(output)
-
-        tidy_writer.write("a line\n")
-        tidy_writer.write("another line\n")
-        tidy_writer.close()
-
-        self.assertEquals("a line\nanother line\n", output.getvalue())
-
-    def test_compression_preserves_a_single_blank_line(self):
-        output = StringIO()
-        tidy_writer = TidyWriter(output)
-
-        tidy_writer.write("test stuff\n\ntest\n")
-        tidy_writer.close()
-
-        self.assertEquals("test stuff\n\ntest\n", output.getvalue())
-
-    def test_newlines_compressed_in_single_write(self):
-        output = StringIO()
-        tidy_writer = TidyWriter(output)
-
-        tidy_writer.write("test stuff\n\n\ntest\n")
-        tidy_writer.close()
-
-        self.assertEquals("test stuff\n\ntest\n", output.getvalue())
-
-    def test_newlines_compressed_across_writes(self):
-        output = StringIO()
-        tidy_writer = TidyWriter(output)
-
-        tidy_writer.write("test stuff\n\n")
-        tidy_writer.write("\ntest\n")
-        tidy_writer.close()
-
-        self.assertEquals("test stuff\n\ntest\n", output.getvalue())
-
-        # now try the other split
-        output = StringIO()
-        tidy_writer = TidyWriter(output)
-
-        tidy_writer.write("test stuff\n")
-        tidy_writer.write("\n\ntest\n")
-        tidy_writer.close()
-
-        self.assertEquals("test stuff\n\ntest\n", output.getvalue())
-
-
 class YumReleaseverSourceTest(fixture.SubManFixture):
     def test_init(self):
         #inj.provide(inj.RELEASE_STATUS_CACHE, Mock())
@@ -684,57 +801,90 @@ class YumReleaseverSourceIsSetTest(fixture.SubManFixture):
 
 class RepoFileTest(unittest.TestCase):
 
-    @patch("subscription_manager.repolib.RepoFile.create")
-    @patch("subscription_manager.repolib.TidyWriter")
-    def test_configparsers_equal(self, tidy_writer, stub_create):
+    def _repo_file(self):
         rf = RepoFile()
-        other = RawConfigParser()
-        for parser in [rf, other]:
-            parser.add_section('test')
-            parser.set('test', 'key', 'val')
-        self.assertTrue(rf._configparsers_equal(other))
+        rf.read()
+        return rf
+
+    def _with_repos_dir(self):
+        repos_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.addCleanup(shutil.rmtree, repos_dir)
+        patcher = patch.object(RepoFile, 'PATH', repos_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return repos_dir
+
+    def test_write_unchanged(self):
+        repos_dir = self._with_repos_dir()
+        rf = self._repo_file()
+        rf.add(Repo('test', [('name', 'test'), ('enabled', '1')]))
+        rf.write()
+        inode = os.stat(rf.path).st_ino
+
+        rf = self._repo_file()
+        rf.update(Repo('test', [('name', 'test'), ('enabled', '1')]))
+        rf.write()
+        self.assertEquals(inode, os.stat(rf.path).st_ino)
+        self.assertEquals(['redhat.repo'], os.listdir(repos_dir))
+
+    def test_write_changed(self):
+        repos_dir = self._with_repos_dir()
+        rf = self._repo_file()
+        rf.add(Repo('test', [('name', 'test'), ('enabled', '1')]))
+        rf.write()
+
+        rf = self._repo_file()
+        rf.update(Repo('test', [('name', 'test'), ('enabled', '0')]))
+        rf.write()
+        self.assertEquals('0', self._repo_file().get('test', 'enabled'))
+        self.assertEquals(['redhat.repo'], os.listdir(repos_dir))
 
     @patch("subscription_manager.repolib.RepoFile.create")
-    @patch("subscription_manager.repolib.TidyWriter")
-    def test_configparsers_diff_sections(self, tidy_writer, stub_create):
+    def test_write_empty_not_created(self, stub_create):
+        repos_dir = self._with_repos_dir()
         rf = RepoFile()
-        rf.add_section('new_section')
-        other = RawConfigParser()
-        for parser in [rf, other]:
-            parser.add_section('test')
-            parser.set('test', 'key', 'val')
-        self.assertFalse(rf._configparsers_equal(other))
+        rf.manage_repos = 1
+        rf.read()
+        rf.write()
+        self.assertEquals([], os.listdir(repos_dir))
+
+    def test_write_is_tidy(self):
+        self._with_repos_dir()
+        rf = self._repo_file()
+        for repo_id in ['a', 'b', 'c']:
+            rf.add(Repo(repo_id, [('name', repo_id)]))
+        rf.write()
+        rf = self._repo_file()
+        rf.delete('b')
+        rf.write()
+        written = open(rf.path).read()
+        self.assertEquals(rf.render(), written)
+        self.assertFalse('\n\n\n' in written)
+        self.assertTrue(written.endswith('\n'))
+
+
+class TidyTests(unittest.TestCase):
 
-    @patch("subscription_manager.repolib.RepoFile.create")
-    @patch("subscription_manager.repolib.TidyWriter")
-    def test_configparsers_diff_item_val(self, tidy_writer, stub_create):
-        rf = RepoFile()
-        other = RawConfigParser()
-        for parser in [rf, other]:
-            parser.add_section('test')
-            parser.set('test', 'key', 'val')
-        rf.set('test', 'key', 'val2')
-        self.assertFalse(rf._configparsers_equal(other))
+    def test_empty(self):
+        self.assertEquals('', repolib.tidy(''))
 
-    @patch("subscription_manager.repolib.RepoFile.create")
-    @patch("subscription_manager.repolib.TidyWriter")
-    def test_configparsers_diff_items(self, tidy_writer, stub_create):
-        rf = RepoFile()
-        other = RawConfigParser()
-        for parser in [rf, other]:
-            parser.add_section('test')
-            parser.set('test', 'key', 'val')
-        rf.set('test', 'somekey', 'val')
-        self.assertFalse(rf._configparsers_equal(other))
+    def test_leading_newlines(self):
+        self.assertEquals('\na line\n', repolib.tidy('\n\n\na line'))
 
-    @patch("subscription_manager.repolib.RepoFile.create")
-    @patch("subscription_manager.repolib.TidyWriter")
-    def test_configparsers_equal_int(self, tidy_writer, stub_create):
-        rf = RepoFile()
-        other = RawConfigParser()
-        for parser in [rf, other]:
-            parser.add_section('test')
-            parser.set('test', 'key', 'val')
-        rf.set('test', 'k', 1)
-        other.set('test', 'k', '1')
-        self.assertTrue(rf._configparsers_equal(other))
+    def test_trailing_newlines_kept(self):
+        self.assertEquals('a line\n\n', repolib.tidy('a line\n\n\n'))
+
+    def test_just_newlines_compressed_to_one(self):
+        self.assertEquals('\n', repolib.tidy('\n\n\n\n'))
+
+    def test_newline_added_to_eof(self):
+        self.assertEquals('a line\nanother line\n', repolib.tidy('a line\nanother line'))
+
+    def test_newline_preserved_on_eof(self):
+        self.assertEquals('a line\nanother line\n', repolib.tidy('a line\nanother line\n'))
+
+    def test_compression_preserves_a_single_blank_line(self):
+        self.assertEquals('test stuff\n\ntest\n', repolib.tidy('test stuff\n\ntest\n'))
+
+    def test_newlines_compressed(self):
+        self.assertEquals('test stuff\n\ntest\n', repolib.tidy('test stuff\n\n\ntest\n'))
@@ -1,3 +1,8 @@
+import os
+import shutil
+import tempfile
+import unittest
+
 import fixture
 
 from mock import Mock, patch
@@ -8,7 +13,8 @@ from subscription_manager.utils import parse_server_info, \
     parse_baseurl_info, format_baseurl, \
     get_version, get_client_versions, \
     get_server_versions, friendly_join, is_true_value, url_base_join,\
-    ProductCertificateFilter, EntitlementCertificateFilter
+    ProductCertificateFilter, EntitlementCertificateFilter, \
+    write_temp_file, write_file_atomic
 from stubs import StubProductCertificate, StubProduct, StubEntitlementCertificate
 
 from rhsm.config import DEFAULT_PORT, DEFAULT_PREFIX, DEFAULT_HOSTNAME, \
@@ -726,3 +732,51 @@ class TestEntitlementCertificateFilter(fixture.SubManFixture):
             result = cert_filter.match(data[2])
 
             self.assertEquals(result, data[3], "EntitlementCertificateFilter.match failed with data set %i.\nActual:   %s\nExpected: %s" % (index, result, data[3]))
+
+
+class TestWriteFileAtomic(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix='subscription-manager-unit-tests-tmp')
+        self.path = os.path.join(self.temp_dir, 'file.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _mode(self):
+        return os.stat(self.path).st_mode & 07777
+
+    def test_write(self):
+        write_file_atomic(self.path, 'old')
+        write_file_atomic(self.path, 'new')
+        self.assertEquals('new', open(self.path).read())
+        self.assertEquals(['file.json'], os.listdir(self.temp_dir))
+        self.assertEquals(0644, self._mode())
+
+    def test_failure_keeps_file(self):
+        write_file_atomic(self.path, 'old')
+        with patch('os.rename', side_effect=OSError):
+            self.assertRaises(OSError, write_file_atomic, self.path, 'new')
+        self.assertEquals('old', open(self.path).read())
+        self.assertEquals(['file.json'], os.listdir(self.temp_dir))
+
+    def test_keeps_mode(self):
+        write_file_atomic(self.path, 'old', mode=0600)
+        self.assertEquals(0600, self._mode())
+        write_file_atomic(self.path, 'new')
+        self.assertEquals(0600, self._mode())
+
+    def test_temp_file_in_dir(self):
+        staging_dir = os.path.join(self.temp_dir, 'staging')
+        os.mkdir(staging_dir)
+        tmp_path = write_temp_file(self.path, 'staged', dir=staging_dir)
+        self.assertEquals(staging_dir, os.path.dirname(tmp_path))
+        self.assertEquals('staged', open(tmp_path).read())
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_temp_file_fsync(self):
+        with patch('os.fsync') as mock_fsync:
+            write_temp_file(self.path, 'new')
+            self.assertFalse(mock_fsync.called)
+            write_temp_file(self.path, 'new', fsync=True)
+            self.assertEquals(1, mock_fsync.call_count)